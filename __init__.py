@@ -0,0 +1,30 @@
+"""
+Description:
+    pyUtils: collection of useful python modules.  Submodules are imported
+    on first use, so "import pyUtils" does not pull in paramiko, scp or
+    MySQLdb until a helper that needs them is used:
+
+        import pyUtils
+        pyUtils.dateUtils        # imports dateUtils only
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+from . import lazyUtils
+
+__all__ = [
+    "connectionUtils",
+    "dateUtils",
+    "emailUtils",
+    "formUtils",
+    "lazyUtils",
+    "metricsUtils",
+    "mySqlUtils",
+    "reUtils",
+]
+
+lazyUtils.lazyPackage(__name__, __all__)
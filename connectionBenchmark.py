@@ -0,0 +1,645 @@
+#! /usr/bin/python
+
+"""
+Description:
+    Benchmarks for connectionUtils, run against local stand-in servers so
+    results are reproducible without lab devices.
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+import re
+import sys
+import json
+import math
+import time
+import socket
+import threading
+import subprocess
+import logging
+import argparse
+import paramiko
+import connectionUtils
+
+
+class SshStandIn(paramiko.ServerInterface):
+    """
+    Description:
+        paramiko server interface for the stand-in SSH server; accepts any
+        user name and password.
+
+    Parameters:
+        server - SshServer that owns the connection
+    """
+
+    def __init__(self, server):
+        """ Class entry point """
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_FAILED
+
+    def check_channel_exec_request(self, channel, command):
+        t = threading.Thread(target=self.server.execute, args=(channel, command))
+        t.daemon = True
+        t.start()
+        return True
+
+    def check_channel_subsystem_request(self, channel, name):
+        if name != "netconf":
+            return False
+        t = threading.Thread(target=self.server.netconf, args=(channel,))
+        t.daemon = True
+        t.start()
+        return True
+
+
+class SshServer():
+    """
+    Description:
+        Local paramiko SSH server.  Exec requests are handled as follows:
+            bytes N   - send N bytes of output
+            sh        - run a local /bin/sh (for persistent shell mode)
+            anything  - echo the command back
+
+        The netconf subsystem answers every <rpc> with an <rpc-reply>
+        carrying the same message-id; an operation containing
+        <bench-bytes>N</bench-bytes> gets N bytes of data in its reply, and
+        one containing <bench-items>N</bench-items> gets N
+        <item><name>item-i</name></item> elements, and one containing
+        <bench-delay>S</bench-delay> gets the first half of its reply, then
+        the rest S seconds later.
+
+    Parameters:
+        host - address to listen on
+        port - port to listen on (0 picks a free port)
+    """
+
+    host_key = None
+    interface = SshStandIn
+
+    def __init__(self, host="127.0.0.1", port=0):
+        """ Class entry point """
+        if SshServer.host_key is None:
+            SshServer.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.host, self.port = self.sock.getsockname()
+        self.transports = []
+        self.running = False
+
+    def start(self):
+        """ Accept connections on a background thread """
+        self.running = True
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def serve(self):
+        """ Accept loop """
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            trans = paramiko.Transport(conn)
+            trans.add_server_key(self.host_key)
+            self.setup(trans)
+            try:
+                trans.start_server(server=self.interface(self))
+            except Exception, msg:
+                logging.error("stand-in server failed to negotiate: %s", msg)
+                continue
+            self.transports.append(trans)
+
+    def setup(self, trans):
+        """ Hook for subclasses to register subsystems on a new transport """
+        pass
+
+    def execute(self, channel, command):
+        """ Handle an exec request """
+        try:
+            if command.startswith("bytes "):
+                remaining = int(command.split()[1])
+                block = "x" * 32768
+                while remaining > 0:
+                    remaining -= channel.send(block[:min(remaining, len(block))])
+            elif command in ("sh", "/bin/sh"):
+                self.shell(channel)
+                return
+            else:
+                channel.sendall(command + "\n")
+            channel.send_exit_status(0)
+        except Exception, msg:
+            logging.debug("stand-in exec ended: %s", msg)
+        finally:
+            # EOF rather than close: the exec reply may not have been sent yet
+            channel.shutdown_write()
+
+    def shell(self, channel):
+        """ Connect a channel to a local /bin/sh """
+        proc = subprocess.Popen(["/bin/sh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+
+        def pump():
+            data = proc.stdout.read(1)
+            while data:
+                channel.sendall(data)
+                data = proc.stdout.read(1) if not channel.closed else ""
+        t = threading.Thread(target=pump)
+        t.daemon = True
+        t.start()
+        try:
+            data = channel.recv(32768)
+            while data:
+                proc.stdin.write(data)
+                proc.stdin.flush()
+                data = channel.recv(32768)
+        finally:
+            proc.stdin.close()
+            proc.wait()
+            t.join(1)
+            channel.send_exit_status(proc.returncode)
+            channel.shutdown_write()
+
+    def netconf(self, channel):
+        """ Minimal NETCONF server (base:1.0 and base:1.1 framing) """
+        hello = ('<?xml version="1.0" encoding="UTF-8"?>'
+                 '<hello xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><capabilities>'
+                 '<capability>urn:ietf:params:netconf:base:1.0</capability>'
+                 '<capability>urn:ietf:params:netconf:base:1.1</capability>'
+                 '</capabilities><session-id>1</session-id></hello>]]>]]>')
+        reader = FrameReader(channel)
+        try:
+            channel.sendall(hello)
+            framing = "1.0"
+            if "urn:ietf:params:netconf:base:1.1" in reader.readEom():
+                framing = "1.1"
+            while True:
+                msg = reader.readEom() if framing == "1.0" else reader.readChunked()
+                if msg is None or "close-session" in msg:
+                    break
+                mo = re.search(r'message-id="([^"]*)"', msg)
+                size = re.search(r"<bench-bytes>(\d+)</bench-bytes>", msg)
+                items = re.search(r"<bench-items>(\d+)</bench-items>", msg)
+                data = "x" * int(size.group(1)) if size else ""
+                if items:
+                    data += "".join("<item><name>item-%d</name></item>" % i for i in range(int(items.group(1))))
+                reply = ('<rpc-reply message-id="%s" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">'
+                         '<data>%s</data></rpc-reply>' % (mo.group(1) if mo else "", data))
+                if framing == "1.0":
+                    reply += "]]>]]>"
+                else:
+                    reply = "\n#%d\n%s\n##\n" % (len(reply), reply)
+                delay = re.search(r"<bench-delay>([\d.]+)</bench-delay>", msg)
+                if delay:
+                    channel.sendall(reply[:len(reply) / 2])
+                    time.sleep(float(delay.group(1)))
+                    reply = reply[len(reply) / 2:]
+                channel.sendall(reply)
+        except Exception, msg:
+            logging.debug("stand-in netconf session ended: %s", msg)
+        finally:
+            try:
+                channel.close()
+            except EOFError:
+                # the client already closed the transport
+                pass
+
+    def stop(self):
+        """ Stop accepting connections and close open transports """
+        self.running = False
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        for trans in self.transports:
+            trans.close()
+
+
+class FrameReader():
+    """
+    Description:
+        Buffered reader for the stand-in servers.
+
+    Parameters:
+        conn - socket or paramiko channel
+    """
+
+    def __init__(self, conn):
+        """ Class entry point """
+        self.conn = conn
+        self.buf = ""
+
+    def fill(self):
+        """ Receive more data; returns False at EOF """
+        data = self.conn.recv(32768)
+        self.buf += data
+        return bool(data)
+
+    def readUntil(self, delimiter):
+        """ Returns data up to (not including) delimiter, or None at EOF """
+        while delimiter not in self.buf:
+            if not self.fill():
+                return None
+        data, self.buf = self.buf.split(delimiter, 1)
+        return data
+
+    def readLine(self):
+        """ Returns the next line without its line ending, or None at EOF """
+        line = self.readUntil("\n")
+        return line.rstrip("\r") if line is not None else None
+
+    def readEom(self):
+        """ Returns the next base:1.0 (]]>]]> terminated) message, or None """
+        return self.readUntil("]]>]]>")
+
+    def readChunked(self):
+        """ Returns the next base:1.1 (chunked) message, or None """
+        msg = []
+        while True:
+            header = self.readUntil("\n#")
+            if header is None:
+                return None
+            size = self.readUntil("\n")
+            if size is None:
+                return None
+            if size == "#":
+                return "".join(msg)
+            size = int(size)
+            while len(self.buf) < size:
+                if not self.fill():
+                    return None
+            msg.append(self.buf[:size])
+            self.buf = self.buf[size:]
+
+
+class LineServer():
+    """
+    Description:
+        Local TCP server answering one command per line; "bytes N" returns
+        N bytes of output and anything else is echoed back.  Subclasses
+        decide on login and prompt handling.
+
+    Parameters:
+        host - address to listen on
+        port - port to listen on (0 picks a free port)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        """ Class entry point """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.host, self.port = self.sock.getsockname()
+        self.conns = []
+        self.running = False
+
+    def start(self):
+        """ Accept connections on a background thread """
+        self.running = True
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def serve(self):
+        """ Accept loop; one thread per connection """
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.conns.append(conn)
+            t = threading.Thread(target=self.session, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def session(self, conn):
+        """ Serve one connection """
+        reader = FrameReader(conn)
+        try:
+            if not self.login(conn, reader):
+                return
+            line = reader.readLine()
+            while line is not None and line != "exit":
+                conn.sendall(self.respond(line))
+                line = reader.readLine()
+        except socket.error, msg:
+            logging.debug("stand-in session ended: %s", msg)
+        finally:
+            conn.close()
+
+    def login(self, conn, reader):
+        """ Hook for subclasses; returns False to drop the connection """
+        return True
+
+    def output(self, line):
+        """ Returns the output of a command """
+        if line.startswith("bytes "):
+            return "x" * int(line.split()[1]) + "\r\n"
+        return line + "\r\n"
+
+    def respond(self, line):
+        """ Returns the full response to a command """
+        return self.output(line)
+
+    def stop(self):
+        """ Stop accepting connections and close open ones """
+        self.running = False
+        for conn in [self.sock] + self.conns:
+            try:
+                conn.close()
+            except socket.error:
+                pass
+
+
+class TelnetServer(LineServer):
+    """
+    Description:
+        Telnet stand-in: "login: " and "Password: " prompts (any credentials
+        are accepted), then a shell prompt after every command.  No option
+        negotiation is done.
+
+    Parameters:
+        host   - address to listen on
+        port   - port to listen on (0 picks a free port)
+        prompt - shell prompt
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, prompt="bench@standin:~$ "):
+        """ Class entry point """
+        LineServer.__init__(self, host, port)
+        self.prompt = prompt
+
+    def login(self, conn, reader):
+        conn.sendall("login: ")
+        if reader.readLine() is None:
+            return False
+        conn.sendall("Password: ")
+        if reader.readLine() is None:
+            return False
+        conn.sendall("\r\n" + self.prompt)
+        return True
+
+    def respond(self, line):
+        return self.output(line) + self.prompt
+
+
+class PromptServer(LineServer):
+    """
+    Description:
+        TCP stand-in that ends every response with a status line of the
+        form 0, "ok" (the default SocketController.readUntil() prompt).
+
+    Parameters:
+        host - address to listen on
+        port - port to listen on (0 picks a free port)
+    """
+
+    def respond(self, line):
+        return self.output(line) + '0, "ok"\r\n'
+
+
+def percentile(values, pct):
+    """ Returns the pct percentile of a sorted list (nearest rank) """
+    if not values:
+        return 0.0
+    index = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def measure(name, connect, call, concurrency=1, requests=200):
+    """
+    Description:
+        Run call(controller) requests times spread over concurrency
+        controllers, one thread per controller.
+
+    Parameters:
+        name        - label for the results
+        connect     - callable returning a connected controller
+        call        - callable taking a controller, returning the response
+        concurrency - number of controllers (and threads)
+        requests    - total number of calls
+
+    Returns:
+        dictionary with connect time, cmds/sec, latency percentiles (ms),
+        MB/s and error count
+    """
+    start = time.time()
+    controllers = [connect() for i in range(concurrency)]
+    connect_time = (time.time() - start) / concurrency
+    for ctl in controllers:
+        call(ctl)  # warm up
+
+    def worker(index):
+        ctl = controllers[index]
+        latencies = []
+        count = 0
+        for i in range(requests // concurrency + (index < requests % concurrency)):
+            begin = time.time()
+            count += len(call(ctl))
+            latencies.append(time.time() - begin)
+        return latencies, count
+
+    latencies = []
+    received = 0
+    errors = 0
+    start = time.time()
+    for index, result, error, elapsed in connectionUtils.runParallel(worker, range(concurrency), concurrency):
+        if error is not None:
+            logging.error("%s worker %d failed: %s", name, index, error)
+            errors += 1
+            continue
+        latencies.extend(result[0])
+        received += result[1]
+    elapsed = time.time() - start
+    for ctl in controllers:
+        try:
+            ctl.close()
+        except Exception, msg:
+            logging.debug("%s close failed: %s", name, msg)
+    latencies.sort()
+    return {"name": name,
+            "concurrency": concurrency,
+            "requests": len(latencies),
+            "errors": errors,
+            "connect": connect_time,
+            "cmds_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p90_ms": percentile(latencies, 90) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "mbps": received / elapsed / 1048576.0 if elapsed else 0.0}
+
+
+def controllerSuites(ssh, telnet, prompt):
+    """
+    Description:
+        Connect and call functions for each controller against the given
+        stand-in servers.
+
+    Parameters:
+        ssh    - running SshServer (exec and netconf)
+        telnet - running TelnetServer
+        prompt - running PromptServer
+
+    Returns:
+        dictionary of name (key) and (connect, call(controller, size)) tuple (value)
+    """
+    def socketCall(ctl, size):
+        ctl.write("bytes %d" % size)
+        return ctl.readUntil()
+
+    return {
+        "ssh": (lambda: connectionUtils.SshController(ssh.host, "bench", "bench", ssh.port),
+                lambda ctl, size: ctl.run("bytes %d" % size)),
+        "netconf": (lambda: connectionUtils.NetconfController(ssh.host, "bench", "bench", ssh.port),
+                    lambda ctl, size: ctl.rpc("<get><bench-bytes>%d</bench-bytes></get>" % size)),
+        "telnet": (lambda: connectionUtils.TelnetController(telnet.host, "bench", "bench", telnet.port),
+                   lambda ctl, size: ctl.run("bytes %d" % size)),
+        "socket": (lambda: connectionUtils.SocketController(prompt.host, prompt.port, echo=False),
+                   socketCall),
+    }
+
+
+def benchmarkControllers(controllers=None, concurrency=(1, 8), payloads=(0, 65536), requests=200):
+    """
+    Description:
+        Measure commands/sec, latency percentiles and MB/s for each
+        controller against local stand-in servers.
+
+    Parameters:
+        controllers - list of "ssh", "netconf", "telnet" and/or "socket"
+                      (defaults to all)
+        concurrency - list of concurrent connection counts
+        payloads    - list of response sizes (in bytes)
+        requests    - calls per measurement
+
+    Returns:
+        list of dictionaries (see measure()) with the payload size added
+    """
+    ssh = SshServer().start()
+    telnet = TelnetServer().start()
+    prompt = PromptServer().start()
+    suites = controllerSuites(ssh, telnet, prompt)
+    if controllers is None:
+        controllers = sorted(suites.keys())
+    results = []
+    try:
+        for name in controllers:
+            connect, call = suites[name]
+            for size in payloads:
+                for workers in concurrency:
+                    r = measure(name, connect, lambda ctl: call(ctl, size), workers, requests)
+                    r["payload"] = size
+                    results.append(r)
+    finally:
+        for server in (ssh, telnet, prompt):
+            server.stop()
+    return results
+
+
+def benchmarkProfiles(profiles=None, size=64 * 1048576, repeat=3):
+    """
+    Description:
+        Measure SshController throughput for each transport profile against a
+        local stand-in SSH server.
+
+    Parameters:
+        profiles - list of profile names (defaults to all transport_profiles)
+        size     - bytes transferred per run
+        repeat   - runs per profile
+
+    Returns:
+        list of dictionaries with profile, connect time, best and mean MB/s
+    """
+    if profiles is None:
+        profiles = sorted(connectionUtils.transport_profiles.keys())
+    server = SshServer().start()
+    results = []
+    try:
+        for profile in profiles:
+            start = time.time()
+            ssh = connectionUtils.SshController(server.host, "bench", "bench", server.port, profile=profile)
+            connect_time = time.time() - start
+            rates = []
+            for i in range(repeat):
+                start = time.time()
+                count = sum(len(chunk) for chunk in ssh.stream("bytes %d" % size))
+                elapsed = time.time() - start
+                if count != size:
+                    logging.error("%s: expected %d bytes, got %d", profile, size, count)
+                rates.append(count / elapsed / 1048576.0)
+            ssh.close()
+            results.append({"profile": profile,
+                            "connect": connect_time,
+                            "best_mbps": max(rates),
+                            "mean_mbps": sum(rates) / len(rates)})
+    finally:
+        server.stop()
+    return results
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description="connectionUtils benchmarks")
+    parser.add_argument("--suite", choices=("controllers", "profiles"), default="controllers",
+                        help="controller comparison or SSH transport profile throughput")
+    parser.add_argument("--controllers", nargs="*", choices=("ssh", "netconf", "telnet", "socket"),
+                        help="controllers to measure (controllers suite)")
+    parser.add_argument("--concurrency", nargs="*", type=int, default=[1, 8],
+                        help="concurrent connections (controllers suite)")
+    parser.add_argument("--payload", nargs="*", type=int, default=[0, 65536],
+                        help="response sizes in bytes (controllers suite)")
+    parser.add_argument("--requests", type=int, default=200, help="calls per measurement (controllers suite)")
+    parser.add_argument("--profiles", nargs="*", help="transport profiles to compare (profiles suite)")
+    parser.add_argument("--size", type=int, default=64, help="MB transferred per run (profiles suite)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per profile (profiles suite)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    # the stand-in servers log every client disconnect as an error
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    if args.suite == "profiles":
+        results = benchmarkProfiles(args.profiles, args.size * 1048576, args.repeat)
+        if args.json:
+            print json.dumps(results, indent=2, sort_keys=True)
+            return 0
+        print "%-20s %10s %10s %10s" % ("profile", "connect s", "best MB/s", "mean MB/s")
+        for r in results:
+            print "%-20s %10.3f %10.1f %10.1f" % (r["profile"], r["connect"], r["best_mbps"], r["mean_mbps"])
+        return 0
+
+    results = benchmarkControllers(args.controllers, args.concurrency, args.payload, args.requests)
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+        return 0
+    print "%-8s %8s %5s %9s %10s %9s %9s %9s %9s %6s" % (
+        "name", "payload", "conc", "connect s", "cmds/s", "p50 ms", "p90 ms", "p99 ms", "MB/s", "errors")
+    for r in results:
+        print "%-8s %8d %5d %9.3f %10.1f %9.2f %9.2f %9.2f %9.1f %6d" % (
+            r["name"], r["payload"], r["concurrency"], r["connect"], r["cmds_per_sec"],
+            r["p50_ms"], r["p90_ms"], r["p99_ms"], r["mbps"], r["errors"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,13 +15,32 @@ import sys
 import os
 import time
 import telnetlib
-import paramiko
-from scp import SCPClient
+import lazyUtils
+import metricsUtils
 import socket
 import select
+import struct
+import fcntl
 import logging
 import StringIO
 import re
+import threading
+import Queue
+import errno
+import collections
+import hashlib
+import pipes
+import random
+import json
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+# heavy modules only some code paths need; imported on first use
+paramiko = lazyUtils.LazyImport("paramiko")
+scp = lazyUtils.LazyImport("scp")
+multiprocessing = lazyUtils.LazyImport("multiprocessing")
 
 
 class TelnetController():
@@ -36,46 +55,98 @@ class TelnetController():
         user     - user name
         password - password
         prompt   - command prompt
+        scheduler - ConnectScheduler for connection retries (defaults to the shared one)
         
     """
-    def __init__(self, host, user, password=None, port=23, timeout=300, prompt=":~$"):
+    def __init__(self, host, user, password=None, port=23, timeout=300, prompt=":~$", scheduler=None):
         """ class entry point """
+        self.type = "telnet"
         self.host = host
+        self.port = int(port)
         self.user = user
         self.password = password
         self.timeout = timeout
         self.prompt = prompt
+        self.scheduler = scheduler or connect_scheduler
         self.hdl = None
         self.connect()
 
     def connect(self):
-        """ Connect to a remote host and login """
+        """ Connect to a remote host and login; raises ConnectError on failure """
+        start = time.time()
+        try:
+            self.hdl = self.scheduler.connect(self.host, self.open, self.port)
+        except ConnectError, msg:
+            metricsUtils.connected(self.type, self.host, time.time() - start, ok=False)
+            logging.error("failed to connect to %s: %s", self.host, msg)
+            raise
+        metricsUtils.connected(self.type, self.host, time.time() - start)
+
+    def open(self, timeout):
+        """ One connection and login attempt (see ConnectScheduler) """
+        hdl = telnetlib.Telnet(self.host, self.port, timeout)
         try:
-            self.hdl = telnetlib.Telnet(self.host)
-            self.hdl.read_until("login: ")
-            self.hdl.write(self.user + "\n")
+            steps = [("login: ", self.user)]
             if self.password:
-                self.hdl.read_until("Password: ")
-                self.hdl.write(self.password + "\n")
-                self.hdl.read_until(self.prompt)
-        except socket.timeout:
-            print "failed to connect to %s" % self.host
+                steps += [("Password: ", self.password), (self.prompt, None)]
+            for text, reply in steps:
+                if not hdl.read_until(text, timeout).endswith(text):
+                    raise socket.timeout("no '%s' from %s" % (text.strip(), self.host))
+                if reply is not None:
+                    hdl.write(reply + "\n")
+        except Exception:
+            hdl.close()
+            raise
+        hdl.sock.settimeout(None)
+        return hdl
 
     def connectDirect(self):
         """ Connect to a remote host (not expecting login) """
         try:
-            self.hdl = telnetlib.Telnet(self.host)
-        except socket.timeout:
-            print "failed to connect to %s" % self.host
+            self.hdl = self.scheduler.connect(self.host, lambda timeout: telnetlib.Telnet(self.host, self.port, timeout),
+                                              self.port)
+        except ConnectError, msg:
+            logging.error("failed to connect to %s: %s", self.host, msg)
+            raise
+        self.hdl.sock.settimeout(None)
             
-    def run(self, cmd, prompt=None):
+    def expect(self, patterns, timeout=None, timer=None):
         """
         Description:
-            Run a command on the remote host.
+            Read until one of a list of regular expressions matches.
+
+        Parameters:
+            patterns - regular expression, or list of regular expressions
+            timeout  - timeout (in seconds)
+            timer    - metricsUtils.CommandTimer to record bytes and timeouts
+                       in; None records the read as an operation of its own
+
+        Returns:
+            tuple of (index of matching pattern or -1, match object, text read)
+        """
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        own = timer is None
+        if own:
+            timer = metricsUtils.timer(self.type, self.host, "read")
+        result = self.hdl.expect([re.compile(p) for p in patterns], timeout or self.timeout)
+        timer.received(len(result[2]))
+        if result[0] == -1:
+            timer.timeout()
+        if own:
+            timer.done()
+        return result
+
+    def run(self, cmd, prompt=None, expect=None):
+        """
+        Description:
+            Run a command on the remote host.  Returns as soon as the prompt
+            (or one of the expect patterns) is seen.
         
         Parameters:
             command  - command to execute
             prompt   - expected prompt after execution
+            expect   - list of regular expressions to wait for instead of prompt
             
         Returns:
             string of command response
@@ -84,9 +155,19 @@ class TelnetController():
             prompt = self.prompt
         if not cmd.endswith("\n"):
             cmd += "\n"
-        time.sleep(1)
+        timer = metricsUtils.timer(self.type, self.host, "run", cmd)
+        self.hdl.read_very_eager()
         self.hdl.write(cmd)
-        return self.hdl.read_until(prompt, self.timeout)
+        timer.sent(len(cmd))
+        if expect:
+            index, match, resp = self.expect(expect, timer=timer)
+        else:
+            resp = self.hdl.read_until(prompt, self.timeout)
+            if not resp.endswith(prompt):
+                timer.timeout()
+            timer.received(len(resp))
+        timer.done()
+        return resp
 
     def close(self):
         """ Close the connection to the remote host """
@@ -94,6 +175,345 @@ class TelnetController():
         self.hdl.close()
 
 
+transport_profiles = {
+    "default": {
+        "window_size": 2147483647,
+    },
+    "bulk-transfer": {
+        "window_size": 2147483647,
+        "max_packet_size": 32768,
+        "ciphers": ("aes128-ctr", "aes256-ctr", "aes128-gcm@openssh.com", "aes256-gcm@openssh.com"),
+        "compress": False,
+        "rekey_bytes": pow(2, 40),
+        "rekey_packets": pow(2, 40),
+    },
+    "low-latency": {
+        "window_size": 4194304,
+        "max_packet_size": 32768,
+        "compress": False,
+        "keepalive": 15,
+    },
+    "constrained-device": {
+        "window_size": 65536,
+        "max_packet_size": 16384,
+        "ciphers": ("aes128-ctr", "aes128-cbc", "3des-cbc"),
+        "compress": False,
+        "keepalive": 60,
+    },
+}
+
+
+def transportProfile(profile="default"):
+    """
+    Description:
+        Resolve a transport profile.
+
+    Parameters:
+        profile - name of an entry in transport_profiles, or a dictionary of
+                  settings (window_size, max_packet_size, ciphers, compress,
+                  rekey_bytes, rekey_packets, keepalive)
+
+    Returns:
+        dictionary of settings
+    """
+    if isinstance(profile, dict):
+        return profile
+    if profile not in transport_profiles:
+        raise ValueError("unknown transport profile '%s'" % profile)
+    return transport_profiles[profile]
+
+
+def sshConnect(host, port, user, password, profile="default", timeout=None):
+    """
+    Description:
+        Connect a paramiko SSHClient and tune its transport with a profile.
+
+    Parameters:
+        host     - hostname or ip address of remote host
+        port     - port number
+        user     - user name
+        password - password
+        profile  - transport profile name or dictionary (see transportProfile)
+        timeout  - TCP connect and banner timeout (in seconds)
+
+    Returns:
+        connected paramiko.SSHClient
+    """
+    settings = transportProfile(profile)
+    hdl = paramiko.SSHClient()
+    hdl.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    kwargs = {"username": user, "password": password, "compress": settings.get("compress", False)}
+    if timeout:
+        kwargs["timeout"] = kwargs["banner_timeout"] = timeout
+    if settings.get("ciphers"):
+        preferred = getattr(paramiko.Transport, "_preferred_ciphers", ())
+        kwargs["disabled_algorithms"] = {"ciphers": [c for c in preferred if c not in settings["ciphers"]]}
+    try:
+        try:
+            hdl.connect(host, int(port), **kwargs)
+        except TypeError:
+            logging.warning("paramiko does not support cipher selection; using its defaults")
+            kwargs.pop("disabled_algorithms", None)
+            hdl.connect(host, int(port), **kwargs)
+        tuneTransport(hdl.get_transport(), settings)
+    except Exception:
+        # a failed login leaves the transport thread and socket running
+        hdl.close()
+        raise
+    return hdl
+
+
+def tuneTransport(trans, profile="default"):
+    """
+    Description:
+        Apply the window, packet, rekey and keepalive settings of a profile to
+        a connected paramiko Transport.  Window and packet sizes apply to
+        channels opened afterwards.
+
+    Parameters:
+        trans   - paramiko.Transport
+        profile - transport profile name or dictionary (see transportProfile)
+    """
+    settings = transportProfile(profile)
+    if "window_size" in settings:
+        trans.window_size = settings["window_size"]
+        trans.default_window_size = settings["window_size"]
+    if "max_packet_size" in settings:
+        trans.default_max_packet_size = settings["max_packet_size"]
+    if "rekey_bytes" in settings:
+        trans.packetizer.REKEY_BYTES = settings["rekey_bytes"]
+    if "rekey_packets" in settings:
+        trans.packetizer.REKEY_PACKETS = settings["rekey_packets"]
+    if settings.get("keepalive"):
+        trans.set_keepalive(settings["keepalive"])
+
+
+class ConnectError(IOError):
+    """ Raised when a controller cannot connect to its host; cause is the last attempt's error (if any) """
+    cause = None
+
+
+class CircuitOpenError(ConnectError):
+    """ Raised without connecting while a host's circuit breaker is open """
+    pass
+
+
+class PoolExhaustedError(ConnectError):
+    """ Raised when no pooled connection slot frees up in time; not a host failure, never retried """
+    pass
+
+
+def endpoint(host, port=None):
+    """ "host:port" (or just host) for log and error messages """
+    if port is None:
+        return str(host)
+    return "%s:%s" % (host, port)
+
+
+class CircuitBreaker():
+    """
+    Description:
+        Per-endpoint circuit breaker, keyed on (host, port).  After threshold
+        consecutive connection failures an endpoint's circuit opens and
+        connections to it fail at once.  After reset seconds one trial
+        connection is let through: success closes the circuit, failure opens
+        it again.
+
+    Parameters:
+        threshold - consecutive failures that open the circuit
+        reset     - seconds before a trial connection is allowed
+    """
+
+    def __init__(self, threshold=3, reset=60):
+        """ Class entry point """
+        self.threshold = int(threshold)
+        self.reset = reset
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.opened = {}
+        self.trial = set()
+
+    def allow(self, host, port=None):
+        """ True if a connection to host:port may be attempted """
+        key = (host, port)
+        self.lock.acquire()
+        try:
+            if key not in self.opened:
+                return True
+            if key in self.trial or time.time() - self.opened[key] < self.reset:
+                return False
+            self.trial.add(key)
+            return True
+        finally:
+            self.lock.release()
+
+    def success(self, host, port=None):
+        """ Record a successful connection (closes the circuit) """
+        key = (host, port)
+        self.lock.acquire()
+        try:
+            self.failures.pop(key, None)
+            self.opened.pop(key, None)
+            self.trial.discard(key)
+        finally:
+            self.lock.release()
+
+    def failure(self, host, port=None):
+        """ Record a failed connection """
+        key = (host, port)
+        self.lock.acquire()
+        try:
+            self.failures[key] = self.failures.get(key, 0) + 1
+            if key in self.trial or self.failures[key] >= self.threshold:
+                if key not in self.opened:
+                    logging.warning("circuit for %s opened after %d failures", endpoint(host, port),
+                                    self.failures[key])
+                self.opened[key] = time.time()
+                self.trial.discard(key)
+        finally:
+            self.lock.release()
+
+    def cancel(self, host, port=None):
+        """ Give back a trial slot taken by allow without recording a result """
+        self.lock.acquire()
+        try:
+            self.trial.discard((host, port))
+        finally:
+            self.lock.release()
+
+    def state(self, host, port=None):
+        """ Returns "closed", "open" or "half-open" """
+        key = (host, port)
+        self.lock.acquire()
+        try:
+            if key not in self.opened:
+                return "closed"
+            if key in self.trial or time.time() - self.opened[key] >= self.reset:
+                return "half-open"
+            return "open"
+        finally:
+            self.lock.release()
+
+    def clear(self, host=None, port=None):
+        """ Forget failures for host:port, every port of a host (port None) or every host """
+        self.lock.acquire()
+        try:
+            if host is None:
+                self.failures, self.opened, self.trial = {}, {}, set()
+                return
+            for table in (self.failures, self.opened):
+                for key in table.keys():
+                    if key[0] == host and (port is None or key[1] == port):
+                        del table[key]
+            self.trial = set(key for key in self.trial
+                             if not (key[0] == host and (port is None or key[1] == port)))
+        finally:
+            self.lock.release()
+
+
+class ConnectScheduler():
+    """
+    Description:
+        Runs connection attempts within an overall deadline, retrying with
+        jittered exponential backoff and consulting a circuit breaker.
+
+    Parameters:
+        deadline        - total seconds allowed for all attempts
+        retries         - retries after the first attempt
+        backoff         - base backoff (in seconds); the delay before retry n
+                          is random between 0 and backoff * 2 ** (n - 1)
+        max_backoff     - upper bound on a single delay (in seconds)
+        attempt_timeout - timeout (in seconds) of a single attempt
+        breaker         - CircuitBreaker (True for the shared breaker, None for none)
+        fatal           - exception types that are not retried (defaults to
+                          paramiko.AuthenticationException)
+    """
+
+    def __init__(self, deadline=60, retries=2, backoff=1.0, max_backoff=15, attempt_timeout=15, breaker=True,
+                 fatal=None):
+        """ Class entry point """
+        self.deadline = deadline
+        self.retries = int(retries)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.attempt_timeout = attempt_timeout
+        self.breaker = circuit_breaker if breaker is True else breaker
+        self.fatal = fatal
+
+    def fatalErrors(self):
+        """ Exception types that are not retried """
+        if self.fatal is not None:
+            return self.fatal
+        if lazyUtils.isLoaded(paramiko):
+            return (paramiko.AuthenticationException,)
+        # paramiko cannot have raised anything if it was never imported
+        return ()
+
+    def connect(self, host, attempt, port=None):
+        """
+        Description:
+            Call attempt(timeout) until it succeeds, the retries are used up,
+            the deadline passes or the endpoint's circuit opens.
+
+        Parameters:
+            host    - hostname or ip address
+            attempt - callable taking the attempt timeout (in seconds) and
+                      returning the connection; the timeout never runs past
+                      the deadline
+            port    - port number; (host, port) is the circuit breaker key
+
+        Returns:
+            result of attempt
+
+        Raises:
+            CircuitOpenError if the endpoint's circuit is open,
+            PoolExhaustedError (as raised by attempt, not retried and not
+            counted against the endpoint) if no local pool slot freed up,
+            ConnectError if every attempt failed
+        """
+        name = endpoint(host, port)
+        deadline = time.time() + self.deadline
+        if self.breaker and not self.breaker.allow(host, port):
+            raise CircuitOpenError("circuit open for %s; not connecting" % name)
+        tries = 0
+        while True:
+            tries += 1
+            timeout = max(0.1, min(self.attempt_timeout, deadline - time.time()))
+            try:
+                result = attempt(timeout)
+            except PoolExhaustedError:
+                # a local limit, the endpoint was never contacted
+                if self.breaker:
+                    self.breaker.cancel(host, port)
+                raise
+            except self.fatalErrors(), msg:
+                if self.breaker:
+                    self.breaker.success(host, port)  # the host answered
+                error = ConnectError("failed to connect to %s: %s" % (name, msg))
+                error.cause = msg
+                raise error
+            except Exception, msg:
+                if self.breaker:
+                    self.breaker.failure(host, port)
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (tries - 1)))
+                if tries > self.retries or time.time() + delay >= deadline:
+                    error = ConnectError("failed to connect to %s after %d attempt(s): %s" % (name, tries, msg))
+                    error.cause = msg
+                    raise error
+                if self.breaker and not self.breaker.allow(host, port):
+                    raise CircuitOpenError("circuit open for %s after %d attempt(s): %s" % (name, tries, msg))
+                logging.info("connection to %s failed (%s); retrying in %.1fs", name, msg, delay)
+                time.sleep(delay)
+                continue
+            if self.breaker:
+                self.breaker.success(host, port)
+            return result
+
+
+circuit_breaker = CircuitBreaker()
+connect_scheduler = ConnectScheduler()
+
+
 class SshController():
     """
     Description:
@@ -105,9 +525,16 @@ class SshController():
         timeout  - timeout (in seconds) 
         user     - user name
         password - password
+        pool     - SshPool to borrow the connection from (True for the shared pool)
+        persistent - run commands over one long-lived shell channel
+        profile  - transport profile name or dictionary (see transport_profiles)
+        cache    - ResultCache for run() results (True for the shared cache)
+        scheduler - ConnectScheduler for connection retries (defaults to the shared one)
+        broker   - Unix socket path of an SshBroker to open channels through
     """
 
-    def __init__(self, host, user, password, port=22, timeout=300):
+    def __init__(self, host, user, password, port=22, timeout=300, pool=None, persistent=False,
+                 profile="default", cache=None, scheduler=None, broker=None):
         """ Class entry point """
         self.type = "ssh"
         self.host = host
@@ -115,34 +542,55 @@ class SshController():
         self.timeout = int(timeout)
         self.user = user
         self.password = password
+        self.pool = ssh_pool if pool is True else pool
+        self.cache = result_cache if cache is True else cache
+        self.scheduler = scheduler or connect_scheduler
+        self.broker = broker
+        self.persistent = persistent
+        self.profile = profile
+        self.shell = None
+        self.shell_buf = bytearray()
+        self.shell_seq = 0
+        self.marker = "__PYUTILS_%s" % os.urandom(6).encode("hex")
         self.hld = None
         self.ec = None
+        self.timed_out = False
         self.connect()
 
     def connect(self):
-        """ Establish handler to remote host """
+        """ Establish handler to remote host; raises ConnectError on failure """
+        start = time.time()
+        scheduler = self.scheduler
+        if self.broker:
+            # the broker retries under its own scheduler and breaker; a single
+            # attempt here, allowed the whole deadline, waits for its verdict
+            scheduler = ConnectScheduler(deadline=scheduler.deadline, retries=0,
+                                         attempt_timeout=scheduler.deadline, breaker=None, fatal=scheduler.fatal)
         try:
-            self.hdl = paramiko.SSHClient()
-            self.hdl.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.hdl.connect(self.host, self.port, username=self.user, password=self.password)
-            self.trans = self.hdl.get_transport()
-            self.trans.window_size = 2147483647
-            self.scp = SCPClient(self.trans)
-
-        except paramiko.AuthenticationException:
-            logging.error("We had an authentication exception!")
-
-        except Exception, msg:
-            try:
-                self.ch.close()
-                self.trans.close()
-                self.trans.stop_thread()
-            except:
-                self.destroy()
-            logging.info("Failed to connect to %s. %s" % (self.host, msg))
+            self.hdl = scheduler.connect(self.host, self.open, self.port)
+        except ConnectError, msg:
+            metricsUtils.connected(self.type, self.host, time.time() - start, ok=False)
+            self.destroy()
+            logging.error("Failed to connect to %s. %s" % (self.host, msg))
+            raise
+        self.trans = self.hdl.get_transport()
+        self.scp = scp.SCPClient(self.trans)
+        metricsUtils.connected(self.type, self.host, time.time() - start)
         logging.info("connection to %s open.", self.host)
         return
 
+    def open(self, timeout):
+        """ One connection attempt (see ConnectScheduler) """
+        if self.broker:
+            return BrokerTransport(self.broker, self.host, self.port, self.user, self.password, self.profile,
+                                   timeout)
+        if self.pool:
+            # waiting for a local slot is not connecting: it is bounded by the command timeout,
+            # so queued callers wait their turn, and only the connect by the attempt timeout
+            return self.pool.acquire(self.host, self.user, self.password, self.port, self.timeout,
+                                     self.profile, timeout)
+        return sshConnect(self.host, self.port, self.user, self.password, self.profile, timeout)
+
     def destroy(self):
         """ destroy handler """
         if 'ch' in dir(self):
@@ -152,43 +600,351 @@ class SshController():
         if 'hdl' in dir(self):
             del self.hdl   
         
-    def flush(self, chan):
-        """ Read everything from the channel """
-        time.sleep(1)
-        resp = self.read(chan)
+    def flush(self, chan, prompt=None):
+        """ Read everything from the channel (until EOF or prompt) """
+        resp = self.read(chan, prompt=prompt)
         return resp
 
-    def read(self, chan, timeout=None):
-        """ Retrieves everything from the channel buffer """
+    def read(self, chan, timeout=None, prompt=None, timer=None):
+        """
+        Description:
+            Retrieves everything from the channel buffer.  Returns at channel
+            EOF, or as soon as the prompt regular expression matches.
+
+        Parameters:
+            chan    - paramiko channel
+            timeout - timeout (in seconds)
+            prompt  - regular expression marking the end of the output
+            timer   - metricsUtils.CommandTimer to record bytes and timeouts
+                      in; None records the read as an operation of its own
+
+        Returns:
+            string of channel contents
+        """
+        if not timeout:
+            timeout = self.timeout
+        if isinstance(prompt, basestring):
+            prompt = re.compile(prompt)
+        own = timer is None
+        if own:
+            timer = metricsUtils.timer(self.type, self.host, "read")
+        buf = bytearray()
+        try:
+            for resp in self.readChunks(chan, timeout, timer=timer):
+                buf.extend(resp)
+                if prompt and prompt.search(buf, max(0, len(buf) - len(resp) - 256)):
+                    break
+        finally:
+            if own:
+                timer.done()
+        return str(buf)
+
+    def readChunks(self, chan, timeout=None, size=32768, timer=None):
+        """
+        Description:
+            Yields output chunks from the channel as they arrive, until EOF.
+            Each chunk is the string recv() returns: paramiko channels have
+            no recv_into(), so there is no preallocated receive buffer (unlike
+            SocketController), but nothing is held beyond the current chunk.
+
+        Parameters:
+            chan    - paramiko channel
+            timeout - timeout (in seconds)
+            size    - maximum chunk size (in bytes)
+            timer   - metricsUtils.CommandTimer to record bytes and timeouts
+                      in; None records the read as an operation of its own
+
+        Returns:
+            generator of strings
+        """
         if not timeout:
             timeout = self.timeout
-        buf = str()
+        own = timer is None
+        if own:
+            timer = metricsUtils.timer(self.type, self.host, "read")
         try:
-            resp = chan.recv(5000)
+            resp = chan.recv(size)
             while resp:
-                buf += resp
-                resp = chan.recv(5000)
+                timer.received(len(resp))
+                yield resp
+                resp = chan.recv(size)
         except socket.timeout: # This is resp_wait.
+            self.timed_out = True
+            timer.timeout()
             logging.error("command timeout '%s' exceeded" % timeout)
-            pass
-        return buf
+        finally:
+            if own:
+                timer.done()
+
+    def readLines(self, chan, timeout=None, size=32768, timer=None):
+        """
+        Description:
+            Yields complete lines (including the newline) from the channel as
+            they arrive.  Memory use is bounded by the longest line.
+
+        Parameters:
+            chan    - paramiko channel
+            timeout - timeout (in seconds)
+            size    - maximum chunk size (in bytes)
+            timer   - metricsUtils.CommandTimer to record bytes and timeouts
+                      in; None records the read as an operation of its own
+
+        Returns:
+            generator of strings
+        """
+        pending = bytearray()
+        for resp in self.readChunks(chan, timeout, size, timer):
+            pending.extend(resp)
+            start = 0
+            end = pending.find("\n")
+            while end != -1:
+                yield str(pending[start:end + 1])
+                start = end + 1
+                end = pending.find("\n", start)
+            del pending[:start]
+        if pending:
+            yield str(pending)
+
+    def stream(self, cmd, timeout=None, sudo=False, lines=False):
+        """
+        Description:
+            Run a command and yield its output as it arrives, without holding
+            the whole response in memory: one chunk (see readChunks), or the
+            longest line, at a time.
+
+        Parameters:
+            cmd     - command to execute
+            timeout - timeout (in seconds)
+            sudo    - run the command with sudo
+            lines   - yield complete lines instead of raw chunks
+
+        Returns:
+            generator of strings
+        """
+        if not timeout:
+            timeout = self.timeout
+        timer = metricsUtils.timer(self.type, self.host, "stream", cmd)
+        chan = self.trans.open_session()
+        chan.settimeout(timeout)
+        if sudo:
+            cmd = "echo %s | sudo -S %s" % (self.password, cmd)
+        try:
+            self.write(cmd, chan, timer)
+            if lines:
+                for line in self.readLines(chan, timeout, timer=timer):
+                    yield line
+            else:
+                for resp in self.readChunks(chan, timeout, timer=timer):
+                    yield resp
+        finally:
+            chan.close()
+            timer.done()
+
+    def runToFile(self, cmd, fobj, timeout=None, sudo=False):
+        """
+        Description:
+            Run a command and write its output directly to a file object.
 
-    def write(self, cmd, chan):
-        """ send a command to the channel """
+        Parameters:
+            cmd     - command to execute
+            fobj    - file-like object with a write() method
+            timeout - timeout (in seconds)
+            sudo    - run the command with sudo
+
+        Returns:
+            number of bytes written
+        """
+        count = 0
+        for resp in self.stream(cmd, timeout, sudo):
+            fobj.write(resp)
+            count += len(resp)
+        return count
+
+    def write(self, cmd, chan, timer=None):
+        """ send a command to the channel (recorded in timer, or as an operation of its own) """
+        own = timer is None
+        if own:
+            timer = metricsUtils.timer(self.type, self.host, "write", cmd)
         chan.exec_command(cmd)
-        chan.sendall(cmd)
+        timer.sent(len(cmd))
+        if own:
+            timer.done()
 
-    def run(self, cmd, timeout=None, sudo=False):
-        """ Send a command and return the response """
+    def openShell(self, shell="/bin/sh"):
+        """
+        Description:
+            Open a long-lived shell channel that runShell() and runBatch()
+            send commands over.
+
+        Parameters:
+            shell - shell to execute on the remote host
+        """
+        self.closeShell()
+        self.shell = self.trans.open_session()
+        self.shell.settimeout(self.timeout)
+        self.shell.exec_command(shell)
+        self.shell_buf = bytearray()
+
+    def closeShell(self):
+        """ Close the long-lived shell channel, if open """
+        if self.shell is None:
+            return
+        try:
+            self.shell.close()
+        except Exception:
+            pass
+        self.shell = None
+
+    def sendShell(self, cmds):
+        """ Write commands followed by end markers to the shell; returns their sequence numbers """
+        if self.shell is None or self.shell.closed:
+            self.openShell()
+        seqs = []
+        data = []
+        for cmd in cmds:
+            self.shell_seq += 1
+            seqs.append(self.shell_seq)
+            data.append("{ %s\n} 2>&1\nprintf '\\n%s_%d_%%d__\\n' $?\n" % (cmd, self.marker, self.shell_seq))
+        self.shell.sendall("".join(data))
+        return seqs
+
+    def readShell(self, seq, timeout=None, timer=None):
+        """
+        Description:
+            Read a command's output from the shell up to its end marker.
+
+        Parameters:
+            seq     - sequence number of the command
+            timeout - timeout (in seconds)
+            timer   - metricsUtils.CommandTimer to record bytes and timeouts
+                      in; None records the read as an operation of its own
+
+        Returns:
+            tuple of (command response, exit status); exit status is None on timeout
+        """
+        if timer is None:
+            timer = metricsUtils.timer(self.type, self.host, "read")
+            try:
+                return self.readShell(seq, timeout, timer)
+            finally:
+                timer.done()
+        if not timeout:
+            timeout = self.timeout
+        pattern = re.compile(r"\n%s_%d_(\d+)__\n" % (self.marker, seq))
+        self.shell.settimeout(timeout)
+        pos = 0
+        try:
+            while True:
+                mo = pattern.search(self.shell_buf, pos)
+                if mo:
+                    resp = str(self.shell_buf[:mo.start()])
+                    status = int(mo.group(1))
+                    del self.shell_buf[:mo.end()]
+                    return resp, status
+                pos = max(0, len(self.shell_buf) - len(self.marker) - 32)
+                data = self.shell.recv(32768)
+                if not data:
+                    raise IOError("shell channel to %s closed" % self.host)
+                timer.received(len(data))
+                self.shell_buf.extend(data)
+        except socket.timeout:
+            self.timed_out = True
+            timer.timeout()
+            logging.error("command timeout '%s' exceeded" % timeout)
+        resp = str(self.shell_buf)
+        self.closeShell()
+        return resp, None
+
+    def runShell(self, cmd, timeout=None):
+        """
+        Description:
+            Run a command over the long-lived shell channel.  The exit status
+            is stored in self.ec.
+
+        Parameters:
+            cmd     - command to execute
+            timeout - timeout (in seconds)
+
+        Returns:
+            string of command response
+        """
+        timer = metricsUtils.timer(self.type, self.host, "runShell", cmd)
+        seq = self.sendShell([cmd])[0]
+        timer.sent(len(cmd))
+        resp, self.ec = self.readShell(seq, timeout, timer)
+        timer.done()
+        return resp
+
+    def runBatch(self, cmds, timeout=None):
+        """
+        Description:
+            Send a list of commands over the shell channel in a single write
+            and collect each command's output and exit status.
+
+        Parameters:
+            cmds    - list of commands to execute
+            timeout - timeout (in seconds) for each command
+
+        Returns:
+            list of (command response, exit status) tuples
+        """
+        timer = metricsUtils.timer(self.type, self.host, "runBatch")
+        results = []
+        for seq in self.sendShell(cmds):
+            if self.shell is None:
+                results.append(("", None))
+                continue
+            results.append(self.readShell(seq, timeout, timer))
+        timer.sent(sum(len(cmd) for cmd in cmds))
+        timer.done()
+        return results
+
+    def run(self, cmd, timeout=None, sudo=False, prompt=None):
+        """
+        Description:
+            Send a command and return the response (at EOF or prompt).  With
+            a cache, plain commands (no sudo or prompt) are answered from it;
+            partial output of commands that timed out is not cached.  The
+            exit status is stored in self.ec (None if unknown), and
+            self.timed_out is set if the output is partial.
+
+        Parameters:
+            cmd     - command to execute
+            timeout - timeout (in seconds)
+            sudo    - run the command with sudo
+            prompt  - regular expression marking the end of the output
+
+        Returns:
+            string of command response
+        """
+        if self.cache and not sudo and not prompt:
+            scope = (self.type, self.host, self.port, self.user)
+            def call():
+                resp = self.runCommand(cmd, timeout)
+                return resp, self.ec, self.timed_out
+            # the exit status is cached with the output, so self.ec matches on hits
+            resp, self.ec, self.timed_out = self.cache.call(scope, cmd, call, lambda r: r[0] and not r[2])
+            return resp
+        return self.runCommand(cmd, timeout, sudo, prompt)
+
+    def runCommand(self, cmd, timeout=None, sudo=False, prompt=None):
+        """ Send a command and return the response, bypassing the cache """
+        self.timed_out = False
+        if self.persistent and not sudo and not prompt:
+            return self.runShell(cmd, timeout)
         if not timeout:
             timeout = self.timeout
+        timer = metricsUtils.timer(self.type, self.host, "run", cmd)
         chan = self.trans.open_session()
         chan.settimeout(timeout)
         if sudo:
             cmd = "echo %s | sudo -S %s" % (self.password, cmd)
-        self.write(cmd, chan)
-        resp = self.read(chan, timeout)
+        self.write(cmd, chan, timer)
+        resp = self.read(chan, timeout, prompt, timer)
+        # the exit status follows EOF; it is unknown after a timeout or prompt
+        self.ec = None if self.timed_out or prompt else chan.recv_exit_status()
         chan.close()
+        timer.done()
         return resp
 
     def killProcess(self, p):
@@ -205,118 +961,1718 @@ class SshController():
 
     def get(self, src, dst):
         """ Get a file from a remote" location """
-        self.scp.put(src, dst)
+        self.scp.get(src, dst)
     
     def put(self, src, dst):
         """ Put a file on a remote location """
         self.scp.put(src, dst)
    
     def close(self):
+        self.closeShell()
+        if self.pool:
+            self.pool.release(self.hdl)
+            logging.info("connection to %s returned to pool.", self.host)
+            return
         self.trans.close()
         self.trans.stop_thread()
         logging.info("connection to %s closed.", self.host)
 
 
-class NetconfController():
+class SshPool():
     """
     Description:
-        Connect to remote host via netconf and issue commands.
+        Process-wide pool of authenticated SSH connections keyed by
+        (host, port, user, transport profile).  Connections are health-checked before reuse,
+        evicted once they have been idle for longer than ttl, and capped
+        per host: the cap counts every port, user and profile, since it is
+        the device that limits concurrent sessions.  When a host is at its
+        cap, an idle connection under another key is closed to make room.
 
     Parameters:
-        host     - hostname or ip address of remote host
-        port     - port number
-        timeout  - timeout (in seconds) 
-        user     - user name
-        password - password   
+        ttl          - seconds an idle connection is kept before it is closed
+        max_per_host - maximum number of connections (idle and in use) per host
     """
-    
-    def __init__(self, host, user, password, port=830, timeout=300):
+
+    def __init__(self, ttl=300, max_per_host=4):
         """ Class entry point """
-        self.type = "netconf"
-        self.host = host
-        self.port = int(port)
-        self.timeout = int(timeout)
-        self.user = user
-        self.password = password
-        self.hld = None
-        self.connect()
-        self.flush()
-        self.hello()
-        
-    def connect(self):
-        """ Creates a NETCONF connection. """
-        try:
-            self.hdl = paramiko.SSHClient()
-            self.hdl.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.hdl.connect(self.host, self.port, username=self.user,password=self.password)
-            self.trans = self.hdl.get_transport()
-#             self.trans.window_size = 2147483647            
-            self.ch = self.trans.open_session()
-            self.ch.setblocking(0)
-            self.ch.settimeout(self.timeout)
-            self.ch.invoke_subsystem('netconf')
-
-        except Exception,msg:
-            try:
-                self.ch.close()
-                self.trans.close()
-                self.trans.stop_thread()
-            except:
-                pass
-            print "Failed to connect to %s" % msg
-            sys.exit(1)
+        self.ttl = ttl
+        self.max_per_host = int(max_per_host)
+        self.idle = {}
+        self.count = {}
+        self.keys = {}
+        self.lock = threading.Condition()
 
-    def flush(self):
-        """ read everything in the buffer """
-        time.sleep(2)
-        resp = self.read()
-        return
+    def isAlive(self, hdl):
+        """ Returns True if the connection's transport is still usable """
+        trans = hdl.get_transport()
+        if trans is None or not trans.is_active():
+            return False
+        try:
+            trans.send_ignore()
+        except Exception:
+            return False
+        return True
 
-    def read(self):
-        """ Retrieves everything from the buffer. """
-        buf = str()
+    def acquire(self, host, user, password, port=22, timeout=300, profile="default", connect_timeout=None):
+        """
+        Description:
+            Check out a connection to a remote host, reusing an idle one if possible.
+
+        Parameters:
+            host     - hostname or ip address of remote host
+            user     - user name
+            password - password
+            port     - port number
+            timeout  - seconds to wait for a free slot when the host is at its cap
+            profile  - transport profile used for new connections
+            connect_timeout - TCP connect and banner timeout for new connections
+
+        Raises:
+            PoolExhaustedError if no slot frees up within timeout
+
+        Returns:
+            connected paramiko.SSHClient
+        """
+        if isinstance(profile, dict):
+            profile_key = tuple(sorted(profile.items()))
+        else:
+            profile_key = profile
+        key = (host, int(port), user, profile_key)
+        deadline = time.time() + timeout
+        self.lock.acquire()
         try:
-            resp = self.ch.recv(5000)
-            while resp:
-                buf += resp
-                resp = self.ch.recv(5000)
-                if resp.find('</rpc-reply>') == 0:
+            while True:
+                self.evictIdle()
+                idle = self.idle.setdefault(key, [])
+                while idle:
+                    hdl, last_used = idle.pop()
+                    if self.isAlive(hdl):
+                        self.keys[id(hdl)] = key
+                        return hdl
+                    self.discardLocked(key, hdl)
+                if self.count.get(host, 0) >= self.max_per_host:
+                    self.closeIdleLocked(host)
+                if self.count.get(host, 0) < self.max_per_host:
+                    self.count[host] = self.count.get(host, 0) + 1
                     break
-        except socket.timeout:
-            pass
-        return buf
-    
-    def write(self, cmd):
-        """ Writes a message to the channel """
-        if not cmd.endswith("]]>]]>"):
-            cmd += "]]>]]>"        
-#         self.ch.send(cmd)
-        self.ch.sendall(cmd)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhaustedError("no free connection to %s within %ss" % (host, timeout))
+                self.lock.wait(remaining)
+        finally:
+            self.lock.release()
 
-    def run(self, cmd):
-        self.write(cmd)
-        return self.read()
+        try:
+            hdl = sshConnect(host, port, user, password, profile, connect_timeout)
+        except Exception:
+            self.lock.acquire()
+            try:
+                self.count[host] -= 1
+                self.lock.notify_all()
+            finally:
+                self.lock.release()
+            raise
+        self.lock.acquire()
+        try:
+            self.keys[id(hdl)] = key
+        finally:
+            self.lock.release()
+        return hdl
+
+    def release(self, hdl):
+        """ Return a checked out connection to the pool """
+        self.lock.acquire()
+        try:
+            key = self.keys.pop(id(hdl), None)
+            if key is None:
+                return
+            if self.isAlive(hdl):
+                self.idle.setdefault(key, []).append((hdl, time.time()))
+            else:
+                self.discardLocked(key, hdl)
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def discard(self, hdl):
+        """ Close a checked out connection instead of returning it to the pool """
+        self.lock.acquire()
+        try:
+            key = self.keys.pop(id(hdl), None)
+            if key is not None:
+                self.discardLocked(key, hdl)
+                self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def discardLocked(self, key, hdl):
+        """ Close a connection and free its host slot; caller holds the lock """
+        self.count[key[0]] = max(0, self.count.get(key[0], 0) - 1)
+        try:
+            hdl.close()
+        except Exception:
+            pass
+
+    def closeIdleLocked(self, host):
+        """ Close the longest idle connection to host under any key; caller holds the lock """
+        oldest = None
+        for key, idle in self.idle.items():
+            if key[0] == host and idle and (oldest is None or idle[0][1] < oldest[1][1]):
+                oldest = (key, idle[0])
+        if oldest is not None:
+            key, entry = oldest
+            self.idle[key].remove(entry)
+            self.discardLocked(key, entry[0])
+
+    def evictIdle(self):
+        """ Close connections that have been idle for longer than ttl """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            for key, idle in self.idle.items():
+                keep = []
+                for hdl, last_used in idle:
+                    if now - last_used > self.ttl:
+                        logging.debug("evicting idle connection to %s", key[0])
+                        self.discardLocked(key, hdl)
+                    else:
+                        keep.append((hdl, last_used))
+                self.idle[key] = keep
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def closeAll(self):
+        """ Close every idle connection in the pool """
+        self.lock.acquire()
+        try:
+            for key, idle in self.idle.items():
+                for hdl, last_used in idle:
+                    self.discardLocked(key, hdl)
+            self.idle = {}
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+
+ssh_pool = SshPool()
+
+
+class ResultCache():
+    """
+    Description:
+        LRU cache of command results with per-command TTLs.  Concurrent
+        calls for the same command share one execution (single-flight).
+        Only use it for commands without side effects, such as "show ..."
+        or <get-config>.  Errors and empty responses are not cached.
+
+    Parameters:
+        size - maximum number of cached results
+        ttl  - default time to live (in seconds)
+        ttls - list of (regular expression, ttl) tuples; the first
+               expression matching the start of a command sets its ttl
+               (a ttl of 0 disables caching for that command)
+    """
+
+    def __init__(self, size=1024, ttl=30, ttls=None):
+        """ Class entry point """
+        self.size = int(size)
+        self.ttl = ttl
+        self.ttls = [(re.compile(p) if isinstance(p, basestring) else p, t) for p, t in ttls or []]
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.bypassed = 0
+
+    def ttlFor(self, cmd):
+        """ Returns the time to live for a command """
+        for pattern, ttl in self.ttls:
+            if pattern.match(cmd):
+                return ttl
+        return self.ttl
+
+    def call(self, scope, cmd, func, cacheable=None):
+        """
+        Description:
+            Returns the cached result of cmd, waits for an identical call
+            already in flight, or calls func() and caches its result.
+
+        Parameters:
+            scope     - tuple identifying the connection, such as (type, host, port, user)
+            cmd       - command (the cache key within the scope)
+            func      - callable running the command
+            cacheable - callable taking the result; False keeps it out of
+                        the cache (such as partial output after a timeout).
+                        Defaults to caching any non-empty result.
+
+        Returns:
+            command result
+        """
+        ttl = self.ttlFor(cmd)
+        if ttl <= 0:
+            self.lock.acquire()
+            self.bypassed += 1
+            self.lock.release()
+            return func()
+        key = (scope, cmd)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            future = self.inflight.get(key)
+            if future is not None:
+                self.shared += 1
+            else:
+                self.misses += 1
+                flight = self.inflight[key] = Future()
+        finally:
+            self.lock.release()
+        if future is not None:
+            return future.result()
+
+        try:
+            value = func()
+        except Exception, msg:
+            self.lock.acquire()
+            del self.inflight[key]
+            self.lock.release()
+            flight.setException(msg)
+            raise
+        self.lock.acquire()
+        try:
+            del self.inflight[key]
+            if value and (cacheable is None or cacheable(value)):
+                self.entries[key] = (time.time() + ttl, value)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+        flight.setResult(value)
+        return value
+
+    def invalidate(self, host=None, cmd=None):
+        """ Drop cached results for a host and/or command (everything by default) """
+        self.lock.acquire()
+        try:
+            for scope, key_cmd in self.entries.keys():
+                if (host is None or host in scope) and (cmd is None or cmd == key_cmd):
+                    del self.entries[(scope, key_cmd)]
+        finally:
+            self.lock.release()
+
+    def hitRatio(self):
+        """ Returns the fraction of cacheable calls answered without running the command """
+        self.lock.acquire()
+        try:
+            return self.hitRatioLocked()
+        finally:
+            self.lock.release()
+
+    def hitRatioLocked(self):
+        """ hitRatio() for callers holding the lock """
+        total = self.hits + self.shared + self.misses
+        return float(self.hits + self.shared) / total if total else 0.0
+
+    def stats(self):
+        """ Returns a dictionary of cache statistics """
+        self.lock.acquire()
+        try:
+            return {"hits": self.hits,
+                    "shared": self.shared,
+                    "misses": self.misses,
+                    "bypassed": self.bypassed,
+                    "size": len(self.entries),
+                    "hit_ratio": self.hitRatioLocked()}
+        finally:
+            self.lock.release()
+
+
+result_cache = ResultCache()
+
+
+def sendFrame(sock, kind, data=""):
+    """ Send a broker frame: one type byte, a 4-byte length and the data """
+    sock.sendall(struct.pack("!cI", kind, len(data)) + data)
+
+
+class SshBroker():
+    """
+    Description:
+        Local broker, similar to OpenSSH ControlMaster, that holds one
+        authenticated SSH transport per device and opens channels on it for
+        clients connecting over a Unix socket.  Worker processes use it
+        through SshController(..., broker=path), so N workers share one
+        login per device.
+
+        Each client connection carries one channel.  The client sends a
+        header frame ("h", JSON with host, port, user, password, profile,
+        op and arg), then data ("d"), end of input ("w") and close ("c")
+        frames.  The broker answers "o" (ok) or "e" ("<error class>:
+        <message>"), then sends output ("d") and the exit status ("x") and
+        closes the socket at channel EOF.
+
+    Parameters:
+        path         - Unix socket path
+        ttl          - seconds an unused transport is kept before it is closed
+        max_channels - channels per transport before another login is made
+                       (OpenSSH servers default to MaxSessions 10)
+        scheduler    - ConnectScheduler for device connections
+    """
+
+    def __init__(self, path, ttl=300, max_channels=10, scheduler=None):
+        """ Class entry point """
+        self.path = path
+        self.ttl = ttl
+        self.max_channels = int(max_channels)
+        self.scheduler = scheduler or connect_scheduler
+        self.lock = threading.Lock()
+        self.transports = {}
+        self.key_locks = {}
+        self.sock = None
+        self.running = False
+
+    def listen(self):
+        """ Bind the Unix socket (readable by the current user only) """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                probe.close()
+                raise IOError("a broker is already listening on %s" % self.path)
+            except socket.error:
+                os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0177)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(128)
+        self.sock.settimeout(1)
+        self.running = True
+
+    def serve(self):
+        """ Accept clients until stop() is called; one thread per channel """
+        if self.sock is None:
+            self.listen()
+        while self.running:
+            self.evictIdle()
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            conn.settimeout(None)
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+        self.closeAll()
+
+    def start(self):
+        """ Serve on a background thread of this process """
+        self.listen()
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        """ Stop accepting clients and remove the socket """
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def transport(self, request):
+        """
+        Description:
+            Returns a transport for a device with room for another channel,
+            logging in only if there is none.
+
+        Parameters:
+            request - client header dictionary
+
+        Returns:
+            list of [SSHClient, open channel count, last used time]
+        """
+        key = (request["host"], int(request["port"]), request["user"],
+               hashlib.sha1(request["password"] or "").hexdigest(), json.dumps(request.get("profile")))
+        self.lock.acquire()
+        key_lock = self.key_locks.setdefault(key, threading.Lock())
+        self.lock.release()
+        key_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                entries = self.transports.setdefault(key, [])
+                for entry in list(entries):
+                    if not entry[0].get_transport().is_active():
+                        entries.remove(entry)
+                        continue
+                    if entry[1] < self.max_channels:
+                        entry[1] += 1
+                        entry[2] = time.time()
+                        return entry
+            finally:
+                self.lock.release()
+            profile = request.get("profile") or "default"
+            hdl = self.scheduler.connect(request["host"], lambda timeout: sshConnect(
+                request["host"], request["port"], request["user"], request["password"], profile, timeout),
+                request["port"])
+            entry = [hdl, 1, time.time()]
+            self.lock.acquire()
+            self.transports[key].append(entry)
+            self.lock.release()
+            logging.info("broker connected to %s", request["host"])
+            return entry
+        finally:
+            key_lock.release()
+
+    def done(self, entry):
+        """ Release a transport's channel slot """
+        self.lock.acquire()
+        entry[1] -= 1
+        entry[2] = time.time()
+        self.lock.release()
+
+    def evictIdle(self):
+        """ Close transports that have had no channels for longer than ttl """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for key, entries in self.transports.items():
+                for entry in list(entries):
+                    if entry[1] == 0 and now - entry[2] > self.ttl:
+                        entries.remove(entry)
+                        entry[0].close()
+        finally:
+            self.lock.release()
+
+    def closeAll(self):
+        """ Close every transport """
+        self.lock.acquire()
+        try:
+            for entries in self.transports.values():
+                for entry in entries:
+                    entry[0].close()
+            self.transports = {}
+        finally:
+            self.lock.release()
+
+    def handle(self, conn):
+        """ Serve one client channel """
+        reader = BrokerChannel(conn)
+        entry = chan = None
+        try:
+            kind, data = reader.readFrame()
+            if kind == "c":
+                return  # a liveness probe (see listen and spawnBroker)
+            if kind != "h":
+                raise IOError("expected a header frame, got %r" % kind)
+            request = json.loads(data)
+            entry = self.transport(request)
+            if request["op"] == "connect":
+                sendFrame(conn, "o")
+                return
+            chan = entry[0].get_transport().open_session()
+            if request["op"] == "exec":
+                chan.exec_command(request["arg"])
+            elif request["op"] == "subsystem":
+                chan.invoke_subsystem(request["arg"])
+            elif request["op"] == "shell":
+                chan.invoke_shell()
+            else:
+                raise IOError("unknown broker operation %r" % request["op"])
+            sendFrame(conn, "o")
+            self.pump(conn, reader, chan)
+        except Exception, msg:
+            logging.debug("broker channel failed: %s", msg)
+            # the class lets the client tell a rejected login from a failed connect
+            cause = getattr(msg, "cause", None) or msg
+            try:
+                sendFrame(conn, "e", "%s: %s" % (cause.__class__.__name__, msg))
+            except socket.error:
+                pass
+        finally:
+            if chan is not None:
+                chan.close()
+            if entry is not None:
+                self.done(entry)
+            conn.close()
+
+    def pump(self, conn, reader, chan):
+        """ Copy data between a client socket and a channel until channel EOF """
+        while True:
+            r, w, e = select.select([conn, chan], [], [])
+            if conn in r:
+                reader.fill()
+            while reader.frames:
+                kind, data = reader.frames.popleft()
+                if kind == "d":
+                    chan.sendall(data)
+                elif kind == "w":
+                    chan.shutdown_write()
+                else:
+                    return
+            if chan in r:
+                data = chan.recv(32768)
+                if data:
+                    sendFrame(conn, "d", data)
+                    continue
+                sendFrame(conn, "x", struct.pack("!i", chan.recv_exit_status()))
+                return
+
+
+class BrokerChannel():
+    """
+    Description:
+        Client end of a channel opened through an SshBroker.  Implements the
+        parts of paramiko.Channel that SshController and SCPClient use.
+
+    Parameters:
+        sock    - connected Unix socket
+        host    - device the channel is opened on
+        request - header dictionary sent when the channel is opened
+    """
+
+    def __init__(self, sock, host=None, request=None):
+        """ Class entry point """
+        self.sock = sock
+        self.host = host
+        self.request = request
+        self.rbuf = bytearray()
+        self.frames = collections.deque()
+        self.data = bytearray()
+        self.closed = False
+        self.eof = False
+        self.exit_status = -1
+        self.error = None
+
+    def fill(self):
+        """ Receive once and queue the complete frames received (EOF queues a "c" frame) """
+        try:
+            chunk = self.sock.recv(32768)
+        except socket.error, e:
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise socket.timeout("timed out")
+            raise
+        if not chunk:
+            self.frames.append(("c", ""))
+            return
+        self.rbuf.extend(chunk)
+        while len(self.rbuf) >= 5:
+            kind, size = struct.unpack_from("!cI", self.rbuf)
+            if len(self.rbuf) < 5 + size:
+                break
+            self.frames.append((kind, str(self.rbuf[5:5 + size])))
+            del self.rbuf[:5 + size]
+
+    def readFrame(self):
+        """ Returns the next frame as a (type, data) tuple """
+        while not self.frames:
+            self.fill()
+        return self.frames.popleft()
+
+    def open(self, op, arg=None):
+        """ Ask the broker for a channel; raises paramiko.SSHException on failure """
+        request = dict(self.request, op=op, arg=arg)
+        sendFrame(self.sock, "h", json.dumps(request))
+        kind, data = self.readFrame()
+        if kind != "o":
+            self.closed = self.eof = True
+            self.sock.close()
+            name, sep, text = data.partition(": ")
+            if name == "AuthenticationException":
+                raise paramiko.AuthenticationException("broker: %s" % text)
+            raise paramiko.SSHException("broker: %s" % (data or "channel refused"))
+
+    def exec_command(self, command):
+        self.open("exec", command)
+
+    def invoke_subsystem(self, subsystem):
+        self.open("subsystem", subsystem)
+
+    def invoke_shell(self, *args, **kwargs):
+        self.open("shell")
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def setblocking(self, blocking):
+        self.sock.settimeout(None if blocking else 0.0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        """ Returns up to size bytes of output ("" at EOF) """
+        while not self.data and not self.eof:
+            if not self.frames:
+                self.fill()
+            while self.frames:
+                kind, data = self.frames.popleft()
+                if kind == "d":
+                    self.data.extend(data)
+                elif kind == "x":
+                    self.exit_status = struct.unpack("!i", data)[0]
+                elif kind == "e":
+                    self.error = data
+                    logging.error("broker channel to %s failed: %s", self.host, data)
+                elif kind == "c":
+                    self.eof = self.closed = True
+        data = str(self.data[:size])
+        del self.data[:size]
+        return data
+
+    def recv_ready(self):
+        return bool(self.data)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def recv_stderr(self, size):
+        return ""
+
+    def send(self, data):
+        sendFrame(self.sock, "d", data)
+        return len(data)
+
+    def sendall(self, data):
+        sendFrame(self.sock, "d", data)
+
+    def shutdown_write(self):
+        sendFrame(self.sock, "w")
+
+    def exit_status_ready(self):
+        return self.eof
+
+    def recv_exit_status(self):
+        """ Wait for EOF and return the exit status """
+        self.sock.settimeout(None)
+        while self.recv(32768):
+            pass
+        return self.exit_status
+
+    def close(self):
+        if self.closed and self.eof:
+            self.sock.close()
+            return
+        self.closed = True
+        try:
+            sendFrame(self.sock, "c")
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class BrokerTransport():
+    """
+    Description:
+        Stands in for paramiko.Transport (and SSHClient) for connections made
+        through an SshBroker: every open_session() is a new channel on the
+        broker's shared transport.
+
+    Parameters:
+        path     - broker Unix socket path
+        host     - hostname or ip address of remote host
+        port     - port number
+        user     - user name
+        password - password
+        profile  - transport profile name or dictionary (see transport_profiles)
+        timeout  - timeout (in seconds) for reaching the broker and the device
+    """
+
+    def __init__(self, path, host, port, user, password, profile="default", timeout=None):
+        """ Class entry point """
+        self.path = path
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.request = {"host": host, "port": self.port, "user": user, "password": password, "profile": profile}
+        self.active = True
+        # have the broker log in now, so failures surface at connect time
+        chan = self.open_session()
+        try:
+            chan.open("connect")
+            chan.recv(1)
+        finally:
+            chan.close()
+
+    def open_session(self, *args, **kwargs):
+        """ Returns a BrokerChannel (the channel is opened by exec_command and friends) """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return BrokerChannel(sock, self.host, self.request)
+
+    def get_transport(self):
+        return self
+
+    def getpeername(self):
+        return (self.host, self.port)
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self, *args):
+        pass
+
+    def close(self):
+        self.active = False
+
+    def stop_thread(self):
+        pass
+
+
+def spawnBroker(path, **kwargs):
+    """
+    Description:
+        Start an SshBroker in its own process and wait until it listens.
+
+    Parameters:
+        path   - Unix socket path
+        kwargs - SshBroker arguments (ttl, max_channels)
+
+    Returns:
+        multiprocessing.Process running the broker
+    """
+    proc = multiprocessing.Process(target=lambda: SshBroker(path, **kwargs).serve())
+    proc.daemon = True
+    proc.start()
+    deadline = time.time() + 10
+    # the socket file appears at bind(), before listen(); only a connect proves the broker is up
+    while True:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            break
+        except socket.error:
+            pass
+        finally:
+            probe.close()
+        if time.time() > deadline or not proc.is_alive():
+            raise IOError("broker did not start on %s" % path)
+        time.sleep(0.05)
+    return proc
+
+
+def runParallel(func, items, workers=20):
+    """
+    Description:
+        Call func(item) for every item on a bounded pool of threads and yield
+        results in the order they complete.
+
+    Parameters:
+        func    - callable taking a single item
+        items   - list of items to pass to func
+        workers - maximum number of concurrent threads
+
+    Returns:
+        generator of (item, result, error, elapsed) tuples; error is None on
+        success and result is None on failure
+    """
+    todo = Queue.Queue()
+    done = Queue.Queue()
+    for item in items:
+        todo.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                done.put((item, func(item), None, time.time() - start))
+            except Exception, msg:
+                done.put((item, None, msg, time.time() - start))
+
+    threads = []
+    for i in range(max(1, min(int(workers), len(items)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for i in range(len(items)):
+        yield done.get()
+    for t in threads:
+        t.join()
+
+
+class SshResult():
+    """
+    Description:
+        Outcome of running a command on a single host.
+
+    Parameters:
+        host         - hostname or ip address of remote host
+        cmd          - command that was executed
+        output       - command response (None if the command failed)
+        error        - error message (None if the command succeeded)
+        connect_time - time (in seconds) spent establishing the connection
+        run_time     - time (in seconds) spent running the command
+    """
+
+    def __init__(self, host, cmd, output=None, error=None, connect_time=0.0, run_time=0.0):
+        """ Class entry point """
+        self.host = host
+        self.cmd = cmd
+        self.output = output
+        self.error = error
+        self.connect_time = connect_time
+        self.run_time = run_time
+
+    def ok(self):
+        """ True if the command ran without error """
+        return self.error is None
+
+    def __repr__(self):
+        return "<SshResult %s ok=%s %.2fs>" % (self.host, self.ok(), self.connect_time + self.run_time)
+
+
+class SshFanOut():
+    """
+    Description:
+        Run the same command (or a per-host command) on many hosts with
+        SshController, using a bounded pool of threads.  A full sweep takes
+        about as long as the slowest host.
+
+    Parameters:
+        hosts    - list of hostnames or ip addresses
+        user     - user name
+        password - password
+        port     - port number
+        timeout  - timeout (in seconds) for each command
+        workers  - maximum number of concurrent sessions
+        pool     - SshPool to borrow connections from (True for the shared pool)
+        profile  - transport profile name or dictionary (see transport_profiles)
+        scheduler - ConnectScheduler for connection retries (defaults to the shared one)
+    """
+
+    def __init__(self, hosts, user, password, port=22, timeout=300, workers=20, pool=None, profile="default",
+                 scheduler=None):
+        """ Class entry point """
+        self.scheduler = scheduler
+        self.hosts = list(hosts)
+        self.pool = pool
+        self.profile = profile
+        self.user = user
+        self.password = password
+        self.port = int(port)
+        self.timeout = int(timeout)
+        self.workers = int(workers)
+
+    def runHost(self, host, cmd, sudo=False):
+        """
+        Description:
+            Connect to a single host, run a command and close the connection.
+
+        Parameters:
+            host - hostname or ip address of remote host
+            cmd  - command to execute
+            sudo - run the command with sudo
+
+        Returns:
+            SshResult
+        """
+        result = SshResult(host, cmd)
+        start = time.time()
+        try:
+            ssh = SshController(host, self.user, self.password, self.port, self.timeout, self.pool,
+                                profile=self.profile, scheduler=self.scheduler)
+        except ConnectError, msg:
+            result.connect_time = time.time() - start
+            result.error = str(msg)
+            return result
+        result.connect_time = time.time() - start
+        start = time.time()
+        try:
+            result.output = ssh.run(cmd, sudo=sudo)
+        except Exception, msg:
+            result.error = str(msg)
+        result.run_time = time.time() - start
+        try:
+            ssh.close()
+        except Exception:
+            pass
+        return result
+
+    def iterRun(self, cmd, sudo=False):
+        """
+        Description:
+            Run a command on every host and yield results as each host finishes.
+
+        Parameters:
+            cmd  - command to execute, or dictionary of host (key) and command (value)
+            sudo - run the command with sudo
+
+        Returns:
+            generator of SshResult objects, in order of completion
+        """
+        if isinstance(cmd, dict):
+            hosts = [h for h in self.hosts if h in cmd]
+            get_cmd = cmd.get
+        else:
+            hosts = self.hosts
+            get_cmd = lambda h: cmd
+        for host, result, error, elapsed in runParallel(lambda h: self.runHost(h, get_cmd(h), sudo),
+                                                        hosts, self.workers):
+            if error is not None:
+                result = SshResult(host, get_cmd(host), error=str(error), run_time=elapsed)
+            logging.debug("%s finished in %.2fs", host, elapsed)
+            yield result
+
+    def run(self, cmd, sudo=False):
+        """
+        Description:
+            Run a command on every host and wait for all of them to finish.
+
+        Parameters:
+            cmd  - command to execute, or dictionary of host (key) and command (value)
+            sudo - run the command with sudo
+
+        Returns:
+            dictionary of host (key) and SshResult (value)
+        """
+        return dict((r.host, r) for r in self.iterRun(cmd, sudo))
+
+
+class TransferResult():
+    """
+    Description:
+        Outcome of transferring a single file to or from a host.
+
+    Parameters:
+        host - hostname or ip address of remote host
+        src  - source path
+        dst  - destination path
+    """
+
+    def __init__(self, host, src, dst):
+        """ Class entry point """
+        self.host = host
+        self.src = src
+        self.dst = dst
+        self.size = 0
+        self.sent = 0
+        self.elapsed = 0.0
+        self.skipped = False
+        self.resumed = False
+        self.error = None
+
+    def ok(self):
+        """ True if the transfer completed (or was skipped) without error """
+        return self.error is None
+
+    def rate(self):
+        """ Throughput in bytes per second """
+        if not self.elapsed:
+            return 0.0
+        return self.sent / self.elapsed
+
+    def __repr__(self):
+        if self.skipped:
+            state = "skipped"
+        elif self.error is not None:
+            state = "failed"
+        else:
+            state = "%.2f MB/s" % (self.rate() / 1048576.0)
+        return "<TransferResult %s:%s %s>" % (self.host, self.dst, state)
+
+
+class TransferManager():
+    """
+    Description:
+        Push or pull files to/from many hosts concurrently over SFTP.  Files
+        whose remote size and md5 checksum already match are skipped, and
+        partial files whose contents match the start of the source are
+        resumed instead of restarted.
+
+    Parameters:
+        hosts    - list of hostnames or ip addresses
+        user     - user name
+        password - password
+        port     - port number
+        timeout  - timeout (in seconds)
+        workers  - maximum number of concurrent transfers
+        per_host - maximum number of concurrent connections per host
+        checksum - compare md5 checksums (not just sizes) before skipping
+        profile  - transport profile name or dictionary (see transport_profiles)
+        scheduler - ConnectScheduler for connection retries (defaults to the shared one)
+    """
+
+    def __init__(self, hosts, user, password, port=22, timeout=300, workers=20, per_host=2, checksum=True,
+                 profile="bulk-transfer", scheduler=None):
+        """ Class entry point """
+        self.profile = profile
+        self.scheduler = scheduler
+        self.hosts = list(hosts)
+        self.user = user
+        self.password = password
+        self.port = int(port)
+        self.timeout = int(timeout)
+        self.workers = int(workers)
+        self.checksum = checksum
+        self.per_host = int(per_host)
+        self.pool = SshPool(max_per_host=per_host)
+        self.block = 32768
+        self.lock = threading.Lock()
+        self.host_slots = {}
+
+    def md5Local(self, path, length=None):
+        """ md5 of a local file (or of its first length bytes) """
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            remaining = length
+            while remaining is None or remaining > 0:
+                data = f.read(self.block if remaining is None else min(self.block, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                if remaining is not None:
+                    remaining -= len(data)
+        return digest.hexdigest()
+
+    def md5Remote(self, ssh, path, length=None):
+        """ md5 of a remote file (or of its first length bytes); None if unavailable """
+        if length is None:
+            cmd = "md5sum %s" % pipes.quote(path)
+        else:
+            cmd = "head -c %d %s | md5sum" % (length, pipes.quote(path))
+        resp = ssh.run(cmd).split()
+        if resp and re.match("^[0-9a-f]{32}$", resp[0]):
+            return resp[0]
+        return None
+
+    def remoteSize(self, sftp, path):
+        """ size of a remote file, or None if it does not exist """
+        try:
+            return sftp.stat(path).st_size
+        except IOError:
+            return None
+
+    def localSize(self, path):
+        """ size of a local file, or None if it does not exist """
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        return None
+
+    def copy(self, fsrc, fdst, result):
+        """ Copy one open file to another, counting the bytes sent """
+        data = fsrc.read(self.block)
+        while data:
+            fdst.write(data)
+            result.sent += len(data)
+            data = fsrc.read(self.block)
+
+    def transfer(self, host, src, dst, push):
+        """
+        Description:
+            Transfer a single file, skipping or resuming where possible.
+
+        Parameters:
+            host - hostname or ip address of remote host
+            src  - source path
+            dst  - destination path
+            push - True to copy local src to remote dst, False for remote src to local dst
+
+        Returns:
+            TransferResult
+        """
+        result = TransferResult(host, src, dst)
+        start = time.time()
+        ssh = None
+        try:
+            ssh = SshController(host, self.user, self.password, self.port, self.timeout, self.pool,
+                                profile=self.profile, scheduler=self.scheduler)
+            sftp = paramiko.SFTPClient.from_transport(ssh.trans)
+            try:
+                if push:
+                    result.size = self.localSize(src)
+                    have = self.remoteSize(sftp, dst)
+                    src_md5 = lambda n=None: self.md5Local(src, n)
+                    dst_md5 = lambda n=None: self.md5Remote(ssh, dst, n)
+                else:
+                    result.size = self.remoteSize(sftp, src)
+                    have = self.localSize(dst)
+                    src_md5 = lambda n=None: self.md5Remote(ssh, src, n)
+                    dst_md5 = lambda n=None: self.md5Local(dst, n)
+                if result.size is None:
+                    raise IOError("%s does not exist" % src)
+
+                if have == result.size and (not self.checksum or src_md5() == dst_md5()):
+                    result.skipped = True
+                    return result
+                offset = 0
+                if have and have < result.size and src_md5(have) == dst_md5(have):
+                    offset = have
+                    result.resumed = True
+
+                mode = "ab" if offset else "wb"
+                if push:
+                    fsrc, fdst = open(src, "rb"), sftp.open(dst, mode)
+                else:
+                    fsrc, fdst = sftp.open(src, "rb"), open(dst, mode)
+                try:
+                    fsrc.seek(offset)
+                    if push:
+                        fdst.set_pipelined(True)
+                    else:
+                        fsrc.prefetch()
+                    self.copy(fsrc, fdst, result)
+                finally:
+                    fsrc.close()
+                    fdst.close()
+            finally:
+                sftp.close()
+        except Exception, msg:
+            result.error = str(msg)
+            logging.error("transfer of %s to %s failed: %s", src, host, msg)
+        finally:
+            result.elapsed = time.time() - start
+            if ssh is not None and getattr(ssh, "trans", None) is not None:
+                ssh.close()
+        return result
+
+    def hostSlot(self, host):
+        """ Semaphore holding a host's transfers to per_host at a time """
+        self.lock.acquire()
+        try:
+            return self.host_slots.setdefault(host, threading.Semaphore(self.per_host))
+        finally:
+            self.lock.release()
+
+    def transferInTurn(self, task, push):
+        """ transfer() once the host has a free slot, so queued files wait instead of failing """
+        slot = self.hostSlot(task[0])
+        slot.acquire()
+        try:
+            return self.transfer(task[0], task[1], task[2], push)
+        finally:
+            slot.release()
+
+    def iterTransfer(self, files, push):
+        """ Run transfers on a thread pool and yield results as they finish """
+        tasks = []
+        for host in self.hosts:
+            host_files = files.get(host, []) if isinstance(files, dict) else files
+            for index, (src, dst) in enumerate(host_files):
+                if not push:
+                    # not "%" formatting: local paths may contain a literal "%"
+                    dst = dst.replace("%(host)s", host)
+                tasks.append((index, host, src, dst))
+        # interleave hosts, so workers are not all waiting on one host's slots
+        tasks = [task[1:] for task in sorted(tasks, key=lambda t: t[0])]
+        for task, result, error, elapsed in runParallel(lambda t: self.transferInTurn(t, push), tasks,
+                                                        self.workers):
+            if error is not None:
+                result = TransferResult(*task)
+                result.error = str(error)
+            yield result
+
+    def iterPush(self, files):
+        """
+        Description:
+            Copy local files to every host, yielding results as each finishes.
+
+        Parameters:
+            files - list of (local path, remote path) tuples, or dictionary of
+                    host (key) and list of tuples (value)
+
+        Returns:
+            generator of TransferResult objects
+        """
+        return self.iterTransfer(files, True)
+
+    def iterPull(self, files):
+        """
+        Description:
+            Copy remote files from every host, yielding results as each finishes.
+
+        Parameters:
+            files - list of (remote path, local path) tuples, or dictionary of
+                    host (key) and list of tuples (value); "%(host)s" in the
+                    local path is replaced with the host name
+
+        Returns:
+            generator of TransferResult objects
+        """
+        return self.iterTransfer(files, False)
+
+    def push(self, files):
+        """ Copy local files to every host; returns a list of TransferResult objects """
+        return list(self.iterPush(files))
+
+    def pull(self, files):
+        """ Copy remote files from every host; returns a list of TransferResult objects """
+        return list(self.iterPull(files))
+
+    def close(self):
+        """ Close the pooled connections """
+        self.pool.closeAll()
+
+
+class NetconfController():
+    """
+    Description:
+        Connect to remote host via netconf and issue commands.
+
+    Parameters:
+        host     - hostname or ip address of remote host
+        port     - port number
+        timeout  - timeout (in seconds) 
+        user     - user name
+        password - password   
+        profile  - transport profile name or dictionary (see transport_profiles)
+        cache    - ResultCache for run() results (True for the shared cache)
+        scheduler - ConnectScheduler for connection retries (defaults to the shared one)
+    """
+    
+    def __init__(self, host, user, password, port=830, timeout=300, profile="default", cache=None,
+                 scheduler=None):
+        """ Class entry point """
+        self.type = "netconf"
+        self.cache = result_cache if cache is True else cache
+        self.scheduler = scheduler or connect_scheduler
+        self.host = host
+        self.port = int(port)
+        self.timeout = int(timeout)
+        self.user = user
+        self.password = password
+        self.profile = profile
+        self.hld = None
+        self.framing = "1.0"
+        self.rbuf = bytearray()
+        self.server_hello = ""
+        self.message_id = 0
+        self.replies = {}
+        self.timer = metricsUtils.null_timer
+        self.partial = False
+        self.broken = None
+        self.connect()
+        self.flush()
+        self.hello()
+        
+    def connect(self):
+        """ Creates a NETCONF connection; raises ConnectError on failure """
+        start = time.time()
+        try:
+            self.hdl, self.ch = self.scheduler.connect(self.host, self.open, self.port)
+        except ConnectError, msg:
+            metricsUtils.connected(self.type, self.host, time.time() - start, ok=False)
+            logging.error("Failed to connect to %s" % msg)
+            raise
+        self.trans = self.hdl.get_transport()
+        metricsUtils.connected(self.type, self.host, time.time() - start)
+
+    def open(self, timeout):
+        """ One connection attempt (see ConnectScheduler); returns (SSHClient, channel) """
+        hdl = sshConnect(self.host, self.port, self.user, self.password, self.profile, timeout)
+        try:
+            ch = hdl.get_transport().open_session()
+            ch.settimeout(self.timeout)
+            ch.invoke_subsystem('netconf')
+        except Exception:
+            hdl.close()
+            raise
+        return hdl, ch
+
+    def flush(self):
+        """ read the server hello """
+        self.server_hello = self.read()
+        return
+
+    def recvMore(self):
+        """ Receive more data from the channel into the read buffer """
+        if self.broken:
+            raise IOError(self.broken)
+        try:
+            resp = self.ch.recv(32768)
+        except socket.timeout:
+            if self.partial:
+                self.abandon("netconf session to %s closed after a timeout in the middle of a message" % self.host)
+            raise
+        if not resp:
+            raise IOError("netconf channel to %s closed" % self.host)
+        self.timer.received(len(resp))
+        self.rbuf.extend(resp)
+
+    def iterMessage(self):
+        """
+        Description:
+            Yields the contents of the next message as it arrives, using
+            end-of-message framing (base:1.0) or chunked framing (base:1.1).
+
+        Returns:
+            generator of strings (message contents without framing)
+        """
+        if self.framing == "1.0":
+            while True:
+                end = self.rbuf.find("]]>]]>")
+                if end != -1:
+                    if end:
+                        yield str(self.rbuf[:end])
+                    del self.rbuf[:end + 6]
+                    self.partial = False
+                    return
+                keep = len(self.rbuf) - 5
+                if keep > 0:
+                    yield str(self.rbuf[:keep])
+                    del self.rbuf[:keep]
+                    self.partial = True
+                self.recvMore()
+
+        while True:
+            while len(self.rbuf) < 4:
+                self.recvMore()
+            if self.rbuf[:4] == "\n##\n":
+                del self.rbuf[:4]
+                self.partial = False
+                return
+            if self.rbuf[:2] != "\n#":
+                raise IOError("invalid netconf chunk header from %s" % self.host)
+            end = self.rbuf.find("\n", 2)
+            while end == -1:
+                self.recvMore()
+                end = self.rbuf.find("\n", 2)
+            size = int(str(self.rbuf[2:end]))
+            del self.rbuf[:end + 1]
+            self.partial = True
+            while size:
+                if not self.rbuf:
+                    self.recvMore()
+                piece = str(self.rbuf[:size])
+                del self.rbuf[:len(piece)]
+                size -= len(piece)
+                yield piece
+
+    def readMessage(self):
+        """
+        Reads one complete message from the channel (without framing).  The
+        buffer is only consumed once the whole message is in, so a timeout
+        leaves the session in step and the message is read by the next call.
+        """
+        msg = self.nextMessage()
+        while msg is None:
+            start = max(0, len(self.rbuf) - 5)
+            self.recvMore()
+            msg = self.nextMessage(start)
+        return msg
+
+    def nextMessage(self, start=0):
+        """
+        Remove and return one complete buffered message, or None (the buffer
+        is left alone); start is where to look for the base:1.0 delimiter
+        """
+        if self.framing == "1.0":
+            end = self.rbuf.find("]]>]]>", start)
+            if end == -1:
+                return None
+            msg = str(self.rbuf[:end])
+            del self.rbuf[:end + 6]
+            return msg
+
+        spans = []
+        pos = 0
+        while True:
+            if len(self.rbuf) < pos + 4:
+                return None
+            if self.rbuf[pos:pos + 4] == "\n##\n":
+                msg = "".join([str(self.rbuf[a:b]) for a, b in spans])
+                del self.rbuf[:pos + 4]
+                return msg
+            if self.rbuf[pos:pos + 2] != "\n#":
+                raise IOError("invalid netconf chunk header from %s" % self.host)
+            end = self.rbuf.find("\n", pos + 2)
+            if end == -1:
+                return None
+            size = int(str(self.rbuf[pos + 2:end]))
+            if len(self.rbuf) < end + 1 + size:
+                return None
+            spans.append((end + 1, end + 1 + size))
+            pos = end + 1 + size
+
+    def abandon(self, reason):
+        """ Close a session whose framing can no longer be trusted; later calls raise IOError(reason) """
+        logging.error(reason)
+        self.broken = reason
+        try:
+            self.ch.close()
+        except Exception:
+            pass
+
+    def read(self):
+        """ Retrieves the next message from the channel. """
+        try:
+            return self.timed("read", None, self.readMessage)
+        except socket.timeout:
+            logging.error("netconf timeout '%s' exceeded" % self.timeout)
+            return ""
+    
+    def frameMessage(self, cmd):
+        """ Returns a message framed for the session's framing (base:1.0 or base:1.1) """
+        if self.framing == "1.0":
+            if not cmd.endswith("]]>]]>"):
+                cmd += "]]>]]>"        
+        else:
+            if cmd.endswith("]]>]]>"):
+                cmd = cmd[:-6]
+            cmd = "\n#%d\n%s\n##\n" % (len(cmd), cmd)
+        return cmd
+
+    def write(self, cmd):
+        """ Writes a message to the channel """
+        if self.broken:
+            raise IOError(self.broken)
+        def send(data):
+            self.ch.sendall(data)
+            self.timer.sent(len(data))
+        self.timed("write", cmd, send, self.frameMessage(cmd))
+
+    def timed(self, op, cmd, func, *args):
+        """
+        Description:
+            Call func(*args), recording the bytes it moves and its latency in
+            a metricsUtils.CommandTimer.  Calls made while another operation
+            is being timed are recorded as part of that operation.
+
+        Parameters:
+            op   - operation name, such as "rpc"
+            cmd  - command used to label the metrics
+            func - callable doing the work
+
+        Returns:
+            result of func
+        """
+        if self.timer is not metricsUtils.null_timer:
+            return func(*args)
+        timer = self.timer = metricsUtils.timer(self.type, self.host, op, cmd)
+        try:
+            return func(*args)
+        except socket.timeout:
+            timer.timeout()
+            raise
+        finally:
+            self.timer = metricsUtils.null_timer
+            timer.done()
+
+    def run(self, cmd):
+        """ Send a message and return the next message (from the cache if set) """
+        if self.cache:
+            scope = (self.type, self.host, self.port, self.user)
+            return self.cache.call(scope, cmd, lambda: self.runCommand(cmd))
+        return self.runCommand(cmd)
+
+    def runCommand(self, cmd):
+        """ Send a message and return the next message, bypassing the cache """
+        def call():
+            self.write(cmd)
+            resp = self.read()
+            if not resp:
+                self.timer.timeout()
+            return resp
+        return self.timed("run", cmd, call)
+
+    def sendRpc(self, op):
+        """
+        Description:
+            Wrap an operation in an <rpc> element and send it without waiting
+            for the reply.
+
+        Parameters:
+            op - xml of the operation, such as <get-config>...</get-config>
+
+        Returns:
+            message-id of the request
+        """
+        self.message_id += 1
+        self.write('<rpc message-id="%d" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">%s</rpc>' % (self.message_id, op))
+        return str(self.message_id)
+
+    def getReply(self, message_id):
+        """
+        Description:
+            Returns the reply to a request, reading (and keeping) replies to
+            other requests that arrive first.
+
+        Parameters:
+            message_id - message-id returned by sendRpc()
+
+        Returns:
+            string of <rpc-reply> message
+        """
+        message_id = str(message_id)
+        while message_id not in self.replies:
+            msg = self.timed("read", None, self.readMessage)
+            reply_id = self.replyId(msg)
+            if reply_id is not None:
+                self.replies[reply_id] = msg
+            else:
+                logging.debug("ignoring netconf message without message-id")
+        return self.replies.pop(message_id)
+
+    def replyId(self, msg):
+        """ Returns the message-id of an <rpc-reply> message, or None """
+        mo = re.search(r'<(?:\w+:)?rpc-reply[^>]*\smessage-id=["\']([^"\']*)["\']', msg)
+        if mo:
+            return mo.group(1)
+        return None
+
+    def rpc(self, op):
+        """ Send an operation and return its reply """
+        return self.timed("rpc", op, lambda: self.getReply(self.sendRpc(op)))
+
+    def iterRpc(self, op, match):
+        """
+        Description:
+            Send an operation and incrementally parse its reply as it arrives,
+            yielding each element that matches.  Elements are detached from
+            the tree once yielded, or once no open ancestor can still match,
+            so with a path memory stays proportional to one element.  The
+            reply must be the next message on the channel (no other requests
+            outstanding).
+
+        Parameters:
+            op    - xml of the operation, such as <get-config>...</get-config>
+            match - element name (namespace ignored) or path suffix such as
+                    "interfaces/interface"; a callable taking a complete
+                    element; or a (path, callable) tuple.  A bare callable
+                    makes every element a candidate, so nothing it rejects
+                    can be detached before the reply ends; pair it with a
+                    path to keep memory bounded.
+
+        Returns:
+            generator of xml.etree.ElementTree elements
+        """
+        if isinstance(match, tuple):
+            match, predicate = match
+        elif callable(match):
+            match, predicate = None, match
+        else:
+            predicate = None
+        suffix = match.strip("/").split("/") if match else None
+
+        timer = self.timer = metricsUtils.timer(self.type, self.host, "iterRpc", op)
+        self.sendRpc(op)
+        source = NetconfReader(self.iterMessage())
+        stack = []
+        path = []
+        candidates = []
+        # number of open elements that may still match
+        open_candidates = 0
+        try:
+            for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+                if event == "start":
+                    stack.append(elem)
+                    path.append(elem.tag.rsplit("}", 1)[-1])
+                    candidate = suffix is None or path[-len(suffix):] == suffix
+                    candidates.append(candidate)
+                    open_candidates += candidate
+                    continue
+                # the predicate needs the complete element, so only test at the end
+                stack.pop()
+                path.pop()
+                candidate = candidates.pop()
+                open_candidates -= candidate
+                if candidate and (predicate is None or predicate(elem)):
+                    if stack:
+                        stack[-1].remove(elem)
+                    yield elem
+                elif not open_candidates and stack:
+                    stack[-1].remove(elem)
+        except socket.timeout:
+            timer.timeout()
+            raise
+        finally:
+            source.drain()
+            self.timer = metricsUtils.null_timer
+            timer.done()
+
+    def rpcBatch(self, ops):
+        """
+        Description:
+            Send several operations back to back, then collect the replies.
+
+        Parameters:
+            ops - list of operation xml strings
+
+        Returns:
+            list of replies, in the same order as ops
+        """
+        def call():
+            message_ids = [self.sendRpc(op) for op in ops]
+            return [self.getReply(i) for i in message_ids]
+        return self.timed("rpcBatch", None, call)
 
     def hello(self):
         cmd = """<?xml version="1.0" encoding="UTF-8"?>
   <hello xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">
     <capabilities>
   <capability>urn:ietf:params:netconf:base:1.0</capability>
+  <capability>urn:ietf:params:netconf:base:1.1</capability>
     </capabilities>
   </hello>]]>]]>"""
         self.write(cmd)
+        if "urn:ietf:params:netconf:base:1.1" in self.server_hello:
+            self.framing = "1.1"
         return
     
     def close(self):
         """ Close the connection to the remote host """
-        self.write("""<rpc><close-session/></rpc>""")
-        self.write("""<rpc><kill-session/></rpc>""")
+        if not self.broken:
+            self.write("""<rpc><close-session/></rpc>""")
+            self.write("""<rpc><kill-session/></rpc>""")
         self.ch.close()
         self.trans.close()
         self.trans.stop_thread()
         logging.info("connection to %s closed.", self.host)
 
 
+class NetconfReader():
+    """
+    Description:
+        File-like wrapper around a generator of message pieces, for feeding
+        a NETCONF reply to an incremental parser as it arrives.
+
+    Parameters:
+        pieces - generator of strings (see NetconfController.iterMessage)
+    """
+
+    def __init__(self, pieces):
+        """ Class entry point """
+        self.pieces = pieces
+        self.buf = ""
+
+    def read(self, size=-1):
+        """ Returns up to size bytes; an empty string at the end of the message """
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.pieces)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def drain(self):
+        """ Consume the rest of the message """
+        for piece in self.pieces:
+            pass
+        self.buf = ""
+
+
 class SocketController():
     """ 
     Description:
@@ -332,103 +2688,1293 @@ class SocketController():
     
     def __init__(self, host, port, timeout=15, echo=True, buff=128):
         """ Class entry point """
+        if not hasattr(self, "type"):
+            self.type = "socket"
         self.host = host
         self.port = port
         self.timeout = timeout #float(timeout)
         self.echo = echo
         self.buffer = buff
+        self.rbuf = bytearray(max(int(buff), 4096))
+        self.rstart = 0
+        self.rend = 0
         self.hdl = None
+        self.timer = metricsUtils.null_timer
         self.connect()
 
     def connect(self):
-        """ Establish handler to remote host """
+        """ Establish handler to remote host """
+        start = time.time()
+        try:
+            self.hdl = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.hdl.settimeout(self.timeout)
+            self.hdl.connect((self.host, self.port))
+            metricsUtils.connected(self.type, self.host, time.time() - start)
+        except socket.error as e:
+            metricsUtils.connected(self.type, self.host, time.time() - start, ok=False)
+            logging.error("Failed to connect to %s", self.host)
+            self.close()
+
+    def write(self, cmd):
+        """ send a command to the host """
+        if self.hdl is None: 
+            raise IOError('disconnected')
+            self.close()
+        if not cmd.endswith("\n"):
+            cmd += "\n"
+        def send():
+            self.hdl.sendall(cmd)
+            self.timer.sent(len(cmd))
+        self.timed("write", cmd, send)
+
+    def timed(self, op, cmd, func, *args):
+        """
+        Description:
+            Call func(*args), recording the bytes it moves and its latency in
+            a metricsUtils.CommandTimer.  Calls made while another operation
+            is being timed are recorded as part of that operation.
+
+        Parameters:
+            op   - operation name, such as "run"
+            cmd  - command used to label the metrics
+            func - callable doing the work
+
+        Returns:
+            result of func
+        """
+        if self.timer is not metricsUtils.null_timer:
+            return func(*args)
+        timer = self.timer = metricsUtils.timer(self.type, self.host, op, cmd)
+        try:
+            return func(*args)
+        except socket.timeout:
+            timer.timeout()
+            raise
+        finally:
+            self.timer = metricsUtils.null_timer
+            timer.done()
+
+    def fill(self):
+        """
+        Description:
+            Receive data from the socket directly into the read buffer,
+            compacting or growing the buffer when it is full.
+
+        Returns:
+            number of bytes received (0 if the peer disconnected)
+        """
+        if self.rend == len(self.rbuf):
+            size = self.rend - self.rstart
+            if self.rstart:
+                self.rbuf[:size] = self.rbuf[self.rstart:self.rend]
+            else:
+                self.rbuf.extend(bytearray(len(self.rbuf)))
+            self.rstart = 0
+            self.rend = size
+        n = self.hdl.recv_into(memoryview(self.rbuf)[self.rend:])
+        self.rend += n
+        if n:
+            self.timer.received(n)
+        return n
+
+    def take(self, end):
+        """ Remove and return buffered data up to offset end """
+        data = str(self.rbuf[self.rstart:end])
+        self.rstart = end
+        if self.rstart == self.rend:
+            self.rstart = self.rend = 0
+        return data
+
+    def readFrame(self, finder, timeout=None):
+        """
+        Description:
+            Read until finder locates a complete frame in the buffered data.
+
+        Parameters:
+            finder  - callable taking the scan offset and returning the offset
+                      just past the end of the frame, or -1
+            timeout - timeout (in seconds); None for the controller timeout
+
+        Returns:
+            string of frame contents
+        """
+        if self.hdl is None: 
+            raise IOError('disconnected')
+        return self.timed("read", None, self.readFrameUntil, finder, timeout)
+
+    def readFrameUntil(self, finder, timeout):
+        """ readFrame() without the metrics """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout if timeout else None
+        try:
+            while True:
+                end = finder(self.rstart)
+                if end != -1:
+                    return self.take(end)
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout("timed out")
+                    self.hdl.settimeout(remaining)
+                if not self.fill():
+                    raise IOError('disconnected')
+        except socket.timeout:
+            self.timer.timeout()
+            raise
+        finally:
+            self.hdl.settimeout(self.timeout)
+
+    def delimiterFinder(self, delimiter):
+        """ Returns a readFrame() finder for frames ending in delimiter """
+        scanned = [0]
+        def finder(pos):
+            end = self.rbuf.find(delimiter, pos + scanned[0], self.rend)
+            if end == -1:
+                scanned[0] = max(0, self.rend - pos - len(delimiter) + 1)
+                return -1
+            scanned[0] = 0
+            return end + len(delimiter)
+        return finder
+
+    def matchFinder(self, pattern):
+        """ Returns a readFrame() finder for frames ending in a regular expression match """
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern)
+        def finder(pos):
+            mo = pattern.search(self.rbuf, pos, self.rend)
+            return mo.end() if mo else -1
+        return finder
+
+    def readDelimited(self, delimiter="\n", timeout=None):
+        """ Read up to and including delimiter """
+        return self.readFrame(self.delimiterFinder(delimiter), timeout)
+
+    def readExactly(self, size, timeout=None):
+        """ Read exactly size bytes """
+        return self.readFrame(lambda pos: pos + size if self.rend - pos >= size else -1, timeout)
+
+    def readPrefixed(self, fmt="!I", timeout=None):
+        """
+        Description:
+            Read a length-prefixed frame.
+
+        Parameters:
+            fmt     - struct format of the length prefix
+            timeout - timeout (in seconds)
+
+        Returns:
+            string of frame contents (without the prefix)
+        """
+        header = struct.calcsize(fmt)
+        def finder(pos):
+            if self.rend - pos < header:
+                return -1
+            size = struct.unpack_from(fmt, self.rbuf, pos)[0]
+            return pos + header + size if self.rend - pos >= header + size else -1
+        return self.readFrame(finder, timeout)[header:]
+
+    def readMatch(self, pattern, timeout=None):
+        """ Read up to the end of the first match of a regular expression """
+        return self.readFrame(self.matchFinder(pattern), timeout)
+
+    def read(self, wait=1):
+        """ Returns everything received until nothing arrives for wait seconds """
+        if self.hdl is None: 
+            raise IOError('disconnected')
+            self.close()
+        return self.timed("read", None, self.readIdle, wait)
+
+    def readIdle(self, wait):
+        """ read() without the metrics """
+        data = True
+        while data:
+            r,w,e = select.select([self.hdl], [], [self.hdl], wait)
+            if r: # socket readable               
+                data = self.fill()
+                # no data means the socket is readable but disconnected.
+            else: # no data in socket
+                data = False
+        return self.take(self.rend)
+
+    def readUntil(self, prompt='(\d+|-\d+), ".*"', timeout=25):
+        """
+        Description:
+            Retrieves data the buffer until <prompt> 
+        
+        Parameters:
+            prompt - regular expression of expected expected prompt or text
+            
+        Returns:
+            string of buffer contents 
+        """
+        try:
+            return self.readMatch(prompt, timeout)
+        except socket.timeout:
+            logging.error("timeout exceeded")
+        return self.take(self.rend)
+
+    def run(self, cmd, wait=0.25):
+        """
+        Description:
+            Run a command on the remote host and return the response.
+        
+        Parameters:
+            command  - command to execute
+            
+        Returns:
+            string of command response
+        """
+        if self.hdl is None: 
+            raise IOError('disconnected')
+            self.close()
+        if self.echo:
+            print "executing: %s" % cmd
+        def call():
+            self.write(cmd)
+            return self.read(wait)
+        return self.timed("run", cmd, call)
+    
+    def close(self):
+        """ Close the connection to the remote host """
+        if self.hdl is None: 
+            logging.debug("socket is already closed.")
+            return
+        self.hdl.close()
+        self.hdl = None
+
+
+class Future():
+    """
+    Description:
+        Result of an operation that completes on another thread.
+    """
+
+    def __init__(self):
+        """ Class entry point """
+        self.event = threading.Event()
+        # guards the done flag and the callback list together, so a
+        # callback is either run by finish() or by addCallback(), never lost
+        self.lock = threading.Lock()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+        self.deadline = None
+        self.finder = None
+
+    def done(self):
+        """ True once a result or exception has been set """
+        return self.event.is_set()
+
+    def setResult(self, value):
+        """ Complete the future with a value (ignored once done) """
+        self.finish(value, None)
+
+    def setException(self, error):
+        """ Complete the future with an exception (ignored once done) """
+        self.finish(None, error)
+
+    def finish(self, value, error):
+        """ Mark the future done and run its callbacks """
+        self.lock.acquire()
+        try:
+            if self.event.is_set():
+                return
+            self.value = value
+            self.error = error
+            callbacks, self.callbacks = self.callbacks, []
+            self.event.set()
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logging.exception("future callback failed")
+
+    def addCallback(self, callback):
+        """ Call callback(future) once the future is done """
+        self.lock.acquire()
+        try:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        callback(self)
+
+    def then(self, func):
+        """
+        Description:
+            Chain another step onto the future.
+
+        Parameters:
+            func - called with the result once the future succeeds; may
+                   return a value or another Future
+
+        Returns:
+            Future of func's result (failures are passed along)
+        """
+        chained = Future()
+        def step(future):
+            if future.error is not None:
+                chained.setException(future.error)
+                return
+            try:
+                value = func(future.value)
+            except Exception, msg:
+                chained.setException(msg)
+                return
+            if isinstance(value, Future):
+                value.addCallback(lambda f: chained.setException(f.error) if f.error is not None
+                                  else chained.setResult(f.value))
+            else:
+                chained.setResult(value)
+        self.addCallback(step)
+        return chained
+
+    def exception(self, timeout=None):
+        """ Wait for the future and return its exception (or None) """
+        if not self.event.wait(timeout):
+            raise socket.timeout("timed out")
+        return self.error
+
+    def result(self, timeout=None):
+        """ Wait for the future and return its value, raising its exception """
+        if self.exception(timeout) is not None:
+            raise self.error
+        return self.value
+
+
+class Poller():
+    """
+    Description:
+        Thin wrapper over epoll, poll or select (whichever is available)
+        that reports readable, writable and error file descriptors.
+    """
+
+    def __init__(self):
+        """ Class entry point """
+        self.fds = {}
+        if hasattr(select, "epoll"):
+            self.impl = select.epoll()
+            self.flags = (select.EPOLLIN, select.EPOLLOUT, select.EPOLLERR | select.EPOLLHUP)
+            self.scale = 1.0
+        elif hasattr(select, "poll"):
+            self.impl = select.poll()
+            self.flags = (select.POLLIN, select.POLLOUT, select.POLLERR | select.POLLHUP | select.POLLNVAL)
+            self.scale = 1000.0
+        else:
+            self.impl = None
+
+    def mask(self, readable, writable):
+        """ Build the event mask for the underlying implementation """
+        mask = 0
+        if readable:
+            mask |= self.flags[0]
+        if writable:
+            mask |= self.flags[1]
+        return mask
+
+    def register(self, fd, readable=True, writable=False):
+        """ Start watching a file descriptor """
+        self.fds[fd] = (readable, writable)
+        if self.impl is not None:
+            self.impl.register(fd, self.mask(readable, writable))
+
+    def modify(self, fd, readable=True, writable=False):
+        """ Change the events watched for a file descriptor """
+        if self.fds.get(fd) == (readable, writable):
+            return
+        self.fds[fd] = (readable, writable)
+        if self.impl is not None:
+            self.impl.modify(fd, self.mask(readable, writable))
+
+    def unregister(self, fd):
+        """ Stop watching a file descriptor """
+        if self.fds.pop(fd, None) is not None and self.impl is not None:
+            try:
+                self.impl.unregister(fd)
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+    def poll(self, timeout):
+        """
+        Description:
+            Wait for events.
+
+        Parameters:
+            timeout - maximum time to wait (in seconds)
+
+        Returns:
+            list of (fd, readable, writable, error) tuples
+        """
+        if self.impl is None:
+            r = [fd for fd, (rd, wr) in self.fds.items() if rd]
+            w = [fd for fd, (rd, wr) in self.fds.items() if wr]
+            r, w, e = select.select(r, w, self.fds.keys(), timeout)
+            return [(fd, fd in r, fd in w, fd in e) for fd in set(r + w + e)]
+        try:
+            events = self.impl.poll(timeout * self.scale)
+        except (IOError, OSError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return [(fd, bool(ev & self.flags[0]), bool(ev & self.flags[1]), bool(ev & self.flags[2]))
+                for fd, ev in events]
+
+
+class EngineConnection(SocketController):
+    """
+    Description:
+        Non-blocking SocketController driven by a SocketEngine.  Writes are
+        queued and complete frames are handed to the oldest pending request
+        (see request()) or, when none is pending, to callback(conn, frame).
+
+    Parameters:
+        engine    - SocketEngine that drives the connection
+        host      - hostname or ip address of remote host
+        port      - port number
+        timeout  - timeout (in seconds) for connecting and for each request
+        echo      - echo commands
+        buff      - initial buffer size (in bytes)
+        delimiter - frame delimiter
+        pattern   - regular expression marking the end of a frame (instead of delimiter)
+        callback  - called with (conn, frame) for frames nobody is waiting for
+    """
+
+    def __init__(self, engine, host, port, timeout=15, echo=True, buff=128,
+                 delimiter="\n", pattern=None, callback=None):
+        """ Class entry point """
+        self.engine = engine
+        self.callback = callback
+        self.wbuf = bytearray()
+        self.pending = collections.deque()
+        self.connected = False
+        self.closing = False
+        self.deadline = None
+        SocketController.__init__(self, host, port, timeout, echo, buff)
+        if pattern is not None:
+            self.finder = self.matchFinder(pattern)
+        else:
+            self.finder = self.delimiterFinder(delimiter)
+
+    def connect(self):
+        """ Start a non-blocking connection to the remote host """
+        self.connect_start = time.time()
         try:
             self.hdl = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.hdl.settimeout(self.timeout)
-            self.hdl.connect((self.host, self.port))
+            self.hdl.setblocking(0)
+            err = self.hdl.connect_ex((self.host, self.port))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(err, os.strerror(err))
         except socket.error as e:
+            metricsUtils.connected(self.type, self.host, time.time() - self.connect_start, ok=False)
             logging.error("Failed to connect to %s", self.host)
-            self.close()
+            SocketController.close(self)
+            return
+        if self.timeout:
+            self.deadline = time.time() + self.timeout
+        self.engine.register(self)
 
     def write(self, cmd):
-        """ send a command to the host """
+        """ queue a command to send to the host """
         if self.hdl is None: 
             raise IOError('disconnected')
-            self.close()
+        if not cmd.endswith("\n"):
+            cmd += "\n"
+        self.engine.lock.acquire()
         try:
-            if not cmd.endswith("\n"):
-                cmd += "\n"
-            self.hdl.send(cmd)
-        except IOError as e:
-            raise e
+            self.wbuf.extend(cmd)
+        finally:
+            self.engine.lock.release()
+        self.engine.wake(self)
 
-    def read(self, wait=1):
+    def request(self, cmd, timeout=None, finder=None):
+        """
+        Description:
+            Send a command and return a Future for the next frame received.
+
+        Parameters:
+            cmd     - command to execute (None to only wait for a frame)
+            timeout - timeout (in seconds); None for the connection timeout
+            finder  - readFrame() finder for this response; defaults to the
+                      connection's delimiter or pattern
+
+        Returns:
+            Future
+        """
         if self.hdl is None: 
             raise IOError('disconnected')
-            self.close()
-        
-        buf = ""#bytearray()
-        data = True
-        while data:
-            r,w,e = select.select([self.hdl], [], [self.hdl], wait)
-            if r: # socket readable               
-                data = self.hdl.recv(self.buffer)
-                if data: 
-                    buf += data
-                else: # Socket readable but there is no data, disconnected.
-                    data = False
-#                     self.close()
-            else: # no data in socket
-                data = False
-        return buf
+        if timeout is None:
+            timeout = self.timeout
+        future = Future()
+        future.finder = finder
+        if timeout:
+            future.deadline = time.time() + timeout
+        if self.echo and cmd is not None:
+            logging.debug("executing: %s", cmd)
+        timer = metricsUtils.timer(self.type, self.host, "request", cmd)
+        if cmd is not None:
+            timer.sent(len(cmd))
+        future.addCallback(timer.doneFuture)
+        self.engine.lock.acquire()
+        try:
+            self.pending.append(future)
+        finally:
+            self.engine.lock.release()
+        if cmd is not None:
+            self.write(cmd)
+        else:
+            self.engine.wake(self)
+        return future
 
-    def readUntil(self, prompt='(\d+|-\d+), ".*"', timeout=25):
+    def run(self, cmd, wait=None):
         """
         Description:
-            Retrieves data the buffer until <prompt> 
-        
+            Run a command and wait for its response frame.  Must not be
+            called from the engine thread (use request() there).
+
         Parameters:
-            prompt - regular expression of expected expected prompt or text
-            
+            command  - command to execute
+            wait     - timeout (in seconds); None for the connection timeout
+
         Returns:
-            string of buffer contents 
+            string of command response
         """
-        self.hdl.settimeout(timeout)
-        resp = ""
+        return self.request(cmd, wait).result()
+
+    def fileno(self):
+        """ File descriptor watched by the engine """
+        return self.hdl.fileno()
+
+    def wantWrite(self):
+        """ True while there is queued data or the connect is in progress """
+        return bool(self.wbuf) or not self.connected
+
+    def handleEvents(self, readable, writable, error):
+        """ Handle socket events reported by the engine """
+        if not self.connected and (writable or error):
+            self.onConnect()
+        if self.connected and (readable or error):
+            self.onReadable()
+        if self.connected and writable and self.hdl is not None:
+            self.onWritable()
+        if self.connected:
+            self.dispatchFrames()
+
+    def onConnect(self):
+        """ Finish a non-blocking connect once the socket is writable """
+        err = self.hdl.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        elapsed = time.time() - self.connect_start
+        if err:
+            metricsUtils.connected(self.type, self.host, elapsed, ok=False)
+            logging.error("Failed to connect to %s", self.host)
+            self.fail(socket.error(err, os.strerror(err)))
+            return
+        metricsUtils.connected(self.type, self.host, elapsed)
+        self.connected = True
+        self.deadline = None
+
+    def onReadable(self):
+        """ Receive everything available and dispatch complete frames """
         try:
-            while not resp:
-                resp = self.hdl.recv(128)
-                mo = re.search(prompt, resp)
-                if mo:
-                    break
-        except socket.timeout:
+            while True:
+                if not self.fill():
+                    self.fail(IOError('disconnected'))
+                    return
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.fail(e)
+
+    def dispatchFrames(self):
+        """
+        Description:
+            Hand complete frames to the oldest pending request or, when none
+            is pending, to the callback.  Without either, data stays buffered
+            until a request arrives.
+        """
+        while self.hdl is not None:
+            self.engine.lock.acquire()
+            try:
+                future = self.pending[0] if self.pending else None
+            finally:
+                self.engine.lock.release()
+            if future is None and self.callback is None:
+                return
+            end = (future and future.finder or self.finder)(self.rstart)
+            if end == -1:
+                return
+            frame = self.take(end)
+            if future is None:
+                self.callback(self, frame)
+                continue
+            self.engine.lock.acquire()
+            try:
+                self.pending.popleft()
+            finally:
+                self.engine.lock.release()
+            future.setResult(frame)
+
+    def onWritable(self):
+        """ Send as much queued data as the socket accepts """
+        self.engine.lock.acquire()
+        try:
+            sent = self.hdl.send(self.wbuf)
+            del self.wbuf[:sent]
+            error = None
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            error = e
+        finally:
+            self.engine.lock.release()
+        if error is not None:
+            self.fail(error)
+        elif self.closing and not self.wbuf:
+            EngineConnection.close(self)
+
+    def checkTimeouts(self, now):
+        """ Fail the connection or expired requests once past their deadline """
+        if self.deadline and now > self.deadline:
+            logging.error("Failed to connect to %s", self.host)
+            self.fail(socket.timeout("connect timed out"))
+            return
+        while self.pending and self.pending[0].deadline and now > self.pending[0].deadline:
             logging.error("timeout exceeded")
+            # the late response would be matched to the wrong request, so give up on the connection
+            self.fail(socket.timeout("timed out"))
+
+    def fail(self, error):
+        """ Close the connection and fail every pending request """
+        EngineConnection.close(self)
+        self.engine.lock.acquire()
+        try:
+            pending, self.pending = list(self.pending), collections.deque()
+        finally:
+            self.engine.lock.release()
+        for future in pending:
+            future.setException(error)
+
+    def close(self):
+        """ Close the connection to the remote host """
+        if self.hdl is not None:
+            self.engine.unregister(self)
+        SocketController.close(self)
+
+
+class SocketEngine():
+    """
+    Description:
+        Drive many non-blocking EngineConnections from a single thread.
+
+    Parameters:
+        interval - maximum time (in seconds) between timeout checks
+    """
+
+    def __init__(self, interval=0.5):
+        """ Class entry point """
+        self.interval = interval
+        self.poller = Poller()
+        self.conns = {}
+        self.dirty = set()
+        self.lock = threading.RLock()
+        self.running = False
+        self.thread = None
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wake_r)
+
+    def connect(self, host, port, timeout=15, echo=True, buff=128,
+                delimiter="\n", pattern=None, callback=None):
+        """ Create a connection driven by this engine (see EngineConnection) """
+        return EngineConnection(self, host, port, timeout, echo, buff, delimiter, pattern, callback)
+
+    def register(self, conn):
+        """
+        Description:
+            Start driving a connection.  Any object providing fileno(),
+            wantWrite(), handleEvents(readable, writable, error) and
+            checkTimeouts(now) can be registered.
+        """
+        self.lock.acquire()
+        try:
+            conn.engine_fd = conn.fileno()
+            self.conns[conn.engine_fd] = conn
+            self.poller.register(conn.engine_fd, True, conn.wantWrite())
+        finally:
+            self.lock.release()
+        self.wake()
+
+    def unregister(self, conn):
+        """ Stop driving a connection """
+        self.lock.acquire()
+        try:
+            fd = getattr(conn, "engine_fd", None)
+            if fd is not None and self.conns.get(fd) is conn:
+                del self.conns[fd]
+                self.poller.unregister(fd)
+            conn.engine_fd = None
+            self.dirty.discard(conn)
+        finally:
+            self.lock.release()
+
+    def wake(self, conn=None):
+        """ Interrupt poll() so queued writes are picked up """
+        if conn is not None:
+            self.lock.acquire()
+            try:
+                self.dirty.add(conn)
+            finally:
+                self.lock.release()
+        try:
+            os.write(self.wake_w, "x")
+        except OSError:
             pass
-        return resp
 
-    def run(self, cmd, wait=0.25):
+    def runOnce(self, timeout=None):
         """
         Description:
-            Run a command on the remote host and return the response.
+            Wait for and handle one round of socket events.
+
+        Parameters:
+            timeout - maximum time to wait (in seconds); defaults to interval
+        """
+        if timeout is None:
+            timeout = self.interval
+        self.lock.acquire()
+        try:
+            dirty, self.dirty = self.dirty, set()
+        finally:
+            self.lock.release()
+        for conn in dirty:
+            if getattr(conn, "engine_fd", None) is not None:
+                conn.handleEvents(False, False, False)
+            if getattr(conn, "engine_fd", None) is not None:
+                self.poller.modify(conn.engine_fd, True, conn.wantWrite())
+
+        for fd, readable, writable, error in self.poller.poll(timeout):
+            if fd == self.wake_r:
+                try:
+                    while os.read(self.wake_r, 4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+            conn = self.conns.get(fd)
+            if conn is None:
+                continue
+            conn.handleEvents(readable, writable, error)
+            if self.conns.get(fd) is conn:
+                self.poller.modify(fd, True, conn.wantWrite())
+
+        now = time.time()
+        for conn in self.conns.values():
+            conn.checkTimeouts(now)
+
+    def run(self):
+        """ Handle socket events until stop() is called """
+        self.running = True
+        while self.running:
+            self.runOnce()
+
+    def start(self):
+        """ Run the engine on a background thread """
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        """ Stop the engine and close every connection """
+        self.running = False
+        self.wake()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        for conn in self.conns.values():
+            conn.close()
+
+
+socket_engine = None
+engine_lock = threading.Lock()
+
+
+def getEngine():
+    """ Returns the shared SocketEngine, starting it on first use """
+    global socket_engine
+    engine_lock.acquire()
+    try:
+        if socket_engine is None:
+            socket_engine = SocketEngine()
+            socket_engine.start()
+        return socket_engine
+    finally:
+        engine_lock.release()
+
+
+class AsyncSocketController(EngineConnection):
+    """
+    Description:
+        Event-driven counterpart of SocketController.  Methods return Futures
+        instead of blocking, so one engine thread can drive many sessions.
+
+    Parameters:
+        host      - hostname or ip address of remote host
+        port      - port number
+        timeout   - timeout (in seconds)
+        echo      - echo commands
+        buff      - initial buffer size (in bytes)
+        engine    - SocketEngine to use (defaults to the shared engine)
+        delimiter - frame delimiter
+        pattern   - regular expression marking the end of a frame (instead of delimiter)
+        callback  - called with (conn, frame) for frames nobody is waiting for
+    """
+
+    def __init__(self, host, port, timeout=15, echo=True, buff=128, engine=None,
+                 delimiter="\n", pattern=None, callback=None):
+        """ Class entry point """
+        EngineConnection.__init__(self, engine or getEngine(), host, port, timeout, echo, buff,
+                                  delimiter, pattern, callback)
+
+    def read(self, wait=None):
+        """ Returns a Future for the next frame """
+        return self.request(None, wait)
+
+    def readUntil(self, prompt='(\d+|-\d+), ".*"', timeout=25):
+        """ Returns a Future for the data up to the end of a regular expression match """
+        return self.request(None, timeout, self.matchFinder(prompt))
+
+    def run(self, cmd, wait=None):
+        """ Send a command and return a Future for its response frame """
+        return self.request(cmd, wait)
+
+
+class AsyncTelnetController(EngineConnection):
+    """
+    Description:
+        Event-driven counterpart of TelnetController.  Login and commands are
+        chained on Futures; telnet option negotiation is refused, as
+        telnetlib does.
+
+    Parameters:
+        host     - hostname or ip address of remote host
+        port     - port number
+        timeout  - timeout (in seconds) 
+        user     - user name
+        password - password
+        prompt   - command prompt
+        engine   - SocketEngine to use (defaults to the shared engine)
+    """
+
+    def __init__(self, host, user, password=None, port=23, timeout=300, prompt=":~$", engine=None):
+        """ Class entry point """
+        self.type = "telnet"
+        self.user = user
+        self.password = password
+        self.prompt = prompt
+        self.iac = ""
+        EngineConnection.__init__(self, engine or getEngine(), host, port, timeout, echo=False,
+                                  buff=4096, delimiter=prompt)
+        self.ready = self.login()
+
+    def login(self):
+        """ Log in; returns a Future that completes once the session is usable """
+        if self.hdl is None:
+            failed = Future()
+            failed.setException(IOError('disconnected'))
+            return failed
+        ready = self.expect("login: ").then(
+            lambda resp: self.send(self.user, "Password: " if self.password else None))
+        if self.password:
+            ready = ready.then(lambda resp: self.send(self.password, self.prompt))
+        return ready
+
+    def send(self, data, until=None):
+        """ Write data and return a Future for the text up to until (or None) """
+        if until is None:
+            self.write(data)
+            return None
+        return self.request(data, finder=self.delimiterFinder(until))
+
+    def expect(self, text, timeout=None):
+        """ Returns a Future for the data up to and including text """
+        return self.request(None, timeout, self.delimiterFinder(text))
+
+    def fill(self):
+        """ Receive data and strip telnet commands, refusing every option """
+        n = SocketController.fill(self)
+        if not n:
+            return n
+        data = self.iac + str(self.rbuf[self.rend - n:self.rend])
+        out = []
+        replies = []
+        i = 0
+        while True:
+            j = data.find(telnetlib.IAC, i)
+            if j == -1:
+                out.append(data[i:])
+                i = len(data)
+                break
+            out.append(data[i:j])
+            i = j
+            if j + 1 >= len(data):
+                break
+            cmd = data[j + 1]
+            if cmd == telnetlib.IAC:
+                out.append(telnetlib.IAC)
+                i = j + 2
+            elif cmd in (telnetlib.DO, telnetlib.DONT, telnetlib.WILL, telnetlib.WONT):
+                if j + 2 >= len(data):
+                    break
+                if cmd == telnetlib.DO:
+                    replies.append(telnetlib.IAC + telnetlib.WONT + data[j + 2])
+                elif cmd == telnetlib.WILL:
+                    replies.append(telnetlib.IAC + telnetlib.DONT + data[j + 2])
+                i = j + 3
+            elif cmd == telnetlib.SB:
+                end = data.find(telnetlib.IAC + telnetlib.SE, j + 2)
+                if end == -1:
+                    break
+                i = end + 2
+            else:
+                i = j + 2
+        self.iac = data[i:]
+        clean = "".join(out)
+        self.rbuf[self.rend - n:self.rend] = clean
+        self.rend = self.rend - n + len(clean)
+        if replies:
+            self.engine.lock.acquire()
+            try:
+                self.wbuf.extend("".join(replies))
+            finally:
+                self.engine.lock.release()
+        return n
+
+    def run(self, cmd, prompt=None):
+        """
+        Description:
+            Run a command on the remote host.
         
         Parameters:
             command  - command to execute
+            prompt   - expected prompt after execution
             
         Returns:
-            string of command response
-        """
-        if self.hdl is None: 
-            raise IOError('disconnected')
-            self.close()
-        if self.echo:
-            print "executing: %s" % cmd
+            Future of command response
+        """ 
+        finder = self.delimiterFinder(prompt or self.prompt)
+        return self.ready.then(lambda resp: self.request(cmd, finder=finder))
+
+    def read(self, prompt=None):
+        """ Returns a Future for the data up to the next prompt """
+        return self.expect(prompt or self.prompt)
+
+    def close(self):
+        """ Close the connection once 'exit' has been sent """
+        if self.hdl is None:
+            return
+        self.write("exit\n")
+        self.closing = True
+        self.engine.wake(self)
+
+
+class ChannelReader():
+    """
+    Description:
+        Collects the output of a paramiko channel on a SocketEngine until EOF,
+        then resolves a Future with it.
+
+    Parameters:
+        engine  - SocketEngine that drives the channel
+        chan    - paramiko channel (command already started)
+        timeout - timeout (in seconds)
+        timer   - metricsUtils.CommandTimer to record the command in
+    """
+
+    def __init__(self, engine, chan, timeout, timer=metricsUtils.null_timer):
+        """ Class entry point """
+        self.timer = timer
+        self.engine = engine
+        self.chan = chan
+        self.timeout = timeout
+        self.buf = bytearray()
+        self.future = Future()
+        self.deadline = time.time() + timeout if timeout else None
+        self.chan.setblocking(0)
+        self.engine.register(self)
+
+    def fileno(self):
+        """ File descriptor watched by the engine """
+        return self.chan.fileno()
+
+    def wantWrite(self):
+        """ Channel readers never write """
+        return False
+
+    def handleEvents(self, readable, writable, error):
+        """ Read everything available; finish at EOF """
+        try:
+            while True:
+                data = self.chan.recv(32768)
+                if not data:
+                    self.finish()
+                    return
+                self.timer.received(len(data))
+                self.buf.extend(data)
+        except socket.timeout:
+            pass
+
+    def checkTimeouts(self, now):
+        """ Finish with the partial output once the deadline has passed """
+        if self.deadline and now > self.deadline:
+            logging.error("command timeout '%s' exceeded" % self.timeout)
+            self.timer.timeout()
+            self.finish()
+
+    def finish(self):
+        """ Stop watching the channel, close it and resolve the Future """
+        self.engine.unregister(self)
+        self.chan.close()
+        self.timer.done()
+        self.future.setResult(str(self.buf))
+
+
+class AsyncSshController(SshController):
+    """
+    Description:
+        SshController whose run() and read() return Futures.  Command output
+        is collected by the engine thread instead of the caller; the SSH
+        handshake and channel setup still go through paramiko, which runs
+        one transport thread per connection.
+
+    Parameters:
+        host     - hostname or ip address of remote host
+        port     - port number
+        timeout  - timeout (in seconds) 
+        user     - user name
+        password - password
+        pool     - SshPool to borrow the connection from (True for the shared pool)
+        engine   - SocketEngine to use (defaults to the shared engine)
+        profile  - transport profile name or dictionary (see transport_profiles)
+    """
+
+    def __init__(self, host, user, password, port=22, timeout=300, pool=None, engine=None, profile="default"):
+        """ Class entry point """
+        self.engine = engine or getEngine()
+        SshController.__init__(self, host, user, password, port, timeout, pool, profile=profile)
+
+    def flush(self, chan):
+        """ Returns a Future for everything read from the channel until EOF """
+        return self.read(chan)
+
+    def read(self, chan, timeout=None, timer=None):
+        """ Returns a Future for everything read from the channel until EOF """
+        if timer is None:
+            timer = metricsUtils.timer(self.type, self.host, "read")
+        return ChannelReader(self.engine, chan, timeout or self.timeout, timer).future
+
+    def run(self, cmd, timeout=None, sudo=False):
+        """ Send a command and return a Future for the response """
+        timer = metricsUtils.timer(self.type, self.host, "run", cmd)
+        chan = self.trans.open_session()
+        if sudo:
+            cmd = "echo %s | sudo -S %s" % (self.password, cmd)
+        self.write(cmd, chan, timer)
+        return self.read(chan, timeout, timer)
+
+
+class AsyncNetconfController(NetconfController):
+    """
+    Description:
+        NetconfController whose run(), read() and rpc() return Futures.
+        Replies are read and matched to requests by the engine thread, and
+        writes are queued and sent by it.  The hello exchange is done
+        synchronously before the engine takes over the channel.
+
+    Parameters:
+        host     - hostname or ip address of remote host
+        port     - port number
+        timeout  - timeout (in seconds) 
+        user     - user name
+        password - password   
+        engine   - SocketEngine to use (defaults to the shared engine)
+        profile  - transport profile name or dictionary (see transport_profiles)
+    """
+
+    def __init__(self, host, user, password, port=830, timeout=300, engine=None, profile="default"):
+        """ Class entry point """
+        self.wbuf = bytearray()
+        NetconfController.__init__(self, host, user, password, port, timeout, profile)
+        self.engine = engine or getEngine()
+        self.futures = {}
+        self.waiting = collections.deque()
+        self.ch.setblocking(0)
+        self.engine.register(self)
+
+    def flush(self):
+        """ Read the server hello (synchronously, the engine is not driving the channel yet) """
+        self.server_hello = NetconfController.read(self)
+
+    def fileno(self):
+        """ File descriptor watched by the engine """
+        return self.ch.fileno()
+
+    def wantWrite(self):
+        """ Channels only signal readability; queued writes are flushed on every engine pass """
+        return False
+
+    def write(self, cmd):
+        """ Queue a message for the engine to send (sent directly before registration) """
+        if getattr(self, "engine_fd", None) is None:
+            NetconfController.write(self, cmd)
+            return
+        cmd = self.frameMessage(cmd)
+        self.engine.lock.acquire()
+        try:
+            self.wbuf.extend(cmd)
+        finally:
+            self.engine.lock.release()
+        self.engine.wake(self)
+
+    def flushWrites(self):
+        """ Send as much queued data as the channel's window accepts """
+        self.engine.lock.acquire()
+        try:
+            while self.wbuf:
+                sent = self.ch.send(str(self.wbuf[:32768]))
+                if not sent:
+                    raise IOError("netconf channel to %s closed" % self.host)
+                del self.wbuf[:sent]
+        except socket.timeout:
+            # window full; retried on the next event or timeout check
+            pass
+        finally:
+            self.engine.lock.release()
+
+    def handleEvents(self, readable, writable, error):
+        """ Send queued writes, read everything available and dispatch complete messages """
+        try:
+            self.flushWrites()
+            while True:
+                resp = self.ch.recv(32768)
+                if not resp:
+                    self.fail(IOError("netconf channel to %s closed" % self.host))
+                    return
+                self.rbuf.extend(resp)
+        except socket.timeout:
+            pass
+        except (IOError, socket.error), msg:
+            self.fail(msg)
+            return
+        try:
+            msg = self.nextMessage()
+            while msg is not None:
+                self.dispatch(msg)
+                msg = self.nextMessage()
+        except IOError, msg:
+            self.fail(msg)
+
+    def dispatch(self, msg):
+        """ Resolve the Future waiting for a message """
+        self.engine.lock.acquire()
+        try:
+            future = self.futures.pop(self.replyId(msg), None)
+            if future is None and self.waiting:
+                future = self.waiting.popleft()
+        finally:
+            self.engine.lock.release()
+        if future is not None:
+            future.setResult(msg)
+        else:
+            logging.debug("unsolicited netconf message from %s dropped", self.host)
+
+    def newFuture(self, message_id=None, op="read", cmd=None):
+        """ Create a Future for the next message (or the reply to message_id) """
+        future = Future()
+        timer = metricsUtils.timer(self.type, self.host, op, cmd)
+        if cmd is not None:
+            timer.sent(len(cmd))
+        future.addCallback(timer.doneFuture)
+        if self.timeout:
+            future.deadline = time.time() + self.timeout
+        self.engine.lock.acquire()
+        try:
+            if message_id is None:
+                self.waiting.append(future)
+            else:
+                self.futures[message_id] = future
+        finally:
+            self.engine.lock.release()
+        return future
+
+    def read(self):
+        """ Returns a Future for the next message """
+        return self.newFuture()
+
+    def run(self, cmd):
+        """ Send a message and return a Future for the next message received """
+        future = self.newFuture(op="run", cmd=cmd)
         self.write(cmd)
-        return self.read(wait)
-    
+        return future
+
+    def rpc(self, op):
+        """ Send an operation and return a Future for its reply """
+        self.engine.lock.acquire()
+        try:
+            future = self.newFuture(str(self.message_id + 1), "rpc", op)
+            self.sendRpc(op)
+        finally:
+            self.engine.lock.release()
+        return future
+
+    def rpcBatch(self, ops):
+        """ Send several operations back to back; returns a list of Futures """
+        return [self.rpc(op) for op in ops]
+
+    def checkTimeouts(self, now):
+        """ Retry queued writes and fail Futures that are past their deadline """
+        if self.wbuf:
+            try:
+                self.flushWrites()
+            except (IOError, socket.error), msg:
+                self.fail(msg)
+                return
+        self.engine.lock.acquire()
+        try:
+            expired = [(k, f) for k, f in self.futures.items() if f.deadline and now > f.deadline]
+            for k, f in expired:
+                del self.futures[k]
+            while self.waiting and self.waiting[0].deadline and now > self.waiting[0].deadline:
+                expired.append((None, self.waiting.popleft()))
+        finally:
+            self.engine.lock.release()
+        for k, f in expired:
+            logging.error("netconf timeout '%s' exceeded" % self.timeout)
+            f.setException(socket.timeout("timed out"))
+
+    def fail(self, error):
+        """ Stop watching the channel and fail every outstanding Future """
+        self.engine.unregister(self)
+        self.engine.lock.acquire()
+        try:
+            pending = self.futures.values() + list(self.waiting)
+            self.futures = {}
+            self.waiting = collections.deque()
+        finally:
+            self.engine.lock.release()
+        for future in pending:
+            future.setException(error)
+
     def close(self):
         """ Close the connection to the remote host """
-        if self.hdl is None: 
-            logging.debug("socket is already closed.")
-            return
-        self.hdl.close()
-        self.hdl = None
+        self.engine.unregister(self)
+        self.ch.settimeout(self.timeout)
+        self.engine.lock.acquire()
+        try:
+            pending, self.wbuf = str(self.wbuf), bytearray()
+        finally:
+            self.engine.lock.release()
+        if pending:
+            self.ch.sendall(pending)
+        NetconfController.close(self)
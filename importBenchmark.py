@@ -0,0 +1,116 @@
+#! /usr/bin/python
+
+"""
+Description:
+    Measures how long importing pyUtils modules takes, each in a fresh
+    interpreter, and which heavy third-party modules the import pulls in.
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+heavy_modules = ("paramiko", "scp", "MySQLdb", "multiprocessing")
+
+probe = """
+import sys, time, json
+# the modules directly, and the directory above for the package
+sys.path[:0] = [%(here)r, %(parent)r]
+start = time.time()
+exec %(statement)r
+elapsed = time.time() - start
+print json.dumps({"seconds": elapsed, "modules": len(sys.modules),
+                  "heavy": [m for m in %(heavy)r if m in sys.modules]})
+"""
+
+
+def statements(package=None):
+    """
+    Description:
+        Default import statements to measure: every module on its own, then
+        the package and one of its helpers.
+
+    Parameters:
+        package - package name (defaults to the name of this directory)
+
+    Returns:
+        list of statements
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    package = package or os.path.basename(here)
+    modules = ["dateUtils", "reUtils", "formUtils", "emailUtils", "metricsUtils", "connectionUtils",
+               "mySqlUtils"]
+    result = ["import %s" % m for m in modules]
+    result += ["import %s" % package,
+               "import %s; %s.dateUtils" % (package, package),
+               "import %s; %s.connectionUtils.SshController" % (package, package)]
+    return result
+
+
+def measure(statement, repeat=5, python=sys.executable):
+    """
+    Description:
+        Time an import statement in fresh interpreters.
+
+    Parameters:
+        statement - python statement to time
+        repeat    - number of interpreters to start
+        python    - interpreter to use
+
+    Returns:
+        dictionary with statement, best and median milliseconds, module count
+        and the heavy modules imported (or error)
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = probe % {"here": here, "parent": os.path.dirname(here), "statement": statement, "heavy": heavy_modules}
+    times = []
+    last = None
+    for i in range(repeat):
+        proc = subprocess.Popen([python, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode:
+            return {"statement": statement, "error": (err.strip().splitlines() or ["failed"])[-1]}
+        last = json.loads(out.strip().splitlines()[-1])
+        times.append(last["seconds"] * 1000)
+    times.sort()
+    return {"statement": statement,
+            "best_ms": times[0],
+            "median_ms": times[len(times) // 2],
+            "modules": last["modules"],
+            "heavy": last["heavy"]}
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description="pyUtils import-time benchmark")
+    parser.add_argument("statements", nargs="*", help="import statements to time (defaults to every module)")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per statement")
+    parser.add_argument("--package", help="package name (defaults to this directory's name)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = [measure(s, args.repeat) for s in args.statements or statements(args.package)]
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+        return 0
+    print "%-55s %9s %9s %8s  %s" % ("statement", "best ms", "median ms", "modules", "heavy imports")
+    for r in results:
+        if "error" in r:
+            print "%-55s %s" % (r["statement"], r["error"])
+            continue
+        print "%-55s %9.1f %9.1f %8d  %s" % (r["statement"], r["best_ms"], r["median_ms"], r["modules"],
+                                             ", ".join(r["heavy"]) or "-")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#! /usr/bin/python
+
+"""
+Description:
+    Deferred imports: modules that are only imported the first time one of
+    their attributes is used.
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+import sys
+import types
+import importlib
+
+
+class LazyImport(object):
+    """
+    Description:
+        Stands in for a module until one of its attributes is used, then
+        imports it.  Use for heavy third-party modules that only some code
+        paths need:
+
+            paramiko = lazyUtils.LazyImport("paramiko")
+
+    Parameters:
+        name - module name, as passed to importlib.import_module
+    """
+
+    def __init__(self, name):
+        """ Class entry point """
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        """ Import the module (once) and return it """
+        module = self.__dict__["_module"]
+        if module is None:
+            module = self.__dict__["_module"] = importlib.import_module(self._name)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if isLoaded(self) else "not loaded"
+        return "<lazy module '%s' (%s)>" % (self._name, state)
+
+
+def isLoaded(module):
+    """ True if a LazyImport has been imported (always True for real modules) """
+    if isinstance(module, LazyImport):
+        return module.__dict__["_module"] is not None
+    return True
+
+
+class LazyPackage(types.ModuleType):
+    """
+    Description:
+        Package module whose submodules are imported on first attribute
+        access, so "import pyUtils" costs nothing until a helper is used.
+
+    Parameters:
+        name       - package name (__name__ of the package)
+        submodules - names of the submodules to expose
+    """
+
+    def __init__(self, name, submodules):
+        """ Class entry point """
+        types.ModuleType.__init__(self, name)
+        self.__dict__["_submodules"] = tuple(submodules)
+
+    def __getattr__(self, attr):
+        if attr in self._submodules:
+            module = importlib.import_module("%s.%s" % (self.__name__, attr))
+            setattr(self, attr, module)
+            return module
+        raise AttributeError("module '%s' has no attribute '%s'" % (self.__name__, attr))
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys()) | set(self._submodules))
+
+
+def lazyPackage(name, submodules):
+    """
+    Description:
+        Replace a package's module object in sys.modules with a LazyPackage.
+        Call at the end of the package's __init__.py:
+
+            lazyUtils.lazyPackage(__name__, __all__)
+
+    Parameters:
+        name       - package name (__name__ of the package)
+        submodules - names of the submodules to expose
+
+    Returns:
+        LazyPackage
+    """
+    original = sys.modules[name]
+    package = LazyPackage(name, submodules)
+    package.__dict__.update(original.__dict__)
+    # keep the original module alive: Python 2 clears a module's globals
+    # when it is freed, which would break functions defined in __init__.py
+    package.__dict__["_original"] = original
+    sys.modules[name] = package
+    return package
@@ -0,0 +1,287 @@
+#! /usr/bin/python
+
+"""
+Description:
+    In-process counters and histograms for connection timing, with JSON and
+    Prometheus text output.
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+import re
+import json
+import time
+import bisect
+import threading
+
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Histogram():
+    """
+    Description:
+        Cumulative histogram of observed values.
+
+    Parameters:
+        buckets - sorted upper bounds of the buckets
+    """
+
+    def __init__(self, buckets=latency_buckets):
+        """ Class entry point """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Record a value """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def toDict(self):
+        """ Returns the histogram as a dictionary (bucket counts are cumulative) """
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            cumulative.append([bound, total])
+        return {"buckets": cumulative, "sum": self.sum, "count": self.count}
+
+
+class Metrics():
+    """
+    Description:
+        Thread-safe registry of labelled counters and histograms.
+
+    Parameters:
+        buckets     - histogram bucket upper bounds (in seconds)
+        per_command - label command metrics with the command itself (first
+                      line, shortened); every distinct command becomes a
+                      new series, so only use it with a bounded command set
+    """
+
+    def __init__(self, buckets=latency_buckets, per_command=False):
+        """ Class entry point """
+        self.buckets = buckets
+        self.per_command = per_command
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, value, **labels):
+        """ Record a value in the histogram name{labels} """
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(self.buckets)
+            hist.observe(value)
+        finally:
+            self.lock.release()
+
+    def inc(self, name, value=1, **labels):
+        """ Add value to the counter name{labels} """
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        """ Discard everything recorded so far """
+        self.lock.acquire()
+        try:
+            self.histograms = {}
+            self.counters = {}
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """
+        Description:
+            Returns everything recorded so far.
+
+        Returns:
+            dictionary with "counters" and "histograms" lists; each entry has
+            name, labels and value (counters) or buckets/sum/count (histograms)
+        """
+        self.lock.acquire()
+        try:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), hist in sorted(self.histograms.items()):
+                entry = hist.toDict()
+                entry.update({"name": name, "labels": dict(labels)})
+                histograms.append(entry)
+        finally:
+            self.lock.release()
+        return {"counters": counters, "histograms": histograms}
+
+    def toJson(self, indent=None):
+        """ Returns the snapshot as a JSON string """
+        return json.dumps(self.snapshot(), indent=indent, sort_keys=True)
+
+    def toPrometheus(self, prefix="pyutils_"):
+        """ Returns the snapshot in the Prometheus text exposition format """
+        snap = self.snapshot()
+        lines = []
+        typed = set()
+        for c in snap["counters"]:
+            name = prefix + c["name"]
+            if name not in typed:
+                lines.append("# TYPE %s counter" % name)
+                typed.add(name)
+            lines.append("%s%s %s" % (name, formatLabels(c["labels"]), c["value"]))
+        for h in snap["histograms"]:
+            name = prefix + h["name"]
+            if name not in typed:
+                lines.append("# TYPE %s histogram" % name)
+                typed.add(name)
+            for bound, count in h["buckets"]:
+                labels = dict(h["labels"], le=bound if bound == "+Inf" else repr(float(bound)))
+                lines.append("%s_bucket%s %d" % (name, formatLabels(labels), count))
+            lines.append("%s_sum%s %r" % (name, formatLabels(h["labels"]), h["sum"]))
+            lines.append("%s_count%s %d" % (name, formatLabels(h["labels"]), h["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def formatLabels(labels):
+    """ Format a label dictionary as {k="v",...} for Prometheus """
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{%s}" % ",".join('%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items()))
+
+
+class CommandTimer():
+    """
+    Description:
+        Times one command: time to first byte, total time, bytes in and out,
+        and whether it timed out.  Recorded when done() is called.
+
+    Parameters:
+        metrics - Metrics to record into
+        kind    - controller type, such as "ssh"
+        host    - hostname or ip address of remote host
+        op      - operation, such as "run"
+        cmd     - command (used as a label when metrics.per_command is set)
+    """
+
+    def __init__(self, metrics, kind, host, op, cmd=None):
+        """ Class entry point """
+        self.metrics = metrics
+        self.labels = {"kind": kind, "host": host, "op": op}
+        if cmd is not None and metrics.per_command:
+            self.labels["command"] = commandLabel(cmd)
+        self.start = time.time()
+        self.first = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.timed_out = False
+        self.finished = False
+
+    def received(self, count):
+        """ Record bytes received """
+        if self.first is None:
+            self.first = time.time()
+        self.bytes_in += count
+
+    def sent(self, count):
+        """ Record bytes sent """
+        self.bytes_out += count
+
+    def timeout(self):
+        """ Record that the command timed out """
+        self.timed_out = True
+
+    def done(self):
+        """ Record the command's metrics (only the first call counts) """
+        if self.finished:
+            return
+        self.finished = True
+        elapsed = time.time() - self.start
+        self.metrics.observe("command_seconds", elapsed, **self.labels)
+        if self.first is not None:
+            self.metrics.observe("first_byte_seconds", self.first - self.start, **self.labels)
+        host_labels = {"kind": self.labels["kind"], "host": self.labels["host"]}
+        if self.bytes_in:
+            self.metrics.inc("bytes_received_total", self.bytes_in, **host_labels)
+        if self.bytes_out:
+            self.metrics.inc("bytes_sent_total", self.bytes_out, **host_labels)
+        if self.timed_out:
+            self.metrics.inc("timeouts_total", op=self.labels["op"], **host_labels)
+
+    def doneFuture(self, future):
+        """ Record a command completed through a Future (for addCallback) """
+        error = future.error
+        if error is None:
+            if isinstance(future.value, basestring):
+                self.received(len(future.value))
+        elif "timed out" in str(error):
+            self.timeout()
+        self.done()
+
+
+class NullTimer():
+    """ CommandTimer stand-in used while metrics are disabled """
+
+    def received(self, count):
+        pass
+
+    def sent(self, count):
+        pass
+
+    def timeout(self):
+        pass
+
+    def done(self):
+        pass
+
+    def doneFuture(self, future):
+        pass
+
+
+def commandLabel(cmd, length=64):
+    """ Shorten a command to a single-line label """
+    cmd = str(cmd).strip()
+    if cmd.startswith("<"):
+        # xml request: label with the first two element names, e.g. "rpc get-config"
+        cmd = " ".join(re.findall(r"<([A-Za-z_][\w.:-]*)", cmd)[:2])
+    lines = cmd.splitlines()
+    return lines[0][:length] if lines else ""
+
+
+metrics = Metrics()
+null_timer = NullTimer()
+
+
+def setMetrics(registry):
+    """ Install a Metrics registry for all controllers (None disables metrics) """
+    global metrics
+    metrics = registry
+
+
+def timer(kind, host, op, cmd=None):
+    """ Returns a CommandTimer for the current registry (or a NullTimer) """
+    if metrics is None:
+        return null_timer
+    return CommandTimer(metrics, kind, host, op, cmd)
+
+
+def connected(kind, host, elapsed, ok=True):
+    """ Record a connection attempt """
+    if metrics is None:
+        return
+    if ok:
+        metrics.observe("connect_seconds", elapsed, kind=kind, host=host)
+    else:
+        metrics.inc("connect_failures_total", kind=kind, host=host)
@@ -3,8 +3,668 @@
 Description:
     Collection of utilities to facilitate database interactions.
 """
-import MySQLdb
+import re
+import time
+import weakref
+import hashlib
 import logging
+import threading
+import contextlib
+import collections
+import lazyUtils
+
+# imported on first use, so importing this module does not require MySQLdb
+MySQLdb = lazyUtils.LazyImport("MySQLdb")
+cursors = lazyUtils.LazyImport("MySQLdb.cursors")
+
+
+class DbPool:
+    """
+    Description:
+        Thread-safe pool of MySQLdb connections to one database.
+        Connections are pinged before they are handed out, replaced once
+        they are older than recycle seconds, and capped at max_size.
+
+    Parameters:
+        db_name  - name of database
+        host     - host (name or IP address) of database server
+        user     - user ID
+        passwd   - user password
+        min_size - connections opened up front
+        max_size - maximum number of connections (idle and in use)
+        timeout  - seconds to wait for a free connection
+        recycle  - seconds after which a connection is closed and replaced
+        ping     - ping connections before handing them out
+    """
+
+    def __init__(self, db_name, host, user, passwd, min_size=1, max_size=10, timeout=30, recycle=3600,
+                 ping=True):
+        """ Class entry point """
+        self.db_host = host
+        self.db_user = user
+        self.db_passwd = passwd
+        self.db_name = db_name
+        self.max_size = int(max_size)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping = ping
+        self.lock = threading.Condition()
+        self.idle = []
+        self.created = {}
+        self.count = 0
+        for i in range(min(int(min_size), self.max_size)):
+            self.count += 1
+            self.idle.append(self.newConnection())
+
+    def newConnection(self):
+        """ Open a new connection """
+        db = MySQLdb.connect(host=self.db_host, user=self.db_user, passwd=self.db_passwd, db=self.db_name)
+        self.created[id(db)] = time.time()
+        return db
+
+    def healthy(self, db):
+        """ True if an idle connection may be handed out """
+        if self.recycle and time.time() - self.created.get(id(db), 0) > self.recycle:
+            return False
+        if self.ping:
+            try:
+                db.ping()
+            except MySQLdb.Error, e:
+                logging.debug("dropping dead database connection: %s", e)
+                return False
+        return True
+
+    def acquire(self, timeout=None):
+        """
+        Description:
+            Check out a connection, opening one if the pool is below max_size.
+
+        Parameters:
+            timeout - seconds to wait for a free connection (defaults to the pool timeout)
+
+        Returns:
+            MySQLdb connection
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        while True:
+            self.lock.acquire()
+            try:
+                while not self.idle and self.count >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise IOError("no free database connection to %s within %ss" % (self.db_host, timeout))
+                    self.lock.wait(remaining)
+                if self.idle:
+                    db = self.idle.pop()
+                else:
+                    self.count += 1
+                    db = None
+            finally:
+                self.lock.release()
+
+            if db is None:
+                try:
+                    return self.newConnection()
+                except Exception:
+                    self.lock.acquire()
+                    self.count -= 1
+                    self.lock.notify()
+                    self.lock.release()
+                    raise
+            if self.healthy(db):
+                return db
+            self.discard(db)
+
+    def release(self, db):
+        """ Return a connection to the pool, rolling back anything uncommitted """
+        try:
+            db.rollback()
+        except MySQLdb.Error, e:
+            logging.debug("dropping database connection that failed to roll back: %s", e)
+            self.discard(db)
+            return
+        self.lock.acquire()
+        try:
+            self.idle.append(db)
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def discard(self, db):
+        """ Close a checked out connection instead of returning it """
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+        self.lock.acquire()
+        try:
+            self.created.pop(id(db), None)
+            self.count -= 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Description:
+            Check out a connection for the duration of a with block:
+
+                with pool.connection() as db:
+                    ...
+
+            The connection is discarded if the block raises a connection
+            error, and returned to the pool otherwise.
+        """
+        db = self.acquire(timeout)
+        try:
+            yield db
+        except MySQLdb.OperationalError:
+            self.discard(db)
+            raise
+        except:
+            self.release(db)
+            raise
+        self.release(db)
+
+    def stats(self):
+        """ Returns a dictionary with the open, idle and in use connection counts """
+        self.lock.acquire()
+        try:
+            return {"open": self.count, "idle": len(self.idle), "in_use": self.count - len(self.idle)}
+        finally:
+            self.lock.release()
+
+    def closeAll(self):
+        """ Close the idle connections """
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, []
+        finally:
+            self.lock.release()
+        for db in idle:
+            self.discard(db)
+
+
+# MySQL errors meaning cached table metadata is stale: unknown column,
+# table doesn't exist, column count doesn't match value count
+schema_errors = (1054, 1146, 1136)
+
+# MySQL error: unknown prepared statement handler (the connection was reset)
+unknown_statement = 1243
+
+ddl_regex = re.compile(r"^\s*(alter|create|drop|rename|truncate)\s+table\b", re.IGNORECASE)
+
+# statements that do not change any table
+read_regex = re.compile(r"^\s*\(?\s*(select|show|describe|desc|explain)\b", re.IGNORECASE)
+
+# reads whose results must not be cached
+uncacheable_regex = re.compile(r"\b(sql_no_cache|for\s+update|lock\s+in\s+share\s+mode|into)\b|@", re.IGNORECASE)
+
+table_name = r"`?\w+`?(?:\.`?\w+`?)?"
+
+# tables read by a SELECT: "from a", "from a x, b as y", "join c"
+read_tables_regex = re.compile(r"\b(?:from|join)\s+(%s(?:\s+(?:as\s+)?\w+)?(?:\s*,\s*%s(?:\s+(?:as\s+)?\w+)?)*)"
+                               % (table_name, table_name), re.IGNORECASE)
+
+# table changed by a single-table write
+write_table_regex = re.compile(r"^\s*(?:(?:insert|replace)(?:\s+(?:low_priority|delayed|high_priority|ignore))*"
+                               r"(?:\s+into)?|update(?:\s+(?:low_priority|ignore))*|delete(?:\s+(?:low_priority|quick|"
+                               r"ignore))*\s+from|(?:alter|drop|create|truncate)(?:\s+temporary)?(?:\s+table)?"
+                               r"(?:\s+if(?:\s+not)?\s+exists)?)\s+(%s)" % table_name, re.IGNORECASE)
+
+# writes that can change more than the first table named
+multi_table_regex = re.compile(r"\b(join|using)\b|^\s*(update\s+%s\s*,|delete\s+%s\s*,|rename\b)"
+                               % (table_name, table_name), re.IGNORECASE)
+
+quoted_regex = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|\s+""")
+
+table_stats_sql = ("SELECT TABLE_NAME, ENGINE, TABLE_ROWS, AVG_ROW_LENGTH, DATA_LENGTH, INDEX_LENGTH, DATA_FREE, "
+                   "AUTO_INCREMENT, CREATE_TIME, UPDATE_TIME FROM information_schema.TABLES "
+                   "WHERE TABLE_SCHEMA = %s")
+
+index_stats_sql = ("SELECT INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME, NON_UNIQUE, CARDINALITY, INDEX_TYPE "
+                   "FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s "
+                   "ORDER BY INDEX_NAME = 'PRIMARY' DESC, INDEX_NAME, SEQ_IN_INDEX")
+
+
+class TableSchema:
+    """
+    Description:
+        Metadata of one table, parsed from DESCRIBE output.
+
+    Parameters:
+        table - name of table
+        rows  - DESCRIBE rows (Field, Type, Null, Key, Default, Extra)
+    """
+
+    def __init__(self, table, rows):
+        """ Class entry point """
+        self.table = table
+        self.columns = [row[0] for row in rows]
+        self.types = dict((row[0], row[1]) for row in rows)
+        self.nullable = dict((row[0], row[2] == "YES") for row in rows)
+        self.keys = dict((row[0], row[3]) for row in rows if row[3])
+        self.defaults = dict((row[0], row[4]) for row in rows)
+        self.primary = [row[0] for row in rows if row[3] == "PRI"]
+        self.auto_increment = None
+        for row in rows:
+            if "auto_increment" in (row[5] or "").lower():
+                self.auto_increment = row[0]
+                break
+        self.loaded = time.time()
+
+
+class SchemaCache:
+    """
+    Description:
+        Thread-safe cache of TableSchema objects with a time to live.
+
+    Parameters:
+        ttl - seconds a table's metadata is kept (0 disables the cache)
+    """
+
+    def __init__(self, ttl=300):
+        """ Class entry point """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def get(self, table):
+        """ Returns the cached TableSchema of a table, or None """
+        self.lock.acquire()
+        try:
+            schema = self.tables.get(table)
+            if schema is not None and time.time() - schema.loaded > self.ttl:
+                del self.tables[table]
+                return None
+            return schema
+        finally:
+            self.lock.release()
+
+    def put(self, schema):
+        """ Cache a TableSchema """
+        if not self.ttl:
+            return
+        self.lock.acquire()
+        try:
+            self.tables[schema.table] = schema
+        finally:
+            self.lock.release()
+
+    def invalidate(self, table=None):
+        """ Drop a table's metadata (or every table's) """
+        self.lock.acquire()
+        try:
+            if table is None:
+                self.tables = {}
+            else:
+                self.tables.pop(table, None)
+        finally:
+            self.lock.release()
+
+
+class Statement:
+    """
+    Description:
+        A parameterized SQL statement: the text has a %s placeholder for
+        every value, which is passed separately to the server.  The text is
+        a MySQLdb format string, so a literal % in it is written %%.
+
+    Parameters:
+        sql     - statement text
+        columns - columns whose values are bound first (VALUES or SET)
+        where   - columns whose values are bound next (WHERE clause)
+    """
+
+    def __init__(self, sql, columns=(), where=()):
+        """ Class entry point """
+        self.sql = sql
+        self.columns = tuple(columns)
+        self.where = tuple(where)
+        # server-side prepared statement name, the same for the same text
+        self.name = "pyutils_%s" % hashlib.md5(sql).hexdigest()[:16]
+
+    def args(self, values=None, where_data=None):
+        """ Returns the values to bind, in placeholder order """
+        args = tuple(values[c] for c in self.columns)
+        return args + tuple(where_data[c] for c in self.where)
+
+    def prepareText(self):
+        """ Returns the text for PREPARE: ? placeholders and literal % signs """
+        return self.sql % (("?",) * (len(self.columns) + len(self.where)))
+
+
+class StatementCache:
+    """
+    Description:
+        Thread-safe LRU cache of Statements, keyed by table, column set and
+        where-key set, so calls of the same shape reuse the same SQL text.
+
+    Parameters:
+        size - maximum number of statements kept
+    """
+
+    def __init__(self, size=256):
+        """ Class entry point """
+        self.size = size
+        self.lock = threading.Lock()
+        self.statements = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """ Returns the cached Statement for key, calling build() to create it """
+        self.lock.acquire()
+        try:
+            stmt = self.statements.pop(key, None)
+            if stmt is None:
+                self.misses += 1
+                stmt = build()
+                if len(self.statements) >= self.size:
+                    self.statements.popitem(last=False)
+            else:
+                self.hits += 1
+            self.statements[key] = stmt
+            return stmt
+        finally:
+            self.lock.release()
+
+    def select(self, table, cols=None, where_data=None):
+        """ Returns the SELECT Statement for cols (a column list string) and where_data's keys """
+        where_key = whereKey(where_data)
+        def build():
+            where, bind = whereClause(where_key)
+            return Statement("SELECT %s FROM `%s`%s" % (escapePercent(cols or "*"), escapePercent(table), where),
+                             where=bind)
+        return self.get(("select", table, cols, where_key), build)
+
+    def insert(self, table, columns):
+        """ Returns the INSERT Statement for a set of columns """
+        columns = tuple(sorted(columns))
+        def build():
+            return Statement("INSERT INTO `%s` (%s) VALUES (%s)" % (escapePercent(table), columnList(columns),
+                                                                     ", ".join(["%s"] * len(columns))), columns)
+        return self.get(("insert", table, columns), build)
+
+    def update(self, table, columns, where_data):
+        """ Returns the UPDATE Statement for a set of columns and where_data's keys """
+        columns = tuple(sorted(columns))
+        where_key = whereKey(where_data)
+        def build():
+            where, bind = whereClause(where_key)
+            sets = ", ".join(["`%s`=%%s" % escapePercent(c) for c in columns])
+            return Statement("UPDATE `%s` SET %s%s" % (escapePercent(table), sets, where), columns, bind)
+        return self.get(("update", table, columns, where_key), build)
+
+    def delete(self, table, where_data=None):
+        """ Returns the DELETE Statement for where_data's keys """
+        where_key = whereKey(where_data)
+        def build():
+            where, bind = whereClause(where_key)
+            return Statement("DELETE FROM `%s`%s" % (escapePercent(table), where), where=bind)
+        return self.get(("delete", table, where_key), build)
+
+    def clear(self):
+        """ Drop every cached statement """
+        self.lock.acquire()
+        try:
+            self.statements.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """ Returns cached statement count, hits and misses """
+        return {"statements": len(self.statements), "hits": self.hits, "misses": self.misses}
+
+
+def whereKey(where_data):
+    """ Returns the shape of a where dictionary: sorted (column, is None) pairs """
+    return tuple(sorted((k, v is None) for k, v in (where_data or {}).iteritems()))
+
+
+def whereClause(where_key):
+    """ Returns the WHERE clause for a whereKey() and the columns it binds """
+    if not where_key:
+        return "", ()
+    terms = ["`%s` IS NULL" % escapePercent(k) if null else "`%s`=%%s" % escapePercent(k) for k, null in where_key]
+    return " WHERE " + " AND ".join(terms), tuple(k for k, null in where_key if not null)
+
+
+def escapePercent(text):
+    """ Escapes the % signs in text going into a statement MySQLdb will %-format """
+    return text.replace("%", "%%")
+
+
+def columnList(columns):
+    """ Returns the quoted, comma separated column names of an INSERT """
+    return ", ".join(["`%s`" % escapePercent(c) for c in columns])
+
+
+statement_cache = StatementCache()
+
+# names of the statements prepared on each connection, least recently used first
+prepared_statements = weakref.WeakKeyDictionary()
+prepared_lock = threading.Lock()
+
+# statements kept prepared per connection (the server caps the total at
+# max_prepared_stmt_count, 16382 by default)
+max_prepared = 64
+
+
+def tableName(name):
+    """ Strips backticks from a table name, keeping any database prefix """
+    return name.replace("`", "")
+
+
+def normalizeQuery(query):
+    """ Collapses whitespace outside quoted strings and drops a trailing semicolon """
+    query = quoted_regex.sub(lambda m: m.group(1) or " ", query).strip()
+    return query[:-1].rstrip() if query.endswith(";") else query
+
+
+def readTables(query):
+    """
+    Description:
+        Returns the tables a cacheable SELECT reads from.
+
+    Parameters:
+        query - sql query
+
+    Returns:
+        tuple of table names, or None if the query is not a cacheable read
+    """
+    if not read_regex.match(query) or uncacheable_regex.search(query):
+        return None
+    tables = set()
+    for match in read_tables_regex.finditer(query):
+        for item in match.group(1).split(","):
+            tables.add(tableName(item.split()[0]))
+    return tuple(sorted(tables)) or None
+
+
+def writeTables(query):
+    """
+    Description:
+        Returns the tables a statement may change.
+
+    Parameters:
+        query - sql statement
+
+    Returns:
+        tuple of table names; empty for reads; None if the statement may
+        change any table
+    """
+    if read_regex.match(query):
+        return ()
+    match = write_table_regex.match(query)
+    if match is None or multi_table_regex.search(query):
+        return None
+    return (tableName(match.group(1)),)
+
+
+class QueryCache:
+    """
+    Description:
+        Thread-safe LRU cache of query results with a time to live, for
+        lookups against tables that rarely change.  Results are keyed by
+        scope (host, user and database), normalized query and parameters,
+        and dropped when a table they read from is written through dbase.
+        Tables are named with their database (db.table), so a write to a
+        table drops the results that read it through any database of the
+        same host and user.  Writes made by other clients are only seen
+        once entries expire.
+
+    Parameters:
+        size - maximum number of cached results
+        ttl  - default time to live (in seconds)
+        ttls - dictionary of table name (db.table, or table for every
+               database) (key) and time to live (value); a result lives as
+               long as the shortest ttl of its tables (a ttl of 0 disables
+               caching for that table)
+    """
+
+    def __init__(self, size=1024, ttl=60, ttls=None):
+        """ Class entry point """
+        self.size = int(size)
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        # bumped on every invalidation, so a query that was running while
+        # its tables were written does not store its (stale) result
+        self.generations = {}
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.invalidations = 0
+
+    def ttlFor(self, tables):
+        """ Returns the time to live for a result read from tables """
+        return min([self.ttls.get(t, self.ttls.get(t.split(".")[-1], self.ttl)) for t in tables])
+
+    def generation(self, scope, tables):
+        """ Returns the invalidation counters of tables (call with the lock held) """
+        counters = (self.epoch, self.generations.get((scope, None), 0))
+        return counters + tuple(self.generations.get((scope[:-1], t), 0) for t in tables)
+
+    def call(self, scope, query, args, tables, func):
+        """
+        Description:
+            Returns the cached result of a query, or calls func() and
+            caches its result.
+
+        Parameters:
+            scope  - (host, user, db_name) the query runs as
+            query  - sql query
+            args   - query parameters (tuple, or None)
+            tables - db.table names of the tables the query reads
+            func   - callable running the query
+
+        Returns:
+            query result
+        """
+        ttl = self.ttlFor(tables)
+        if ttl <= 0:
+            self.lock.acquire()
+            self.bypassed += 1
+            self.lock.release()
+            return func()
+        key = (scope, normalizeQuery(query), tuple(args) if args is not None else None)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            generation = self.generation(scope, tables)
+        finally:
+            self.lock.release()
+
+        value = func()
+        self.lock.acquire()
+        try:
+            if self.generation(scope, tables) == generation:
+                self.entries[key] = (time.time() + ttl, tables, value)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+        return value
+
+    def invalidate(self, scope=None, table=None):
+        """
+        Drop cached results of a scope, or the results that read a db.table
+        through any database of the scope's host and user (everything by
+        default)
+        """
+        self.lock.acquire()
+        try:
+            self.invalidations += 1
+            if scope is None:
+                self.entries.clear()
+                self.epoch += 1
+                return
+            key = (scope, None) if table is None else (scope[:-1], table)
+            self.generations[key] = self.generations.get(key, 0) + 1
+            for entry_key, entry in self.entries.items():
+                if table is None and entry_key[0] == scope:
+                    del self.entries[entry_key]
+                elif table is not None and entry_key[0][:-1] == scope[:-1] and table in entry[1]:
+                    del self.entries[entry_key]
+        finally:
+            self.lock.release()
+
+    def hitRatio(self):
+        """ Returns the fraction of cacheable queries answered from the cache """
+        self.lock.acquire()
+        try:
+            return self.hitRatioLocked()
+        finally:
+            self.lock.release()
+
+    def hitRatioLocked(self):
+        """ hitRatio() for callers holding the lock """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        """ Returns a dictionary of cache statistics """
+        self.lock.acquire()
+        try:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "bypassed": self.bypassed,
+                    "invalidations": self.invalidations,
+                    "size": len(self.entries),
+                    "hit_ratio": self.hitRatioLocked()}
+        finally:
+            self.lock.release()
+
+
+query_cache = QueryCache()
+
+
+db_pools = {}
+db_pools_lock = threading.Lock()
+
+
+def getPool(db_name, host, user, passwd):
+    """ Returns the shared DbPool for a database, creating it on first use """
+    key = (db_name, host, user, passwd)
+    db_pools_lock.acquire()
+    try:
+        if key not in db_pools:
+            db_pools[key] = DbPool(db_name, host, user, passwd)
+        return db_pools[key]
+    finally:
+        db_pools_lock.release()
 
 
 class dbase:
@@ -17,32 +677,138 @@ class dbase:
         host    - host (name or IP address) of database server
         user    - user ID 
         passwd  - user password
+        pool    - DbPool to check connections out of for each call (True
+                  for the shared pool of this database); without a pool the
+                  object holds one connection and is not thread-safe.
+                  insertRow, insertMany and updateRow always commit;
+                  deleteRow and runSql writes commit only in pooled mode
+                  (returning the connection would roll them back), and are
+                  left to the caller on a single connection.  Nothing
+                  commits inside a transaction() block.
+        schema_ttl - seconds table metadata is cached (0 disables the cache)
+        prepared   - run the statements of insertRow, updateRow, deleteRow
+                     and selectRow as server-side prepared statements; this
+                     takes an extra round trip per call (see executeStatement)
+        cache      - QueryCache for the results of selectRow and runSql
+                     SELECTs (True for the shared cache); writes made
+                     through this object invalidate the tables they change
     """
     
-    def __init__(self, db_name, host, user, passwd):
+    def __init__(self, db_name, host, user, passwd, pool=None, schema_ttl=300, prepared=False, cache=None):
         """ Class entry point"""
+        self.schema = SchemaCache(schema_ttl)
+        self.statements = statement_cache
+        self.prepared = prepared
+        self.cache = query_cache if cache is True else cache
+        self.scope = (host, user, db_name)
         self.db_host = host
         self.db_user = user
         self.db_passwd = passwd
         self.db_name = db_name
-        self.connect()
+        self.pool = getPool(db_name, host, user, passwd) if pool is True else pool
+        self.local = threading.local()
+        self.db = None
+        self.cursor = None
+        if self.pool is None:
+            self.connect()
 
     def connect(self):
         """ 
         Description:
             Establish db connection
         """
-        self.db = MySQLdb.connect(host=self.db_host, user=self.db_user, passwd=self.db_passwd, db=self.db_name)
+        self.db = self.newConnection()
         self.cursor = self.db.cursor()
 
+    def newConnection(self):
+        """ Open a new connection to the database """
+        return MySQLdb.connect(host=self.db_host, user=self.db_user, passwd=self.db_passwd, db=self.db_name)
+
     def close(self):
         """
         Description:
-            Close db connection
+            Close db connection (pooled connections stay with the pool)
         """
+        if self.pool is not None:
+            return
         self.cursor.close()
         self.db.close()
 
+    @contextlib.contextmanager
+    def checkout(self):
+        """
+        Description:
+            Yields a cursor for the duration of a with block.  In pooled mode
+            a connection is checked out for the block; nested checkouts on
+            the same thread share it.  Use cursor.connection to commit.
+        """
+        if self.pool is None:
+            yield self.cursor
+            return
+        cursor = getattr(self.local, "cursor", None)
+        if cursor is not None:
+            yield cursor
+            return
+        with self.pool.connection() as db:
+            cursor = self.local.cursor = db.cursor()
+            try:
+                yield cursor
+            finally:
+                self.local.cursor = None
+                cursor.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Description:
+            Yields a cursor and runs the writes of a with block as one
+            transaction:
+
+                with db.transaction():
+                    db.deleteRow("hosts", {"site": 3})
+                    db.insertMany("hosts", rows)
+
+            The write methods do not commit inside the block; it is
+            committed when the block ends and rolled back if it raises.
+            Reads inside the block bypass the query cache, and cached
+            results of the tables written are dropped again at the end.
+            A nested block is part of the outer transaction.
+        """
+        if self.inTransaction():
+            with self.checkout() as cursor:
+                yield cursor
+            return
+        with self.checkout() as cursor:
+            self.local.written = []
+            try:
+                yield cursor
+            except:
+                cursor.connection.rollback()
+                raise
+            else:
+                cursor.connection.commit()
+            finally:
+                written, self.local.written = self.local.written, None
+                for tables in written:
+                    self.invalidateCache(tables)
+
+    def inTransaction(self):
+        """ True inside a transaction() block on this thread """
+        return getattr(self.local, "written", None) is not None
+
+    def commitWrite(self, cursor, pooled=False):
+        """
+        Description:
+            Commit a write made outside a transaction() block.
+
+        Parameters:
+            cursor - cursor the write ran on
+            pooled - commit only in pooled mode
+        """
+        if self.inTransaction() or (pooled and self.pool is None):
+            return
+        cursor.connection.commit()
+
     def getDbServerOs(self):
         """
         Description:
@@ -51,8 +817,9 @@ class dbase:
         Returns:
             string describing OS and version
         """
-        self.cursor.execute("SELECT VERSION()")
-        return self.cursor.fetchone()[0]
+        with self.checkout() as cursor:
+            cursor.execute("SELECT VERSION()")
+            return cursor.fetchone()[0]
 
     def getDataBases(self, db_type=None):
         """
@@ -65,16 +832,18 @@ class dbase:
         Returns:
             list of database names
         """
-        self.cursor.execute("show databases")
-        return [db[0] for db in self.cursor.fetchall()]
+        with self.checkout() as cursor:
+            cursor.execute("show databases")
+            return [db[0] for db in cursor.fetchall()]
 
     def getTables(self):
         """
         Description:
             Returns a list containing names of all tables in the database.
         """
-        self.cursor.execute("show tables")
-        return [row[0] for row in self.cursor]
+        with self.checkout() as cursor:
+            cursor.execute("show tables")
+            return [row[0] for row in cursor]
 
     def getColumnNames(self, table):
         """
@@ -87,13 +856,70 @@ class dbase:
         Returns:
             list of field names in table
         """
-        self.cursor.execute("DESCRIBE %s" % table)
-        return [row[0] for row in self.cursor]
+        return list(self.getSchema(table).columns)
+
+    def getSchema(self, table, refresh=False):
+        """
+        Description:
+            Returns the columns, types, keys and auto-increment column of a
+            table, from the schema cache when possible.
+
+        Parameters:
+            table   - name of table
+            refresh - ignore the cache and DESCRIBE the table again
+
+        Returns:
+            TableSchema
+        """
+        schema = None if refresh else self.schema.get(table)
+        if schema is None:
+            with self.checkout() as cursor:
+                cursor.execute("DESCRIBE %s" % table)
+                schema = TableSchema(table, cursor.fetchall())
+            self.schema.put(schema)
+        return schema
+
+    def invalidateSchema(self, table=None):
+        """
+        Description:
+            Drop cached schema of a table (or of every table), for example
+            after an ALTER TABLE run outside this object.
+
+        Parameters:
+            table - name of table; None for all tables
+        """
+        self.schema.invalidate(table)
+
+    def invalidateCache(self, tables=None):
+        """
+        Description:
+            Drop cached query results that read from tables, for example
+            after a write made outside this object.
+
+        Parameters:
+            tables - table names (table, or db.table for another database);
+                     None for every table of the database
+        """
+        if self.cache is None:
+            return
+        if self.inTransaction():
+            # dropped again once the transaction ends
+            self.local.written.append(tables)
+        if tables is None:
+            self.cache.invalidate(self.scope)
+            return
+        for table in self.qualifyTables(tables):
+            self.cache.invalidate(self.scope, table)
+
+    def qualifyTables(self, tables):
+        """ Returns table names as db.table, adding this database to bare names """
+        return tuple(t if "." in t else "%s.%s" % (self.db_name, t) for t in map(tableName, tables))
 
     def getColumnCount(self, table):
         """
         Description:
-            Returns the field (column) count for a given table.
+            Returns the field (column) count for a given table, from the
+            schema cache when possible.
 
         Parameters:
             table - name of table
@@ -101,22 +927,110 @@ class dbase:
         Returns:
             number of fields in table
         """
-        self.cursor.execute("select * from %s" % table)
-        return self.db.field_count()
+        return len(self.getSchema(table).columns)
 
-    def getRowCount(self, table):
+    def getRowCount(self, table, exact=True):
         """
         Description:
             Returns the record (row) count for a given table.
 
         Parameters:
             table - name of table
+            exact - count rows with COUNT(*) (scans the table); False reads
+                    the estimate kept in information_schema instead, which
+                    costs nothing but can be well off for InnoDB tables
 
         Returns:
             number of records in table
-        """        
-        self.cursor.execute("SELECT COUNT(*) FROM %s" % table)
-        return self.cursor.fetchall()[0][0]
+        """
+        if not exact:
+            return self.getTableStats(table)["rows"]
+        with self.checkout() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM %s" % table)
+            return cursor.fetchall()[0][0]
+
+    def getTableStats(self, table, exact=False):
+        """
+        Description:
+            Returns row count, sizes and storage details of a table from
+            information_schema.TABLES, without reading the table itself.
+            The row count and sizes are estimates maintained by the server
+            (MySQL 8 also caches them, see information_schema_stats_expiry).
+
+        Parameters:
+            table - name of table
+            exact - replace the estimated row count with COUNT(*)
+
+        Returns:
+            dictionary with table, engine, rows, exact (whether rows is
+            exact), avg_row_length, data_length, index_length, data_free,
+            total_length (bytes), auto_increment, create_time and update_time
+        """
+        with self.checkout() as cursor:
+            cursor.execute(table_stats_sql + " AND TABLE_NAME = %s", (self.db_name, table))
+            row = cursor.fetchone()
+        if row is None:
+            raise MySQLdb.ProgrammingError(1146, "Table '%s.%s' doesn't exist" % (self.db_name, table))
+        stats = self.statsToDict(row)
+        if exact:
+            stats["rows"] = self.getRowCount(table)
+            stats["exact"] = True
+        return stats
+
+    def getTableSizes(self):
+        """
+        Description:
+            Returns the statistics of every table in the database with one
+            information_schema query (see getTableStats).
+
+        Returns:
+            dictionary of table name (key) and statistics dictionary (value)
+        """
+        with self.checkout() as cursor:
+            cursor.execute(table_stats_sql, (self.db_name,))
+            return dict((row[0], self.statsToDict(row)) for row in cursor.fetchall())
+
+    def getIndexes(self, table):
+        """
+        Description:
+            Returns the indexes of a table from information_schema.STATISTICS.
+
+        Parameters:
+            table - name of table
+
+        Returns:
+            list of dictionaries with name, columns (in index order), unique,
+            primary, type and cardinality (the server's estimate of distinct
+            values) of each index
+        """
+        with self.checkout() as cursor:
+            cursor.execute(index_stats_sql, (self.db_name, table))
+            rows = cursor.fetchall()
+        indexes = []
+        by_name = {}
+        for name, seq, column, non_unique, cardinality, index_type in rows:
+            index = by_name.get(name)
+            if index is None:
+                index = by_name[name] = {"name": name, "columns": [], "unique": not int(non_unique),
+                                         "primary": name == "PRIMARY", "type": index_type,
+                                         "cardinality": cardinality}
+                indexes.append(index)
+            index["columns"].append(column)
+            # the cardinality of the whole index is that of its last column
+            index["cardinality"] = cardinality
+        return indexes
+
+    def statsToDict(self, row):
+        """ Converts a table_stats_sql row into a getTableStats() dictionary """
+        (table, engine, rows, avg_row_length, data_length, index_length, data_free, auto_increment,
+         create_time, update_time) = row
+        total = None
+        if data_length is not None or index_length is not None:
+            total = (data_length or 0) + (index_length or 0)
+        return {"table": table, "engine": engine, "rows": rows, "exact": False,
+                "avg_row_length": avg_row_length, "data_length": data_length, "index_length": index_length,
+                "data_free": data_free, "total_length": total, "auto_increment": auto_increment,
+                "create_time": create_time, "update_time": update_time}
 
     def getAllRows(self, table):
         """
@@ -129,8 +1043,9 @@ class dbase:
         Returns:
             tuple of tuples (row data)
         """
-        self.cursor.execute("select * from %s" % table)
-        return self.cursor.fetchall()
+        with self.checkout() as cursor:
+            cursor.execute("select * from %s" % table)
+            return cursor.fetchall()
 
     def insertRow(self, table, d, debug=0):
         """
@@ -144,32 +1059,125 @@ class dbase:
         Returns:
             id of new row
         """
-        ## check keys against column names
-        valid_columns = self.getColumnNames(table)
-        for k in d.keys():
-            if k not in valid_columns:
-                d.pop(k)
-
-        new_row = -1
-        field_list = []
-        value_list = []
-        for k,v in d.iteritems():
-            field_list.append(k)
-            value_list.append(v)
-        fields = ', '.join(['`%s`' % i for i in field_list])
-        values = ', '.join(['%s' % i if type(i).__name__ in ['int', 'long'] else '"%s"' % i for i in value_list])
-        cmd = '''INSERT INTO `%s` (%s) VALUES (%s)''' % (table,fields,values)
-        print cmd
-        logging.debug(cmd)
+        for attempt in range(2):
+            ## check keys against column names
+            valid_columns = self.getColumnNames(table)
+            for k in d.keys():
+                if k not in valid_columns:
+                    d.pop(k)
+
+            stmt = self.statements.insert(table, d.keys())
+            logging.debug(stmt.sql)
+            try:
+                with self.checkout() as cursor:
+                    self.executeStatement(cursor, stmt, stmt.args(d))
+                    self.commitWrite(cursor)
+                    self.invalidateCache([table])
+                    if cursor.lastrowid:
+                        return cursor.lastrowid
+                    # no auto-increment column
+                    return max([i[0] for i in self.selectRow(table, where_data=d)])
+            except MySQLdb.Error, e:
+                logging.debug("%s: %s", e[0], e[1])
+                if attempt or e.args[0] not in schema_errors:
+                    return -1
+                # the table changed since its columns were cached
+                self.invalidateSchema(table)
+      
+    def insertMany(self, table, rows, batch_size=1000):
+        """
+        Description:
+            Inserts many records, batch_size rows per INSERT statement and
+            one commit per batch (none inside transaction()).  Columns are
+            checked once; keys that are not columns of the table are
+            ignored.  Consecutive rows with the same columns share a batch.
+
+        Parameters:
+            table      - name of table to add records to
+            rows       - list (or generator) of dictionaries containing column
+                         name (key) and value (value)
+            batch_size - maximum number of rows per statement
+
+        Returns:
+            list of ids of the new rows, in the order given.  Ids are derived
+            from the first id of each batch, stepping by the session's
+            auto_increment_increment, so they are only right when a batch
+            gets an unbroken run of ids: not with innodb_autoinc_lock_mode 2
+            (interleaved), where concurrent inserts can take ids in between.
+            Rows are None for tables without an auto-increment column and
+            for rows that give the auto-increment column themselves.
+
+        Raises:
+            MySQLdb.Error; batches before the failing one stay committed
+        """
+        schema = self.getSchema(table)
+        ids = []
+        batch = []
+        columns = None
+        try:
+            with self.checkout() as cursor:
+                step = self.autoIncrementStep(cursor) if schema.auto_increment else 1
+
+                def flush():
+                    batch_ids = self.insertBatch(cursor, table, columns, batch, step)
+                    if schema.auto_increment in columns:
+                        batch_ids = [None] * len(batch)
+                    ids.extend(batch_ids)
+
+                for row in rows:
+                    row_columns = tuple(c for c in schema.columns if c in row)
+                    if batch and (row_columns != columns or len(batch) >= batch_size):
+                        flush()
+                        batch = []
+                    columns = row_columns
+                    batch.append(tuple(row[c] for c in columns))
+                if batch:
+                    flush()
+        finally:
+            # earlier batches stay committed when a later one fails
+            self.invalidateCache([table])
+        return ids
+
+    def autoIncrementStep(self, cursor):
+        """ Returns the session's auto_increment_increment: the gap between generated ids """
+        cursor.execute("SELECT @@auto_increment_increment")
+        return int(cursor.fetchall()[0][0])
+
+    def insertBatch(self, cursor, table, columns, values, step=1):
+        """
+        Description:
+            Inserts one batch of rows with a single multi-row INSERT and commits.
+            The statement grows with the batch, so batch_size must keep it
+            under the server's max_allowed_packet.
+
+        Parameters:
+            cursor  - cursor to use
+            table   - name of table
+            columns - tuple of column names
+            values  - list of tuples of values (in column order)
+            step    - auto_increment_increment (see autoIncrementStep)
+
+        Returns:
+            list of ids of the new rows, assuming they are consecutive (see insertMany)
+        """
+        cmd = "INSERT INTO `%s` (%s) VALUES " % (escapePercent(table), columnList(columns))
+        row = "(%s)" % ", ".join(["%s"] * len(columns))
+        logging.debug("%s%s [%d rows]", cmd, row, len(values))
         try:
-            self.cursor.execute(cmd)
-            self.db.commit()
-            new_row = max([i[0] for i in self.selectRow(table, where_data=d)])
+            # built here rather than by executemany(), which splits statements
+            # longer than 64KB and leaves lastrowid at the last piece's first row
+            cursor.execute(cmd + ", ".join([row] * len(values)), [v for r in values for v in r])
+            self.commitWrite(cursor)
         except MySQLdb.Error, e:
-            logging.debug("%s: %s", e[0], e[1])
-            return -1
-        return new_row
-      
+            if not self.inTransaction():
+                cursor.connection.rollback()
+            if e.args and e.args[0] in schema_errors:
+                self.invalidateSchema(table)
+            raise
+        if not cursor.lastrowid:
+            return [None] * len(values)
+        return range(cursor.lastrowid, cursor.lastrowid + len(values) * step, step)
+
     def updateRow(self, table, set_data, where_data, debug=0):
         """
         Description:
@@ -178,22 +1186,17 @@ class dbase:
         Parameters:
             table      - name of table to containing record to update
             set_data   - dictionary containing column name (key) and value (value) of data to update
-            where_data - dictionary containing column name (key) and value (value) of data to match
+            where_data - dictionary containing column name (key) and value (value) of data to match;
+                         must not be empty (use runSql to update every row)
         """
-        cmd = 'UPDATE %s SET ' % table
-        cmd += ', '.join(['%s=%s' % (k,v) if type(v).__name__ == 'int' else '%s="%s"' % (k,v) for k,v in set_data.iteritems()])
-        compound = False
-        cmd += ' WHERE'
-        for k,v in where_data.iteritems():
-            if compound: cmd += ''' AND'''
-            else: compound = True
-            if type(v).__name__ == 'int':
-                cmd += ''' %s=%s''' % (k,v)
-            else:
-                cmd += ''' %s="%s"''' % (k,v)
-        logging.debug(cmd)
-        self.cursor.execute(cmd)
-        self.db.commit()
+        if not where_data:
+            raise ValueError("updateRow of %s without where_data would update every row" % table)
+        stmt = self.statements.update(table, set_data.keys(), where_data)
+        logging.debug(stmt.sql)
+        with self.checkout() as cursor:
+            self.executeStatement(cursor, stmt, stmt.args(set_data, where_data))
+            self.commitWrite(cursor)
+        self.invalidateCache([table])
 
     def deleteRow(self, table, d=None, debug=0):
         """
@@ -204,20 +1207,12 @@ class dbase:
             table - name of table
             d     - dictionary containing column name (key) and value (value)
         """
-        if not d:
-            cmd = '''DELETE FROM %s''' % table
-        else:
-            cmd = '''DELETE FROM %s WHERE''' % table
-            compound = False
-            for k,v in d.iteritems():
-                if compound: cmd += ''' AND'''
-                else: compound = True
-                if type(v).__name__ == 'int':
-                    cmd += ''' %s=%s''' % (k,v)
-                else:
-                    cmd += ''' %s="%s"''' % (k,v)
-        logging.debug(cmd)
-        self.cursor.execute(cmd)
+        stmt = self.statements.delete(table, d)
+        logging.debug(stmt.sql)
+        with self.checkout() as cursor:
+            self.executeStatement(cursor, stmt, stmt.args(where_data=d))
+            self.commitWrite(cursor, pooled=True)
+        self.invalidateCache([table])
 
     def selectRow(self, table, cols=None, where_data=None, debug=0, dict=False):
         """
@@ -232,28 +1227,156 @@ class dbase:
         Returns:
             records matching search criteria (tuple of tuples)
         """
-        cmd = 'SELECT'
-        if cols: cmd += ' %s' % cols
-        else: cmd += ' *'
-        cmd += ' FROM %s' % table
-        if where_data:
-            cmd += ' WHERE'
-            compound = False
-            for k,v in where_data.iteritems():
-                if compound: cmd += ''' AND'''
-                else: compound = True
-                if type(v).__name__ == 'int':
-                    cmd += ''' `%s`=%s''' % (k,v)
-                else:
-                    cmd += ''' `%s`="%s"''' % (k,v)
+        stmt = self.statements.select(table, cols, where_data)
+        args = stmt.args(where_data=where_data)
         if debug:
-            logging.debug(cmd)
-        self.cursor.execute(cmd)
-        resp = self.cursor.fetchall()
+            logging.debug(stmt.sql)
+
+        def run():
+            with self.checkout() as cursor:
+                self.executeStatement(cursor, stmt, args)
+                rows = cursor.fetchall()
+                return [d[0] for d in cursor.description or ()], rows
+
+        if self.cache is None or self.inTransaction():
+            names, resp = run()
+        else:
+            names, resp = self.cache.call(self.scope, stmt.sql, args, self.qualifyTables([table]), run)
         if dict:
-            return self.resultsToDict(table, resp)
+            return self.resultsToDict(table, resp, names)
         return resp
 
+    def executeStatement(self, cursor, stmt, args):
+        """
+        Description:
+            Execute a Statement with its values.  In prepared mode the
+            statement is prepared once per connection (PREPARE ... FROM) and
+            then only run with new values (EXECUTE ... USING), so the server
+            parses it once.  MySQLdb has no binary protocol, so the values go
+            through user variables: a statement with values costs two round
+            trips (SET, then EXECUTE) where a plain execute costs one, which
+            is slower unless parsing dominates.  Each connection keeps at
+            most max_prepared statements; the least recently used one is
+            deallocated to make room.
+
+        Parameters:
+            cursor - cursor to use
+            stmt   - Statement
+            args   - values to bind (see Statement.args)
+        """
+        if not self.prepared:
+            cursor.execute(stmt.sql, args)
+            return
+        db = cursor.connection
+        prepared_lock.acquire()
+        try:
+            names = prepared_statements.setdefault(db, collections.OrderedDict())
+        finally:
+            prepared_lock.release()
+        if args:
+            variables = ["@p%d" % i for i in range(len(args))]
+            cursor.execute("SET " + ", ".join(["%s=%%s" % v for v in variables]), args)
+            run = "EXECUTE %s USING %s" % (stmt.name, ", ".join(variables))
+        else:
+            run = "EXECUTE %s" % stmt.name
+        for attempt in range(2):
+            if stmt.name in names:
+                names[stmt.name] = names.pop(stmt.name)  # most recently used last
+            else:
+                while len(names) >= max_prepared:
+                    cursor.execute("DEALLOCATE PREPARE %s" % names.popitem(last=False)[0])
+                cursor.execute("PREPARE %s FROM %%s" % stmt.name, (stmt.prepareText(),))
+                names[stmt.name] = True
+            try:
+                cursor.execute(run)
+                return
+            except MySQLdb.Error, e:
+                if attempt or e.args[0] != unknown_statement:
+                    raise
+                # the connection was reset and lost its prepared statements
+                names.clear()
+
+    def iterSql(self, query, args=None, chunk=1000, dict=False):
+        """
+        Description:
+            Execute a query on an unbuffered (server-side) cursor and yield
+            rows as they arrive, chunk rows at a time, so memory use does
+            not grow with the size of the result.
+
+            An unbuffered result ties up its connection until it is read,
+            so the query runs on a connection of its own: a new one, or one
+            checked out of the pool.  Stopping early closes that connection
+            instead of reading the rest of the result.
+
+        Parameters:
+            query - sql query to run
+            args  - query parameters (for %s placeholders)
+            chunk - rows fetched per round trip
+            dict  - yield dictionaries of column name (key) and value (value)
+
+        Returns:
+            generator of rows (tuples, or dictionaries)
+        """
+        logging.debug(query)
+        cursor_class = cursors.SSDictCursor if dict else cursors.SSCursor
+        if self.pool is None:
+            db = self.newConnection()
+        else:
+            db = self.pool.acquire()
+        finished = False
+        try:
+            cursor = db.cursor(cursor_class)
+            cursor.execute(query, args)
+            rows = cursor.fetchmany(chunk)
+            while rows:
+                for row in rows:
+                    yield row
+                rows = cursor.fetchmany(chunk)
+            cursor.close()
+            finished = True
+        finally:
+            if self.pool is None:
+                db.close()
+            elif finished:
+                self.pool.release(db)
+            else:
+                self.pool.discard(db)
+
+    def iterSelect(self, table, cols=None, where_data=None, chunk=1000, dict=False):
+        """
+        Description:
+            Streaming selectRow(): yields matching records as they arrive
+            (see iterSql).
+
+        Parameters:
+            table      - name of table to get data from
+            cols       - names of column(s) to get data from; defaults to all
+            where_data - dictionary containing column name (key) and value (value) of data to match
+            chunk      - rows fetched per round trip
+            dict       - yield dictionaries of column name (key) and value (value)
+
+        Returns:
+            generator of rows (tuples, or dictionaries)
+        """
+        stmt = self.statements.select(table, cols, where_data)
+        return self.iterSql(stmt.sql, stmt.args(where_data=where_data), chunk=chunk, dict=dict)
+
+    def iterAllRows(self, table, chunk=1000, dict=False):
+        """
+        Description:
+            Streaming getAllRows(): yields every record of a table as it
+            arrives (see iterSql).
+
+        Parameters:
+            table - name of table to retrieve data from
+            chunk - rows fetched per round trip
+            dict  - yield dictionaries of column name (key) and value (value)
+
+        Returns:
+            generator of rows (tuples, or dictionaries)
+        """
+        return self.iterSql("select * from %s" % table, chunk=chunk, dict=dict)
+
     def runSql(self, query, debug=0, flat=False):
         """
         Description:
@@ -266,17 +1389,44 @@ class dbase:
             result of query (tuple of tuples)
         """
         logging.debug(query)
-        self.cursor.execute(query)
+        if ddl_regex.match(query):
+            self.invalidateSchema()
+        tables = readTables(query) if self.cache is not None and not self.inTransaction() else None
+        if tables:
+            resp = self.cache.call(self.scope, query, None, self.qualifyTables(tables), lambda: self.executeSql(query))
+        else:
+            resp = self.executeSql(query)
         if flat:
-            return self.flattenResults(self.cursor.fetchall())
-        return self.cursor.fetchall()
+            return self.flattenResults(resp)
+        return resp
+
+    def executeSql(self, query):
+        """ Runs a query for runSql() and returns all of its rows """
+        with self.checkout() as cursor:
+            cursor.execute(query)
+            if cursor.description is None:
+                # no result set: a write, which would otherwise be rolled
+                # back when a pooled connection is returned
+                self.commitWrite(cursor, pooled=True)
+            resp = cursor.fetchall()
+        if self.cache is not None:
+            changed = writeTables(query)
+            if changed is None or changed:
+                self.invalidateCache(changed)
+        return resp
         
-    def resultsToDict(self, table, results):
+    def resultsToDict(self, table, results, column_names=None):
         """
-        Takes a tuple of tuple database query results and builds a python dictionary
+        Takes a tuple of tuple database query results and builds a python dictionary;
+        column_names (from cursor.description) default to the table's columns
         """
+        if column_names is not None:
+            return [dict(zip(column_names, row)) for row in results]
         records = []
         column_names = self.getColumnNames(table)
+        if results and len(results[0]) != len(column_names):
+            # the table changed since its columns were cached
+            column_names = self.getSchema(table, refresh=True).columns
         for row in results:
             row_index = 0
             d = {}
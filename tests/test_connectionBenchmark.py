@@ -0,0 +1,119 @@
+"""
+Description:
+    Tests for connectionBenchmark: the measurement helpers, the stand-in
+    servers' framing and short runs of both benchmark suites.
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+import os
+import sys
+import socket
+import logging
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import connectionBenchmark
+
+logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+
+class FakeController:
+    """ Controller for measure(): answers every call with size bytes """
+
+    def __init__(self, size=3, fail=False):
+        self.size = size
+        self.fail = fail
+        self.calls = 0
+        self.closed = False
+
+    def call(self):
+        self.calls += 1
+        if self.fail and self.calls > 1:
+            raise IOError("gone")
+        return "x" * self.size
+
+    def close(self):
+        self.closed = True
+
+
+class MeasureTest(unittest.TestCase):
+    """ percentile() and measure() """
+
+    def testPercentileNearestRank(self):
+        values = range(1, 11)
+        self.assertEqual(connectionBenchmark.percentile(values, 50), 5)
+        self.assertEqual(connectionBenchmark.percentile(values, 90), 9)
+        self.assertEqual(connectionBenchmark.percentile(values, 99), 10)
+        self.assertEqual(connectionBenchmark.percentile(values, 0), 1)
+        self.assertEqual(connectionBenchmark.percentile([], 50), 0.0)
+
+    def testRequestsSpreadOverControllers(self):
+        controllers = []
+
+        def connect():
+            controllers.append(FakeController())
+            return controllers[-1]
+
+        r = connectionBenchmark.measure("fake", connect, lambda ctl: ctl.call(), concurrency=3, requests=10)
+        self.assertEqual((r["requests"], r["errors"], r["concurrency"]), (10, 0, 3))
+        # one warm-up call each, then 4, 3 and 3
+        self.assertEqual([ctl.calls for ctl in controllers], [5, 4, 4])
+        self.assertTrue(all(ctl.closed for ctl in controllers))
+        self.assertTrue(r["p50_ms"] <= r["p90_ms"] <= r["p99_ms"])
+
+    def testFailedWorkerCounted(self):
+        controllers = [FakeController(), FakeController(fail=True)]
+        r = connectionBenchmark.measure("fake", controllers.pop, lambda ctl: ctl.call(), concurrency=2, requests=4)
+        self.assertEqual((r["requests"], r["errors"]), (2, 1))
+
+
+class FrameReaderTest(unittest.TestCase):
+    """ The stand-in servers' FrameReader """
+
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+        self.reader = connectionBenchmark.FrameReader(self.remote)
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
+    def testLinesAndEom(self):
+        self.local.sendall("one\r\ntwo\n<hello/>]]>]]>")
+        self.assertEqual(self.reader.readLine(), "one")
+        self.assertEqual(self.reader.readLine(), "two")
+        self.assertEqual(self.reader.readEom(), "<hello/>")
+        self.local.close()
+        self.assertEqual(self.reader.readLine(), None)
+
+    def testChunked(self):
+        self.local.sendall("\n#4\n<rpc\n#3\n/>x\n##\n")
+        self.assertEqual(self.reader.readChunked(), "<rpc/>x")
+        self.local.close()
+        self.assertEqual(self.reader.readChunked(), None)
+
+
+class SuiteTest(unittest.TestCase):
+    """ Short runs of the benchmark suites against the stand-ins """
+
+    def testControllers(self):
+        results = connectionBenchmark.benchmarkControllers(concurrency=(2,), payloads=(0, 1000), requests=4)
+        self.assertEqual(sorted(set(r["name"] for r in results)), ["netconf", "socket", "ssh", "telnet"])
+        self.assertEqual(len(results), 8)
+        for r in results:
+            self.assertEqual((r["requests"], r["errors"]), (4, 0), r)
+
+    def testProfiles(self):
+        results = connectionBenchmark.benchmarkProfiles(["default", "low-latency"], size=100000, repeat=1)
+        self.assertEqual([r["profile"] for r in results], ["default", "low-latency"])
+        self.assertTrue(all(r["best_mbps"] > 0 for r in results))
+
+
+if __name__ == "__main__":
+    unittest.main()
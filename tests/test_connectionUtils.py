@@ -0,0 +1,817 @@
+"""
+Description:
+    Behavioural tests for connectionUtils, run against the local stand-in
+    servers in connectionBenchmark.  Run from the repository directory:
+
+        python -m unittest discover -s tests -t .
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import shutil
+import StringIO
+import logging
+import tempfile
+import unittest
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import paramiko
+import connectionUtils
+import connectionBenchmark
+
+# the stand-in servers log every client disconnect as an error
+logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+# the stand-in's reply elements inherit the base namespace
+base_ns = "{urn:ietf:params:xml:ns:netconf:base:1.0}"
+
+
+class NetconfTest(unittest.TestCase):
+    """ NetconfController against the stand-in NETCONF subsystem """
+
+    def setUp(self):
+        connectionUtils.circuit_breaker.clear()
+        self.server = connectionBenchmark.SshServer().start()
+        self.nc = connectionUtils.NetconfController(self.server.host, "test", "test", self.server.port, timeout=10)
+
+    def tearDown(self):
+        self.nc.close()
+        self.server.stop()
+
+    def testIterRpcPath(self):
+        names = [e.findtext(base_ns + "name") for e in self.nc.iterRpc("<get><bench-items>5</bench-items></get>", "data/item")]
+        self.assertEqual(names, ["item-%d" % i for i in range(5)])
+
+    def testIterRpcPredicateSeesCompleteElement(self):
+        op = "<get><bench-items>20</bench-items></get>"
+        # the text of <name> only exists once the element has ended
+        found = [e.text for e in self.nc.iterRpc(op, ("name", lambda e: e.text.endswith("7")))]
+        self.assertEqual(found, ["item-7", "item-17"])
+
+    def testIterRpcPredicateOnChildren(self):
+        op = "<get><bench-items>20</bench-items></get>"
+        found = [e.findtext(base_ns + "name") for e in self.nc.iterRpc(op, ("item", lambda e: e.findtext(base_ns + "name") == "item-3"))]
+        self.assertEqual(found, ["item-3"])
+        # the channel is left at the next message
+        self.assertTrue("item-1" in self.nc.rpc(op))
+
+    def testTimeoutMidMessageKeepsSessionInStep(self):
+        self.nc.ch.settimeout(0.3)
+        rpc = '<rpc message-id="late" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><get>%s</get></rpc>'
+        self.assertEqual(self.nc.run(rpc % "<bench-delay>1</bench-delay>"), "")
+        self.nc.ch.settimeout(10)
+        # the late reply arrives whole, and the next request gets its own reply
+        self.assertTrue(self.nc.read().startswith('<rpc-reply message-id="late"'))
+        self.assertTrue("item-1" in self.nc.rpc("<get><bench-items>2</bench-items></get>"))
+
+    def testTimeoutMidStreamClosesSession(self):
+        self.nc.ch.settimeout(0.3)
+        op = "<get><bench-items>50</bench-items><bench-delay>1</bench-delay></get>"
+        self.assertRaises(socket.timeout, list, self.nc.iterRpc(op, "item"))
+        # part of the reply was consumed, so the session cannot be resynchronised
+        self.assertRaises(IOError, self.nc.rpc, "<get/>")
+
+    def testIterRpcBareCallable(self):
+        op = "<get><bench-items>3</bench-items></get>"
+        found = [e.text for e in self.nc.iterRpc(op, lambda e: (e.text or "").startswith("item-"))]
+        self.assertEqual(found, ["item-0", "item-1", "item-2"])
+
+
+class MuteTelnetServer(connectionBenchmark.TelnetServer):
+    """ Telnet stand-in that never sends a login prompt """
+
+    def login(self, conn, reader):
+        reader.readLine()
+        return False
+
+
+class TelnetTest(unittest.TestCase):
+    """ TelnetController against the telnet stand-in """
+
+    def setUp(self):
+        self.server = connectionBenchmark.TelnetServer().start()
+        self.scheduler = connectionUtils.ConnectScheduler(deadline=3, retries=0, attempt_timeout=1, breaker=None)
+        self.telnet = connectionUtils.TelnetController(self.server.host, "test", "test", self.server.port,
+                                                       timeout=5, prompt=self.server.prompt, scheduler=self.scheduler)
+
+    def tearDown(self):
+        self.telnet.close()
+        self.server.stop()
+
+    def testRunReadsToPrompt(self):
+        self.assertEqual(self.telnet.run("hello"), "hello\r\n" + self.server.prompt)
+        self.assertEqual(len(self.telnet.run("bytes 100000")), 100002 + len(self.server.prompt))
+
+    def testExpectIndexOfMatch(self):
+        self.telnet.hdl.write("bytes 500\n")
+        index, match, text = self.telnet.expect(["no such text", r"x{500}\r\n"])
+        self.assertEqual(index, 1)
+        self.assertEqual(match.group(0), "x" * 500 + "\r\n")
+
+    def testExpectTimeout(self):
+        self.telnet.hdl.write("hello\n")
+        index, match, text = self.telnet.expect("no such text", timeout=0.5)
+        self.assertEqual(index, -1)
+        self.assertEqual(match, None)
+        self.assertEqual(text, "hello\r\n" + self.server.prompt)
+
+    def testNoLoginPromptIsConnectError(self):
+        server = MuteTelnetServer().start()
+        try:
+            self.assertRaises(connectionUtils.ConnectError, connectionUtils.TelnetController, server.host,
+                              "test", "test", server.port, scheduler=self.scheduler)
+        finally:
+            server.stop()
+
+    def testClosedPortIsConnectError(self):
+        self.assertRaises(connectionUtils.ConnectError, connectionUtils.TelnetController, self.server.host,
+                          "test", "test", closedPort(), scheduler=self.scheduler)
+
+
+class RejectingStandIn(connectionBenchmark.SshStandIn):
+    """ Stand-in SSH interface that refuses the password "wrong" """
+
+    def check_auth_password(self, username, password):
+        if password == "wrong":
+            return paramiko.AUTH_FAILED
+        return paramiko.AUTH_SUCCESSFUL
+
+
+class RejectingSshServer(connectionBenchmark.SshServer):
+    interface = RejectingStandIn
+
+
+class TransportProfileTest(unittest.TestCase):
+    """ sshConnect and transport profiles """
+
+    def setUp(self):
+        self.server = RejectingSshServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testProfileApplied(self):
+        hdl = connectionUtils.sshConnect(self.server.host, self.server.port, "test", "test", "low-latency", 5)
+        try:
+            trans = hdl.get_transport()
+            self.assertEqual(trans.default_window_size, 4194304)
+        finally:
+            hdl.close()
+
+    def testUnknownProfile(self):
+        self.assertRaises(ValueError, connectionUtils.sshConnect, self.server.host, self.server.port, "test",
+                          "test", "no-such-profile", 5)
+
+    def testFailedLoginClosesTransport(self):
+        before = threading.active_count()
+        for i in range(3):
+            self.assertRaises(paramiko.AuthenticationException, connectionUtils.sshConnect, self.server.host,
+                              self.server.port, "test", "wrong", "default", 5)
+        # the server side threads go away when the client closes
+        deadline = time.time() + 5
+        while threading.active_count() > before and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(threading.active_count(), before)
+
+
+class SlowSshServer(connectionBenchmark.SshServer):
+    """
+    Description:
+        Stand-in SSH server with two extra commands:
+            slow N   - send "partial", wait N seconds, then send "done"
+            status N - echo the command and exit with status N
+    """
+
+    def execute(self, channel, command):
+        if command.startswith("slow "):
+            try:
+                channel.sendall("partial\n")
+                time.sleep(float(command.split()[1]))
+                channel.sendall("done\n")
+                channel.send_exit_status(0)
+            except Exception:
+                pass
+            finally:
+                channel.shutdown_write()
+            return
+        if command.startswith("status "):
+            channel.sendall(command + "\n")
+            channel.send_exit_status(int(command.split()[1]))
+            channel.shutdown_write()
+            return
+        connectionBenchmark.SshServer.execute(self, channel, command)
+
+
+class StreamTest(unittest.TestCase):
+    """ SshController streaming output """
+
+    def setUp(self):
+        connectionUtils.circuit_breaker.clear()
+        self.server = SlowSshServer().start()
+        self.ssh = connectionUtils.SshController(self.server.host, "test", "test", self.server.port, timeout=10)
+
+    def tearDown(self):
+        self.ssh.close()
+        self.server.stop()
+
+    def testChunksBounded(self):
+        sizes = [len(chunk) for chunk in self.ssh.stream("bytes 200000")]
+        self.assertEqual(sum(sizes), 200000)
+        self.assertTrue(max(sizes) <= 32768)
+
+    def testLines(self):
+        self.assertEqual(list(self.ssh.stream("status 0", lines=True)), ["status 0\n"])
+
+    def testRunToFile(self):
+        out = StringIO.StringIO()
+        self.assertEqual(self.ssh.runToFile("bytes 100000", out), 100000)
+        self.assertEqual(out.getvalue(), "x" * 100000)
+
+    def testTimeoutEndsStream(self):
+        self.assertEqual(list(self.ssh.stream("slow 1.5", timeout=0.5)), ["partial\n"])
+        self.assertTrue(self.ssh.timed_out)
+
+
+class ShellTest(unittest.TestCase):
+    """ Commands over a long-lived shell channel """
+
+    def setUp(self):
+        connectionUtils.circuit_breaker.clear()
+        self.server = connectionBenchmark.SshServer().start()
+        self.ssh = connectionUtils.SshController(self.server.host, "test", "test", self.server.port, timeout=10)
+        self.ssh.openShell("sh")
+
+    def tearDown(self):
+        self.ssh.close()
+        self.server.stop()
+
+    def testStateKeptBetweenCommands(self):
+        self.assertEqual(self.ssh.runShell("cd /tmp; X=5"), "")
+        self.assertEqual(self.ssh.runShell("echo $X; pwd"), "5\n/tmp\n")
+        self.assertEqual(self.ssh.ec, 0)
+        self.assertEqual(self.ssh.runShell("false"), "")
+        self.assertEqual(self.ssh.ec, 1)
+
+    def testBatch(self):
+        results = self.ssh.runBatch(["echo a", "echo b >&2; false", "printf c"])
+        self.assertEqual(results, [("a\n", 0), ("b\n", 1), ("c", 0)])
+
+    def testTimeoutReopensShell(self):
+        self.assertEqual(self.ssh.runShell("echo x; sleep 2", timeout=0.5), "x\n")
+        self.assertEqual(self.ssh.ec, None)
+        self.assertTrue(self.ssh.timed_out)
+        self.assertEqual(self.ssh.shell, None)
+        self.assertEqual(self.ssh.runShell("echo again"), "again\n")
+
+
+class ResultCacheTest(unittest.TestCase):
+    """ SshController.run() through a ResultCache """
+
+    def setUp(self):
+        connectionUtils.circuit_breaker.clear()
+        self.server = SlowSshServer().start()
+        self.cache = connectionUtils.ResultCache()
+        self.ssh = connectionUtils.SshController(self.server.host, "test", "test", self.server.port, timeout=10,
+                                                 cache=self.cache)
+
+    def tearDown(self):
+        self.ssh.close()
+        self.server.stop()
+
+    def testTimedOutOutputNotCached(self):
+        self.assertEqual(self.ssh.run("slow 1.5", timeout=0.5), "partial\n")
+        self.assertTrue(self.ssh.timed_out)
+        self.assertEqual(self.cache.stats()["size"], 0)
+        self.assertEqual(self.ssh.run("slow 1.5", timeout=10), "partial\ndone\n")
+        self.assertFalse(self.ssh.timed_out)
+        self.assertEqual(self.ssh.run("slow 1.5", timeout=10), "partial\ndone\n")
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def testExitStatusRestoredOnHit(self):
+        self.ssh.run("status 3")
+        self.assertEqual(self.ssh.ec, 3)
+        self.ssh.run("status 0")
+        self.assertEqual(self.ssh.ec, 0)
+        self.ssh.run("status 3")
+        self.assertEqual(self.ssh.ec, 3)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.hitRatio(), 1 / 3.0)
+
+
+class FrameReaderTest(unittest.TestCase):
+    """ SocketController framed reads, fed by hand from the peer socket """
+
+    def setUp(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.sock = connectionUtils.SocketController("127.0.0.1", listener.getsockname()[1], timeout=5, echo=False)
+        self.peer = listener.accept()[0]
+        listener.close()
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def send(self, *pieces):
+        for piece in pieces:
+            self.peer.sendall(piece)
+            time.sleep(0.02)
+
+    def testDelimitedAcrossPieces(self):
+        self.send("ab", "c\r", "\nde\r\n")
+        self.assertEqual(self.sock.readDelimited("\r\n"), "abc\r\n")
+        self.assertEqual(self.sock.readDelimited("\r\n"), "de\r\n")
+
+    def testPrefixedAndExact(self):
+        frame = struct.pack("!I", 5) + "hello"
+        self.send(frame[:2], frame[2:7], frame[7:] + struct.pack("!H", 2) + "hiXYZ")
+        self.assertEqual(self.sock.readPrefixed(), "hello")
+        self.assertEqual(self.sock.readPrefixed("!H"), "hi")
+        self.assertEqual(self.sock.readExactly(3), "XYZ")
+
+    def testFrameLargerThanBuffer(self):
+        self.send("x" * 100000 + "\n" + "tail\n")
+        self.assertEqual(self.sock.readDelimited(), "x" * 100000 + "\n")
+        self.assertEqual(self.sock.readDelimited(), "tail\n")
+        self.assertTrue(len(self.sock.rbuf) >= 100001)
+
+    def testTimeoutKeepsPartialFrame(self):
+        self.send("par")
+        self.assertRaises(socket.timeout, self.sock.readDelimited, "\n", 0.2)
+        self.send("t\n")
+        self.assertEqual(self.sock.readDelimited(), "part\n")
+
+    def testReadMatch(self):
+        self.send("line one\r\n", '0, "ok"\r\nrest')
+        self.assertEqual(self.sock.readUntil(), 'line one\r\n0, "ok"')
+        self.assertEqual(self.sock.read(0.1), "\r\nrest")
+
+    def testDisconnect(self):
+        self.send("no end")
+        self.peer.close()
+        self.assertRaises(IOError, self.sock.readDelimited)
+
+
+class FutureTest(unittest.TestCase):
+    """ Future completion and callbacks """
+
+    def testCallbacksAddedWhileFinishingAllRun(self):
+        for i in range(200):
+            future = connectionUtils.Future()
+            ran = []
+            start = threading.Event()
+
+            def add():
+                start.wait()
+                for j in range(20):
+                    future.addCallback(lambda f: ran.append(f.value))
+            threads = [threading.Thread(target=add) for t in range(4)]
+            for t in threads:
+                t.start()
+            start.set()
+            future.setResult(i)
+            for t in threads:
+                t.join()
+            self.assertEqual(ran, [i] * 80)
+
+    def testThenChain(self):
+        future = connectionUtils.Future()
+        chained = future.then(lambda v: v + 1).then(lambda v: connectionUtils.Future())
+        inner = future.then(lambda v: v * 10)
+        future.setResult(1)
+        self.assertEqual(inner.result(1), 10)
+        self.assertFalse(chained.done())
+
+    def testFirstCompletionWins(self):
+        future = connectionUtils.Future()
+        future.setResult("first")
+        future.setException(IOError("late"))
+        future.setResult("second")
+        self.assertEqual(future.result(0), "first")
+
+    def testExceptionPassedAlong(self):
+        future = connectionUtils.Future()
+        chained = future.then(lambda v: v)
+        future.setException(IOError("boom"))
+        self.assertRaises(IOError, chained.result, 1)
+
+
+class PollerTest(unittest.TestCase):
+    """ Poller over a pipe, with the native implementation and with select() """
+
+    def setUp(self):
+        self.r, self.w = os.pipe()
+
+    def tearDown(self):
+        os.close(self.r)
+        os.close(self.w)
+
+    def check(self, poller):
+        poller.register(self.r)
+        self.assertEqual(poller.poll(0), [])
+        os.write(self.w, "x")
+        self.assertEqual(poller.poll(1), [(self.r, True, False, False)])
+        poller.register(self.w, readable=False, writable=True)
+        self.assertEqual(sorted(poller.poll(1)), [(self.r, True, False, False), (self.w, False, True, False)])
+        poller.modify(self.w, readable=False, writable=False)
+        poller.unregister(self.r)
+        self.assertEqual(poller.poll(0), [])
+
+    def testNative(self):
+        self.check(connectionUtils.Poller())
+
+    def testSelect(self):
+        poller = connectionUtils.Poller()
+        poller.impl = None
+        self.check(poller)
+
+
+class SocketEngineTest(unittest.TestCase):
+    """ Many AsyncSocketControllers on one engine thread """
+
+    def setUp(self):
+        self.server = connectionBenchmark.LineServer().start()
+        self.engine = connectionUtils.SocketEngine(interval=0.1)
+        self.engine.start()
+
+    def tearDown(self):
+        self.engine.stop()
+        self.server.stop()
+
+    def connect(self, host=None, port=None, **kwargs):
+        return connectionUtils.AsyncSocketController(host or self.server.host, port or self.server.port, timeout=5,
+                                                     echo=False, engine=self.engine, **kwargs)
+
+    def testManyConnections(self):
+        conns = [self.connect() for i in range(20)]
+        futures = [conn.run("hello %d" % i) for i, conn in enumerate(conns)]
+        self.assertEqual([f.result(5) for f in futures], ["hello %d\r\n" % i for i in range(20)])
+        self.assertEqual(len(self.engine.conns), 20)
+        for conn in conns:
+            conn.close()
+        self.assertEqual(self.engine.conns, {})
+
+    def testPipelinedRequestsInOrder(self):
+        conn = self.connect()
+        futures = [conn.run("bytes %d" % n) for n in (100000, 1, 10)]
+        self.assertEqual([len(f.result(5)) for f in futures], [100002, 3, 12])
+
+    def testUnrequestedFramesToCallback(self):
+        frames = []
+        conn = self.connect(callback=lambda c, frame: frames.append(frame))
+        conn.write("one")
+        conn.write("two")
+        deadline = time.time() + 5
+        while len(frames) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(frames, ["one\r\n", "two\r\n"])
+
+    def testRequestTimeoutFailsConnection(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        try:
+            conn = self.connect("127.0.0.1", listener.getsockname()[1])
+            future = conn.run("hello", 0.3)
+            self.assertTrue(isinstance(future.exception(5), socket.timeout))
+            self.assertEqual(conn.hdl, None)
+        finally:
+            listener.close()
+
+    def testRefusedConnectionFailsRequests(self):
+        conn = self.connect("127.0.0.1", closedPort())
+        # refused at once by connect_ex(), or later when the engine sees it
+        try:
+            error = conn.run("hello").exception(5)
+        except IOError, error:
+            pass
+        self.assertTrue(isinstance(error, IOError))
+        self.assertEqual(conn.hdl, None)
+
+
+class AsyncControllerTest(unittest.TestCase):
+    """ Engine-driven controllers against the stand-in SSH server """
+
+    def setUp(self):
+        connectionUtils.circuit_breaker.clear()
+        self.server = connectionBenchmark.SshServer().start()
+        self.engine = connectionUtils.SocketEngine(interval=0.05)
+        self.engine.start()
+
+    def tearDown(self):
+        self.engine.stop()
+        self.server.stop()
+
+    def testAsyncNetconfRpc(self):
+        nc = connectionUtils.AsyncNetconfController(self.server.host, "test", "test", self.server.port, 10,
+                                                   self.engine)
+        try:
+            self.assertTrue(nc.engine is self.engine)
+            self.assertEqual(nc.framing, "1.1")
+            reply = nc.rpc("<get><bench-items>2</bench-items></get>").result(10)
+            self.assertTrue("item-1" in reply)
+        finally:
+            nc.close()
+
+    def testAsyncNetconfLargeRpcs(self):
+        nc = connectionUtils.AsyncNetconfController(self.server.host, "test", "test", self.server.port,
+                                                   engine=self.engine)
+        try:
+            # several MB of queued writes: more than one channel window
+            filler = "<filter>%s</filter>" % ("y" * 1048576)
+            futures = nc.rpcBatch(["<get>%s<bench-bytes>%d</bench-bytes></get>" % (filler, i) for i in range(4)])
+            for i, future in enumerate(futures):
+                self.assertTrue(("x" * i + "</data>") in future.result(30))
+        finally:
+            nc.close()
+
+    def testAsyncSshPositionalEngine(self):
+        ssh = connectionUtils.AsyncSshController(self.server.host, "test", "test", self.server.port, 10, None,
+                                                self.engine)
+        try:
+            self.assertTrue(ssh.engine is self.engine)
+            self.assertEqual(ssh.run("hello").result(10), "hello\n")
+        finally:
+            ssh.close()
+
+
+def closedPort():
+    """ A local port with nothing listening on it """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ConnectSchedulerTest(unittest.TestCase):
+    """ Circuit breaker keying and pool exhaustion """
+
+    def setUp(self):
+        self.server = connectionBenchmark.SshServer().start()
+        self.breaker = connectionUtils.CircuitBreaker(threshold=2, reset=60)
+        self.scheduler = connectionUtils.ConnectScheduler(deadline=2, retries=0, backoff=0, attempt_timeout=1,
+                                                          breaker=self.breaker)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def connect(self, port, pool=None, timeout=10):
+        return connectionUtils.SshController(self.server.host, "test", "test", port, timeout=timeout, pool=pool,
+                                             scheduler=self.scheduler)
+
+    def testBreakerKeyedOnPort(self):
+        port = closedPort()
+        for i in range(2):
+            self.assertRaises(connectionUtils.ConnectError, self.connect, port)
+        self.assertRaises(connectionUtils.CircuitOpenError, self.connect, port)
+        self.assertEqual(self.breaker.state(self.server.host, port), "open")
+        # the same host on another port is unaffected
+        ssh = self.connect(self.server.port)
+        try:
+            self.assertEqual(ssh.run("hello"), "hello\n")
+        finally:
+            ssh.close()
+        self.assertEqual(self.breaker.state(self.server.host, self.server.port), "closed")
+        self.breaker.clear(self.server.host)
+        self.assertEqual(self.breaker.state(self.server.host, port), "closed")
+
+    def testPoolExhaustionNotAHostFailure(self):
+        pool = connectionUtils.SshPool(max_per_host=1)
+        first = self.connect(self.server.port, pool)
+        try:
+            for i in range(3):
+                start = time.time()
+                self.assertRaises(connectionUtils.PoolExhaustedError, self.connect, self.server.port, pool, 1)
+                # one slot wait, bounded by the command timeout, never retried
+                self.assertTrue(time.time() - start < 1.5)
+            self.assertEqual(self.breaker.state(self.server.host, self.server.port), "closed")
+        finally:
+            first.close()
+        second = self.connect(self.server.port, pool)
+        try:
+            self.assertEqual(second.run("hello"), "hello\n")
+        finally:
+            second.close()
+            pool.closeAll()
+
+    def testSlotWaitOutlastsAttemptTimeout(self):
+        pool = connectionUtils.SshPool(max_per_host=1)
+        first = self.connect(self.server.port, pool)
+        timer = threading.Timer(1.5, first.close)
+        timer.start()
+        try:
+            start = time.time()
+            second = self.connect(self.server.port, pool)
+            self.assertTrue(time.time() - start >= 1.4)
+            self.assertEqual(second.run("hello"), "hello\n")
+            second.close()
+        finally:
+            timer.join()
+            pool.closeAll()
+
+
+class SshPoolTest(unittest.TestCase):
+    """ SshPool reuse and eviction """
+
+    def setUp(self):
+        self.server = connectionBenchmark.SshServer().start()
+        self.pool = connectionUtils.SshPool(ttl=0.5, max_per_host=2)
+
+    def tearDown(self):
+        self.pool.closeAll()
+        self.server.stop()
+
+    def acquire(self):
+        return self.pool.acquire(self.server.host, "test", "test", self.server.port, 1, connect_timeout=5)
+
+    def testReleasedConnectionReused(self):
+        first = self.acquire()
+        self.pool.release(first)
+        self.assertTrue(self.acquire() is first)
+
+    def testDeadConnectionReplaced(self):
+        first = self.acquire()
+        self.pool.release(first)
+        first.close()
+        second = self.acquire()
+        self.assertFalse(second is first)
+        self.assertTrue(second.get_transport().is_active())
+
+    def testCapCountsEveryUserAndProfile(self):
+        self.pool.max_per_host = 1
+        first = self.acquire()
+        self.assertRaises(connectionUtils.PoolExhaustedError, self.pool.acquire, self.server.host, "other", "test",
+                          self.server.port, 0.3, "low-latency", 5)
+        self.pool.release(first)
+        # the idle connection of the other key makes room
+        second = self.pool.acquire(self.server.host, "other", "test", self.server.port, 0.3, "low-latency", 5)
+        self.assertFalse(first.get_transport() and first.get_transport().is_active())
+        self.pool.release(second)
+
+    def testIdleConnectionEvicted(self):
+        first = self.acquire()
+        self.pool.release(first)
+        time.sleep(0.7)
+        self.assertFalse(self.acquire() is first)
+        self.assertFalse(first.get_transport() and first.get_transport().is_active())
+
+
+class BrokerTest(unittest.TestCase):
+    """ SshController through a spawned SshBroker """
+
+    def setUp(self):
+        connectionUtils.circuit_breaker.clear()
+        self.server = RejectingSshServer().start()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "broker.sock")
+        self.proc = connectionUtils.spawnBroker(self.path)
+
+    def tearDown(self):
+        self.proc.terminate()
+        self.proc.join()
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def testRunThroughBroker(self):
+        # spawnBroker returned, so the first connect must not be refused
+        ssh = connectionUtils.SshController(self.server.host, "test", "test", self.server.port, timeout=10,
+                                            broker=self.path)
+        try:
+            self.assertEqual(ssh.run("hello"), "hello\n")
+        finally:
+            ssh.close()
+
+    def testAuthFailureComesBackAsAuthFailure(self):
+        try:
+            connectionUtils.SshController(self.server.host, "test", "wrong", self.server.port, timeout=10,
+                                          broker=self.path)
+            self.fail("login with a wrong password succeeded")
+        except connectionUtils.ConnectError, msg:
+            self.assertTrue(isinstance(msg.cause, paramiko.AuthenticationException))
+        self.assertEqual(connectionUtils.circuit_breaker.failures, {})
+
+    def testBrokerFailureNotRetriedByWorker(self):
+        port = closedPort()
+        self.assertRaises(connectionUtils.ConnectError, connectionUtils.SshController, self.server.host, "test",
+                          "test", port, timeout=10, broker=self.path)
+        # the broker retried; the worker made one attempt and counted nothing
+        self.assertEqual(connectionUtils.circuit_breaker.failures, {})
+
+    def testProbeChannelClosed(self):
+        opened = []
+
+        class RecordingTransport(connectionUtils.BrokerTransport):
+            def open_session(self, *args, **kwargs):
+                chan = connectionUtils.BrokerTransport.open_session(self, *args, **kwargs)
+                opened.append(chan)
+                return chan
+
+        RecordingTransport(self.path, self.server.host, self.server.port, "test", "test", timeout=10).close()
+        self.assertEqual(len(opened), 1)
+        # a closed socket object refuses every call
+        self.assertRaises(socket.error, opened[0].sock.fileno)
+
+
+class FanOutTest(unittest.TestCase):
+    """ SshFanOut across two stand-in hosts and a closed one """
+
+    def setUp(self):
+        self.first = SlowSshServer().start()
+        # a second loopback address, so the hosts differ but share the port
+        self.second = SlowSshServer("127.0.0.2", self.first.port).start()
+        scheduler = connectionUtils.ConnectScheduler(deadline=5, retries=0, attempt_timeout=2, breaker=None)
+        self.fanout = connectionUtils.SshFanOut(["127.0.0.1", "127.0.0.2", "127.0.0.3"], "test", "test",
+                                                self.first.port, timeout=10, scheduler=scheduler)
+
+    def tearDown(self):
+        self.first.stop()
+        self.second.stop()
+
+    def testResultsInOrderOfCompletion(self):
+        results = list(self.fanout.iterRun({"127.0.0.1": "slow 1", "127.0.0.2": "status 0"}))
+        self.assertEqual([r.host for r in results], ["127.0.0.2", "127.0.0.1"])
+        self.assertEqual(results[0].output, "status 0\n")
+        self.assertEqual(results[1].output, "partial\ndone\n")
+        self.assertTrue(results[0].ok() and results[1].ok())
+
+    def testFailedHostReported(self):
+        results = self.fanout.run("status 0")
+        self.assertEqual(sorted(results), ["127.0.0.1", "127.0.0.2", "127.0.0.3"])
+        failed = results["127.0.0.3"]
+        self.assertFalse(failed.ok())
+        self.assertEqual(failed.output, None)
+        self.assertTrue(failed.error)
+        self.assertTrue(results["127.0.0.1"].ok() and results["127.0.0.2"].ok())
+
+
+class RecordingTransferManager(connectionUtils.TransferManager):
+    """ TransferManager that records transfers instead of connecting """
+
+    def transfer(self, host, src, dst, push):
+        return (host, src, dst, push)
+
+
+class SlowTransferManager(connectionUtils.TransferManager):
+    """ TransferManager whose transfers hold a pooled connection for a while """
+
+    active = 0
+    most = 0
+
+    def transfer(self, host, src, dst, push):
+        ssh = connectionUtils.SshController(host, self.user, self.password, self.port, self.timeout, self.pool,
+                                            scheduler=self.scheduler)
+        try:
+            self.lock.acquire()
+            self.active += 1
+            self.most = max(self.most, self.active)
+            self.lock.release()
+            time.sleep(0.6)
+            return ssh.run("hello")
+        finally:
+            self.lock.acquire()
+            self.active -= 1
+            self.lock.release()
+            ssh.close()
+
+
+class TransferManagerTest(unittest.TestCase):
+    """ Transfer task expansion """
+
+    def testPullDestinationWithPercent(self):
+        mgr = RecordingTransferManager(["a", "b"], "test", "test")
+        results = sorted(mgr.pull([("/var/log/x", "/tmp/100%/%(host)s-x"), ("/etc/motd", "/tmp/%d/motd")]))
+        self.assertEqual(results, [("a", "/etc/motd", "/tmp/%d/motd", False),
+                                   ("a", "/var/log/x", "/tmp/100%/a-x", False),
+                                   ("b", "/etc/motd", "/tmp/%d/motd", False),
+                                   ("b", "/var/log/x", "/tmp/100%/b-x", False)])
+
+    def testMoreFilesThanSlots(self):
+        server = connectionBenchmark.SshServer().start()
+        scheduler = connectionUtils.ConnectScheduler(attempt_timeout=0.5, breaker=None)
+        mgr = SlowTransferManager([server.host], "test", "test", server.port, timeout=10, per_host=2,
+                                  scheduler=scheduler)
+        try:
+            # each transfer outlasts the attempt timeout; queued files wait their turn
+            results = mgr.push([("/src/%d" % i, "/dst/%d" % i) for i in range(6)])
+        finally:
+            mgr.close()
+            server.stop()
+        self.assertEqual(results, ["hello\n"] * 6)
+        self.assertEqual(mgr.most, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
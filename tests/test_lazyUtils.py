@@ -0,0 +1,126 @@
+"""
+Description:
+    Tests for lazyUtils, using throwaway modules written to a temporary
+    directory, and for the import cost of the package itself.
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lazyUtils
+import importBenchmark
+
+
+class LazyTest(unittest.TestCase):
+    """ Base class: a temporary directory on sys.path for throwaway modules """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        sys.path.insert(0, self.dir)
+        self.names = []
+
+    def tearDown(self):
+        sys.path.remove(self.dir)
+        for name in list(sys.modules):
+            if name.split(".")[0] in self.names:
+                del sys.modules[name]
+        shutil.rmtree(self.dir)
+
+    def write(self, path, text):
+        """ Write a module (path relative to the temporary directory) """
+        path = os.path.join(self.dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").write(text)
+        self.names.append(os.path.relpath(path, self.dir).split(os.sep)[0].replace(".py", ""))
+
+
+class LazyImportTest(LazyTest):
+    """ LazyImport """
+
+    def testImportedOnFirstUse(self):
+        self.write("lazy_probe.py", "value = 1\n")
+        module = lazyUtils.LazyImport("lazy_probe")
+        self.assertFalse("lazy_probe" in sys.modules)
+        self.assertFalse(lazyUtils.isLoaded(module))
+        self.assertEqual(repr(module), "<lazy module 'lazy_probe' (not loaded)>")
+        self.assertEqual(module.value, 1)
+        self.assertTrue(lazyUtils.isLoaded(module))
+        self.assertEqual(repr(module), "<lazy module 'lazy_probe' (loaded)>")
+
+    def testAttributesSetOnModule(self):
+        self.write("lazy_probe.py", "value = 1\n")
+        module = lazyUtils.LazyImport("lazy_probe")
+        module.value = 2
+        self.assertEqual(sys.modules["lazy_probe"].value, 2)
+
+    def testMissingModuleFailsOnUse(self):
+        module = lazyUtils.LazyImport("lazy_probe_missing")
+        self.assertRaises(ImportError, getattr, module, "value")
+        self.assertFalse(lazyUtils.isLoaded(module))
+
+    def testRealModuleIsLoaded(self):
+        self.assertTrue(lazyUtils.isLoaded(os))
+
+
+class LazyPackageTest(LazyTest):
+    """ LazyPackage, installed by a package's __init__.py """
+
+    def setUp(self):
+        LazyTest.setUp(self)
+        self.write("lazy_pkg/__init__.py", "import lazyUtils\n"
+                                           "__all__ = ['sub']\n"
+                                           "def helper():\n"
+                                           "    return __all__\n"
+                                           "lazyUtils.lazyPackage(__name__, __all__)\n")
+        self.write("lazy_pkg/sub.py", "value = 1\n")
+
+    def testSubmoduleImportedOnFirstUse(self):
+        import lazy_pkg
+        self.assertTrue(isinstance(lazy_pkg, lazyUtils.LazyPackage))
+        self.assertFalse("lazy_pkg.sub" in sys.modules)
+        self.assertTrue("sub" in dir(lazy_pkg))
+        self.assertEqual(lazy_pkg.sub.value, 1)
+        self.assertTrue("lazy_pkg.sub" in sys.modules)
+
+    def testUnknownAttribute(self):
+        import lazy_pkg
+        self.assertRaises(AttributeError, getattr, lazy_pkg, "other")
+
+    def testPackageFunctionsKeepTheirGlobals(self):
+        import lazy_pkg
+        self.assertEqual(lazy_pkg.helper(), ["sub"])
+
+
+class ImportCostTest(unittest.TestCase):
+    """ Heavy modules stay unimported until used (each in a fresh interpreter) """
+
+    def heavy(self, statement):
+        result = importBenchmark.measure(statement, repeat=1)
+        self.assertFalse("error" in result, result)
+        return result["heavy"]
+
+    def testModulesImportNothingHeavy(self):
+        self.assertEqual(self.heavy("import connectionUtils, mySqlUtils"), [])
+
+    def testPackageImportsNothingHeavy(self):
+        package = os.path.basename(os.path.dirname(os.path.abspath(importBenchmark.__file__)))
+        self.assertEqual(self.heavy("import %s; %s.connectionUtils.SshController" % (package, package)), [])
+
+    def testHeavyModuleImportedOnUse(self):
+        self.assertEqual(self.heavy("import connectionUtils; connectionUtils.paramiko.Transport"), ["paramiko"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Description:
+    Tests for metricsUtils and the controller instrumentation, run against
+    the local stand-in servers in connectionBenchmark.
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+import os
+import re
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metricsUtils
+import connectionUtils
+import connectionBenchmark
+
+logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+
+def recordedOps(registry):
+    """ Returns the sorted op labels of the command_seconds histograms """
+    return sorted(h["labels"]["op"] for h in registry.snapshot()["histograms"] if h["name"] == "command_seconds")
+
+
+class MetricsTest(unittest.TestCase):
+    """ Metrics registry """
+
+    def testCommandLabelOffByDefault(self):
+        registry = metricsUtils.Metrics()
+        metricsUtils.CommandTimer(registry, "ssh", "h", "run", "show version").done()
+        labels = registry.snapshot()["histograms"][0]["labels"]
+        self.assertFalse("command" in labels)
+
+    def testCommandLabelWhenEnabled(self):
+        registry = metricsUtils.Metrics(per_command=True)
+        metricsUtils.CommandTimer(registry, "ssh", "h", "run", "show version\nmore").done()
+        self.assertEqual(registry.snapshot()["histograms"][0]["labels"]["command"], "show version")
+
+
+class InstrumentationTest(unittest.TestCase):
+    """ Standalone reads and writes are recorded, nested ones are not """
+
+    def setUp(self):
+        connectionUtils.circuit_breaker.clear()
+        self.saved = metricsUtils.metrics
+        self.registry = metricsUtils.Metrics()
+        metricsUtils.setMetrics(self.registry)
+        self.servers = []
+
+    def tearDown(self):
+        metricsUtils.setMetrics(self.saved)
+        for server in self.servers:
+            server.stop()
+
+    def start(self, server):
+        self.servers.append(server.start())
+        return server
+
+    def testSocketWriteAndReadUntil(self):
+        server = self.start(connectionBenchmark.PromptServer())
+        ctl = connectionUtils.SocketController(server.host, server.port, echo=False)
+        try:
+            ctl.write("hello")
+            self.assertTrue("hello" in ctl.readUntil())
+            self.assertEqual(recordedOps(self.registry), ["read", "write"])
+            self.registry.reset()
+            ctl.run("again")
+            self.assertEqual(recordedOps(self.registry), ["run"])
+        finally:
+            ctl.close()
+
+    def testSshWriteAndRead(self):
+        server = self.start(connectionBenchmark.SshServer())
+        ssh = connectionUtils.SshController(server.host, "test", "test", server.port, timeout=10)
+        try:
+            chan = ssh.trans.open_session()
+            ssh.write("hello", chan)
+            self.assertEqual(ssh.read(chan), "hello\n")
+            self.assertEqual(recordedOps(self.registry), ["read", "write"])
+            self.registry.reset()
+            ssh.run("again")
+            self.assertEqual(recordedOps(self.registry), ["run"])
+        finally:
+            ssh.close()
+
+    def testNetconfWriteAndRead(self):
+        server = self.start(connectionBenchmark.SshServer())
+        nc = connectionUtils.NetconfController(server.host, "test", "test", server.port, timeout=10)
+        try:
+            self.registry.reset()
+            nc.write('<rpc message-id="x"><get/></rpc>')
+            self.assertTrue('message-id="x"' in nc.read())
+            self.assertEqual(recordedOps(self.registry), ["read", "write"])
+            self.registry.reset()
+            nc.rpc("<get/>")
+            self.assertEqual(recordedOps(self.registry), ["rpc"])
+        finally:
+            nc.close()
+
+    def testTelnetExpect(self):
+        server = self.start(connectionBenchmark.TelnetServer())
+        ctl = connectionUtils.TelnetController(server.host, "test", "test", server.port, timeout=10,
+                                               prompt=server.prompt)
+        try:
+            self.registry.reset()
+            ctl.hdl.write("hello\n")
+            index, match, text = ctl.expect(re.escape(server.prompt))
+            self.assertEqual(index, 0)
+            self.assertEqual(recordedOps(self.registry), ["read"])
+        finally:
+            ctl.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
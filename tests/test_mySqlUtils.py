@@ -0,0 +1,530 @@
+"""
+Description:
+    Tests for mySqlUtils, run against StandInMySQLdb: an in-memory stand-in
+    for the MySQLdb module that keeps a few tables and records every
+    statement, commit and rollback.  Run from the repository directory:
+
+        python -m unittest discover -s tests -t .
+
+Author:
+    David Slusser
+
+Revision:
+    0.0.1
+"""
+
+import os
+import re
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mySqlUtils
+
+
+class StandInError(Exception):
+    pass
+
+
+class StandInOperationalError(StandInError):
+    pass
+
+
+class StandInProgrammingError(StandInError):
+    pass
+
+
+def literal(value):
+    """ Returns value as an SQL literal, as MySQLdb escapes it """
+    if value is None:
+        return "NULL"
+    if isinstance(value, basestring):
+        return "'%s'" % value.replace("\\", "\\\\").replace("'", "\\'")
+    return str(value)
+
+
+class StandInCursor:
+    """ Cursor of a StandInConnection """
+
+    def __init__(self, connection, cursor_class=None):
+        self.connection = connection
+        self.cursor_class = cursor_class
+        self.description = None
+        self.lastrowid = 0
+        self.rows = []
+
+    def execute(self, query, args=None):
+        server = self.connection.server
+        sent = query
+        if args is not None:
+            # like MySQLdb: the query is %-formatted whenever args are passed
+            try:
+                sent = query % tuple(literal(a) for a in args)
+            except (TypeError, ValueError), e:
+                raise StandInProgrammingError(str(e))
+        args = tuple(args or ())
+        self.connection.log.append(("execute", sent, args))
+        self.description, self.rows = None, []
+        prepared = self.connection.prepared
+        m = re.match(r"PREPARE (\w+) FROM %s$", query)
+        if m:
+            prepared[m.group(1)] = args[0].replace("%", "%%").replace("?", "%s")
+            return
+        m = re.match(r"DEALLOCATE PREPARE (\w+)$", query)
+        if m:
+            del prepared[m.group(1)]
+            return
+        if query.startswith("SET "):
+            self.connection.variables.update(zip(re.findall(r"(@\w+)=%s", query), args))
+            return
+        m = re.match(r"EXECUTE (\w+)(?: USING (.*))?$", query)
+        if m:
+            names = m.group(2).split(", ") if m.group(2) else []
+            return self.execute(prepared[m.group(1)], [self.connection.variables[n] for n in names])
+        if query == "SELECT @@auto_increment_increment":
+            self.description, self.rows = [(query[7:],)], [(server.increment,)]
+            return
+        if query.startswith(mySqlUtils.table_stats_sql):
+            tables = args[1:] or sorted(server.stats)
+            self.rows = [server.stats[t] for t in tables if args[0] == "test" and t in server.stats]
+            return
+        if query == mySqlUtils.index_stats_sql:
+            self.rows = list(server.indexes.get(args[1], ())) if args[0] == "test" else []
+            return
+        m = re.match(r"SELECT COUNT\(\*\) FROM `?(\w+)`?$", query)
+        if m:
+            self.rows = [(len(server.rows.get(m.group(1), [])),)]
+            return
+        m = re.match(r"DESCRIBE `?(\w+)`?$", query)
+        if m:
+            self.description = [("Field",), ("Type",), ("Null",), ("Key",), ("Default",), ("Extra",)]
+            self.rows = [(c, "varchar(64)", "YES", "PRI" if c == "id" else "", None,
+                          "auto_increment" if c == "id" else "") for c in server.tables[m.group(1)]]
+            return
+        m = re.match(r"INSERT INTO `(\w+)` \(([^)]*)\) VALUES ", query)
+        if m:
+            columns = [c.strip(" `") for c in m.group(2).split(",")]
+            table = server.tables[m.group(1)]
+            self.lastrowid = server.next_id
+            for i in range(0, len(args), len(columns)):
+                row = dict(id=server.next_id)
+                row.update(zip(columns, args[i:i + len(columns)]))
+                server.rows.setdefault(m.group(1), []).append(tuple(row.get(c) for c in table))
+                if row["id"] == server.next_id:
+                    server.next_id += server.increment
+            return
+        m = re.match(r"SELECT (.*) FROM `?(\w+)`?(?: WHERE `(\w+)`=%s)?$", query)
+        if m:
+            table = server.tables[m.group(2)]
+            names = table if m.group(1) == "*" else [c.strip(" `") for c in m.group(1).split(",")]
+            self.description = [(name,) for name in names]
+            for row in server.rows.get(m.group(2), []):
+                row = dict(zip(table, row))
+                if m.group(3) is None or row[m.group(3)] == args[0]:
+                    self.rows.append(tuple(row[name] for name in names))
+
+    def fetchall(self):
+        rows, self.rows = tuple(self.rows), []
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size):
+        self.connection.log.append(("fetchmany", size))
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        if self.cursor_class is StandInCursors.SSDictCursor:
+            return tuple(dict(zip([d[0] for d in self.description], row)) for row in rows)
+        return tuple(rows)
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    """ Connection to a StandInServer """
+
+    def __init__(self, server):
+        self.server = server
+        self.log = server.log
+        self.prepared = {}
+        self.variables = {}
+        self.closed = False
+
+    def cursor(self, cursor_class=None):
+        return StandInCursor(self, cursor_class)
+
+    def commit(self):
+        self.log.append(("commit",))
+
+    def rollback(self):
+        self.log.append(("rollback",))
+
+    def ping(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class StandInServer:
+    """ The tables (name -> column list) and rows every connection shares """
+
+    def __init__(self):
+        self.tables = {"hosts": ["id", "name", "site"], "events": ["id", "ts"]}
+        self.rows = {}
+        self.next_id = 1
+        self.increment = 1
+        self.log = []
+        # information_schema: table_stats_sql rows of database "test", and
+        # index_stats_sql rows (in order) of its tables
+        self.stats = {
+            "hosts": ("hosts", "InnoDB", 900, 100, 98304, 32768, 0, 1001, None, None),
+            "events": ("events", "MyISAM", 0, 0, None, None, None, None, None, None),
+        }
+        self.indexes = {
+            "hosts": [("PRIMARY", 1, "id", 0, 900, "BTREE"),
+                      ("site_name", 1, "site", 1, 3, "BTREE"),
+                      ("site_name", 2, "name", 1, 850, "BTREE")],
+        }
+        self.connections = []
+
+
+class StandInMySQLdb:
+    """ Takes the place of the MySQLdb module for the duration of a test """
+
+    Error = StandInError
+    OperationalError = StandInOperationalError
+    ProgrammingError = StandInProgrammingError
+    server = None
+
+    @classmethod
+    def connect(cls, **kwargs):
+        cls.server.connections.append(StandInConnection(cls.server))
+        return cls.server.connections[-1]
+
+
+class StandInCursors:
+    """ Takes the place of the MySQLdb.cursors module """
+
+    class SSCursor:
+        pass
+
+    class SSDictCursor:
+        pass
+
+
+class DbaseTest(unittest.TestCase):
+    """ Base class: swaps StandInMySQLdb in for MySQLdb """
+
+    def setUp(self):
+        self.saved = mySqlUtils.MySQLdb, mySqlUtils.cursors
+        StandInMySQLdb.server = self.server = StandInServer()
+        mySqlUtils.MySQLdb, mySqlUtils.cursors = StandInMySQLdb, StandInCursors
+
+    def tearDown(self):
+        mySqlUtils.MySQLdb, mySqlUtils.cursors = self.saved
+
+    def commits(self):
+        return self.server.log.count(("commit",))
+
+
+class CommitTest(DbaseTest):
+    """ Which writes commit, in single-connection and pooled mode """
+
+    def testSingleConnectionLeavesDeleteToCaller(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd")
+        db.deleteRow("hosts", {"site": "a"})
+        db.runSql("DELETE FROM hosts")
+        self.assertEqual(self.commits(), 0)
+        db.updateRow("hosts", {"site": "b"}, {"name": "x"})
+        self.assertEqual(self.commits(), 1)
+
+    def testPooledCommitsEveryWrite(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd",
+                              pool=mySqlUtils.DbPool("test", "localhost", "user", "passwd"))
+        db.deleteRow("hosts", {"site": "a"})
+        db.runSql("DELETE FROM hosts")
+        db.updateRow("hosts", {"site": "b"}, {"name": "x"})
+        self.assertEqual(self.commits(), 3)
+
+    def testTransactionCommitsOnce(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd",
+                              pool=mySqlUtils.DbPool("test", "localhost", "user", "passwd"))
+        with db.transaction():
+            db.insertRow("hosts", {"name": "x", "site": "a"})
+            db.updateRow("hosts", {"site": "b"}, {"name": "x"})
+            db.deleteRow("hosts", {"site": "a"})
+            self.assertEqual(self.commits(), 0)
+        self.assertEqual(self.commits(), 1)
+        self.assertFalse(db.inTransaction())
+
+    def testTransactionRollsBack(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd")
+        try:
+            with db.transaction():
+                db.insertRow("hosts", {"name": "x", "site": "a"})
+                raise KeyError("stop")
+        except KeyError:
+            pass
+        self.assertEqual(self.commits(), 0)
+        self.assertEqual(self.server.log[-1], ("rollback",))
+
+
+class PoolTest(DbaseTest):
+    """ Threads sharing a dbase through a DbPool """
+
+    def testThreadsGetTheirOwnConnections(self):
+        pool = mySqlUtils.DbPool("test", "localhost", "user", "passwd", min_size=0, max_size=4, timeout=5)
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd", pool=pool)
+        held = []
+        lock = threading.Condition()
+
+        def work():
+            with db.checkout() as cursor:
+                with db.checkout() as nested:
+                    self.assertTrue(nested is cursor)
+                lock.acquire()
+                held.append(cursor.connection)
+                lock.notify_all()
+                # hold the connection until every thread has one
+                while len(held) < 4:
+                    lock.wait(5)
+                lock.release()
+
+        for i in range(2):
+            del held[:]
+            threads = [threading.Thread(target=work) for t in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(set(map(id, held))), 4)
+            self.assertEqual(pool.count, 4)
+            self.assertEqual(sorted(map(id, pool.idle)), sorted(map(id, held)))
+        self.assertEqual(self.server.log.count(("rollback",)), 8)
+
+
+class InsertManyTest(DbaseTest):
+    """ insertMany() ids and statement count """
+
+    def testIdsOfLargeBatches(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd")
+        db.insertRow("hosts", {"name": "first", "site": "a"})
+        # well over 64KB per batch
+        rows = [{"name": "host-%d-%s" % (i, "x" * 100), "site": "b", "unknown": 1} for i in range(2500)]
+        ids = db.insertMany("hosts", rows, batch_size=1000)
+        self.assertEqual(ids, range(2, 2502))
+        inserts = [e for e in self.server.log if e[0] == "execute" and e[1].startswith("INSERT")]
+        self.assertEqual(len(inserts), 4)
+        stored = dict((row[1], row[0]) for row in self.server.rows["hosts"])
+        self.assertEqual([stored[row["name"]] for row in rows], ids)
+        self.assertEqual(self.commits(), 4)
+
+    def testColumnChangeStartsBatch(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd")
+        ids = db.insertMany("hosts", [{"name": "a"}, {"name": "b"}, {"name": "c", "site": "x"}])
+        self.assertEqual(ids, [1, 2, 3])
+        self.assertEqual(self.server.rows["hosts"][2], (3, "c", "x"))
+
+    def testIdsStepByIncrement(self):
+        self.server.increment = 10
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd")
+        ids = db.insertMany("hosts", [{"name": "a"}, {"name": "b"}, {"name": "c"}])
+        self.assertEqual(ids, [1, 11, 21])
+        self.assertEqual([row[0] for row in self.server.rows["hosts"]], ids)
+
+    def testExplicitIdsNotReported(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd")
+        ids = db.insertMany("hosts", [{"name": "a"}, {"id": 7, "name": "b"}, {"id": 8, "name": "c"}])
+        self.assertEqual(ids, [1, None, None])
+        self.assertEqual([row[0] for row in self.server.rows["hosts"]], [1, 7, 8])
+
+
+class SelectRowTest(DbaseTest):
+    """ selectRow(dict=True) """
+
+    def testColumnSubsetNamedFromResult(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd", cache=mySqlUtils.QueryCache())
+        db.insertMany("hosts", [{"name": "a", "site": "x"}, {"name": "b", "site": "y"}])
+        for i in range(2):
+            # the second call is answered by the cache
+            self.assertEqual(db.selectRow("hosts", cols="site, name", dict=True),
+                             [{"site": "x", "name": "a"}, {"site": "y", "name": "b"}])
+        describes = [e for e in self.server.log if e[0] == "execute" and e[1].startswith("DESCRIBE")]
+        self.assertEqual(len(describes), 1)
+        self.assertEqual(db.cache.stats()["hits"], 1)
+
+
+class QueryCacheTest(DbaseTest):
+    """ Results cached by dbase and dropped by writes """
+
+    def setUp(self):
+        DbaseTest.setUp(self)
+        self.cache = mySqlUtils.QueryCache()
+        self.db = mySqlUtils.dbase("test", "localhost", "user", "passwd", cache=self.cache)
+        self.db.insertRow("hosts", {"name": "a", "site": "x"})
+
+    def names(self, db=None):
+        return sorted(row[1] for row in (db or self.db).selectRow("hosts"))
+
+    def testInsertInvalidates(self):
+        self.assertEqual(self.names(), ["a"])
+        self.db.insertMany("hosts", [{"name": "b"}])
+        self.assertEqual(self.names(), ["a", "b"])
+        self.assertEqual(self.cache.stats()["hits"], 0)
+
+    def testUpdateInvalidates(self):
+        self.assertEqual(self.names(), ["a"])
+        self.db.updateRow("hosts", {"site": "y"}, {"name": "a"})
+        self.assertEqual(self.names(), ["a"])
+        self.assertEqual(self.cache.stats()["hits"], 0)
+
+    def testDeleteInvalidates(self):
+        self.assertEqual(self.names(), ["a"])
+        self.db.deleteRow("hosts", {"name": "a"})
+        self.assertEqual(self.names(), ["a"])
+        self.assertEqual(self.cache.stats()["hits"], 0)
+
+    def testUnchangedTableStillCached(self):
+        self.assertEqual(self.names(), ["a"])
+        self.db.runSql("DELETE FROM `other`.`hosts`")
+        self.db.insertRow("events", {"ts": "2024"})
+        self.assertEqual(self.names(), ["a"])
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def testWriteToOtherDatabaseInvalidates(self):
+        other = mySqlUtils.dbase("other", "localhost", "user", "passwd", cache=self.cache)
+        self.assertEqual(self.names(other), ["a"])
+        self.db.runSql("DELETE FROM other.hosts")
+        self.assertEqual(self.names(other), ["a"])
+        self.assertEqual(self.cache.stats()["hits"], 0)
+
+    def testUsersDoNotShareResults(self):
+        other = mySqlUtils.dbase("test", "localhost", "reader", "passwd", cache=self.cache)
+        self.assertEqual(self.names(), ["a"])
+        self.assertEqual(self.names(other), ["a"])
+        self.assertEqual(self.cache.stats()["hits"], 0)
+        self.assertEqual(self.cache.hitRatio(), 0.0)
+
+class IterSqlTest(DbaseTest):
+    """ Streaming reads on unbuffered cursors """
+
+    def setUp(self):
+        DbaseTest.setUp(self)
+        self.pool = mySqlUtils.DbPool("test", "localhost", "user", "passwd", min_size=0)
+        self.db = mySqlUtils.dbase("test", "localhost", "user", "passwd", pool=self.pool)
+        self.db.insertMany("hosts", [{"name": "h%d" % i, "site": "ab"[i % 2]} for i in range(5)])
+
+    def fetches(self):
+        return [e for e in self.server.log if e[0] == "fetchmany"]
+
+    def testRowsFetchedInChunks(self):
+        rows = list(self.db.iterSql("SELECT * FROM hosts", chunk=2))
+        self.assertEqual([row[1] for row in rows], ["h0", "h1", "h2", "h3", "h4"])
+        self.assertEqual(self.fetches(), [("fetchmany", 2)] * 4)
+        self.assertEqual(len(self.pool.idle), 1)
+
+    def testOwnConnectionWithoutPool(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd")
+        rows = list(db.iterSql("SELECT * FROM hosts"))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual([conn.closed for conn in self.server.connections[-2:]], [False, True])
+        self.assertTrue(self.server.connections[-2] is db.db)
+
+    def testSelectDictsWithWhere(self):
+        rows = list(self.db.iterSelect("hosts", cols="name", where_data={"site": "b"}, dict=True))
+        self.assertEqual(rows, [{"name": "h1"}, {"name": "h3"}])
+
+    def testStoppingEarlyDiscardsConnection(self):
+        rows = self.db.iterSelect("hosts", chunk=2)
+        rows.next()
+        rows.close()
+        self.assertEqual(self.pool.idle, [])
+        self.assertEqual(self.pool.count, 0)
+        self.assertTrue(self.server.connections[-1].closed)
+
+
+class TableStatsTest(DbaseTest):
+    """ Table and index statistics from information_schema """
+
+    def setUp(self):
+        DbaseTest.setUp(self)
+        self.db = mySqlUtils.dbase("test", "localhost", "user", "passwd")
+
+    def testTableStats(self):
+        stats = self.db.getTableStats("hosts")
+        self.assertEqual((stats["rows"], stats["exact"], stats["engine"]), (900, False, "InnoDB"))
+        self.assertEqual(stats["total_length"], 131072)
+        self.assertEqual(stats["auto_increment"], 1001)
+        self.assertEqual(self.db.getRowCount("hosts", exact=False), 900)
+
+    def testExactRowCount(self):
+        self.db.insertMany("hosts", [{"name": "a"}, {"name": "b"}])
+        stats = self.db.getTableStats("hosts", exact=True)
+        self.assertEqual((stats["rows"], stats["exact"]), (2, True))
+
+    def testMissingTable(self):
+        self.assertRaises(StandInProgrammingError, self.db.getTableStats, "nosuch")
+
+    def testTableSizes(self):
+        sizes = self.db.getTableSizes()
+        self.assertEqual(sorted(sizes), ["events", "hosts"])
+        self.assertEqual(sizes["events"]["total_length"], None)
+        self.assertEqual(sizes["hosts"], self.db.getTableStats("hosts"))
+
+    def testIndexes(self):
+        self.assertEqual(self.db.getIndexes("hosts"), [
+            {"name": "PRIMARY", "columns": ["id"], "unique": True, "primary": True, "type": "BTREE",
+             "cardinality": 900},
+            {"name": "site_name", "columns": ["site", "name"], "unique": False, "primary": False,
+             "type": "BTREE", "cardinality": 850}])
+        self.assertEqual(self.db.getIndexes("events"), [])
+
+
+class StatementTest(DbaseTest):
+    """ Parameterized and prepared statements """
+
+    def setUp(self):
+        DbaseTest.setUp(self)
+        self.saved_max = mySqlUtils.max_prepared
+        mySqlUtils.max_prepared = 2
+
+    def tearDown(self):
+        mySqlUtils.max_prepared = self.saved_max
+        DbaseTest.tearDown(self)
+
+    def testUpdateWithoutWhereRefused(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd")
+        self.assertRaises(ValueError, db.updateRow, "hosts", {"site": "b"}, {})
+        self.assertRaises(ValueError, db.updateRow, "hosts", {"site": "b"}, None)
+        self.assertEqual(self.server.log, [])
+
+    def testPreparedStatementsDeallocated(self):
+        db = mySqlUtils.dbase("test", "localhost", "user", "passwd", prepared=True)
+        db.insertRow("hosts", {"name": "a", "site": "x"})
+        for cols in ("name", "site", "id", "name"):
+            self.assertEqual(len(db.selectRow("hosts", cols=cols, where_data={"site": "x"})), 1)
+        self.assertEqual(len(db.db.prepared), 2)
+        self.assertEqual(sorted(mySqlUtils.prepared_statements[db.db].keys()), sorted(db.db.prepared.keys()))
+        deallocated = [e for e in self.server.log if e[0] == "execute" and e[1].startswith("DEALLOCATE")]
+        self.assertEqual(len(deallocated), 3)
+
+
+    def testPercentInColumnText(self):
+        for prepared in (False, True):
+            db = mySqlUtils.dbase("test", "localhost", "user", "passwd", prepared=prepared)
+            self.assertEqual(db.selectRow("events", cols="DATE_FORMAT(ts, '%Y')"), ())
+            self.assertEqual(db.selectRow("events", cols="DATE_FORMAT(ts, '%Y')", where_data={"id": 1}), ())
+        sent = [e[1] for e in self.server.log if e[0] == "execute"]
+        self.assertTrue("SELECT DATE_FORMAT(ts, '%Y') FROM `events`" in sent)
+        self.assertTrue("SELECT DATE_FORMAT(ts, '%Y') FROM `events` WHERE `id`=1" in sent)
+        prepares = [e[2][0] for e in self.server.log if e[0] == "execute" and e[1].startswith("PREPARE")]
+        self.assertEqual(prepares, ["SELECT DATE_FORMAT(ts, '%Y') FROM `events`",
+                                    "SELECT DATE_FORMAT(ts, '%Y') FROM `events` WHERE `id`=?"])
+
+
+if __name__ == "__main__":
+    unittest.main()